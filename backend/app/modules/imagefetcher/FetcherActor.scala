@@ -25,6 +25,9 @@ object FetcherActor {
     */
   def props(ws: WSClient, serverUrl: String, monitoring: ActorRef): Props = Props(new FetcherActor(ws, serverUrl, monitoring))
 
+  // Header identifying a request in the flask server traces
+  val CorrelationHeader = "X-Correlation-ID"
+
   // Messages definitions
   case class FetchRGB(date: String, place: String, scale: Option[Double], queryId: String)
 
@@ -100,30 +103,44 @@ class FetcherActor(ws: WSClient, serverUrl: String, monitoring: ActorRef) extend
     * @param url Which url to ask for on the flask server
     * @param params Parameters added to the Get request
     * @param task Reference to the task monitoring this computation
-    * @param queryId Id of the query which triggered this request
+    * @param queryId Id of the query which triggered this request, prefix of the correlation id sent to the server
     */
   def fetchImage(url: String, params: Seq[(String, String)], task: Future[Task], queryId: String): Unit = {
     val updatedTask = task.flatMap(task => monitoring
       .ask(UpdateTask(queryId, task.id, Some("Fetching"), Some(5), Some(params.toMap)))
       .mapTo[Task])
 
+    // The flask server tags its traces with this ID and echoes it back
+    val correlationId = queryId + "-" + Random.alphanumeric.take(8).mkString
+
     val request = ws.url(serverUrl + url)
       .withQueryString(params: _*)
+      .withHeaders(CorrelationHeader -> correlationId)
       .get()
 
     val currentSender = sender
 
-    request.map(response =>
-      if (response.status == 200) {
-        val url = (response.json \ "href").as[String]
-        updatedTask map (t => monitoring ? UpdateTask(queryId, t.id, Some("Image generated on Earth Engine"), Some(100),
-                                               Some(t.metadata + ("url" -> url))))
+    request.map(response => {
+      val correlation = "correlationId" -> response.header(CorrelationHeader).getOrElse(correlationId)
+
+      // Large images are split in tiles, the href of the response being the one of the first tile
+      val tiles = (response.json \ "tiles" \\ "href").flatMap(_.asOpt[String])
+      val href = (response.json \ "href").asOpt[String].orElse(tiles.headOption)
+
+      if (response.status == 200 && href.isDefined) {
+        val url = href.get
+        val status = if (tiles.size > 1) "Image generated on Earth Engine (first of " + tiles.size + " tiles)"
+                     else "Image generated on Earth Engine"
+        val tilesMetadata = if (tiles.size > 1) Map("tiles" -> tiles.mkString(" ")) else Map.empty[String, String]
+        updatedTask map (t => monitoring ? UpdateTask(queryId, t.id, Some(status), Some(100),
+                                               Some(t.metadata + ("url" -> url) ++ tilesMetadata + correlation)))
         currentSender ! FetchResponse(url)
       } else {
         val error = (response.json \ "error").asOpt[String]
-        updatedTask map (t => monitoring ? UpdateTask(queryId, t.id, Some("Link generation failed: " + error.getOrElse("no details")), Some(0)))
+        updatedTask map (t => monitoring ? UpdateTask(queryId, t.id, Some("Link generation failed: " + error.getOrElse("no details")), Some(0),
+                                               Some(t.metadata + correlation)))
       }
-    )
+    })
 
     request.onFailure {
       case _ => updatedTask map (t => monitoring ? UpdateTask(queryId, t.id, Some("Connection to server (flask) failed"), Some(0)))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python2
+
+"""Micro benchmark of the request parameters parsing.
+
+Compares the parsing of the /rgb parameters by a stack of get_param
+decorators using the former list based polygon parser, with the single pass
+get_params decorator parsing polygons to flat arrays.
+
+Run it from the imagefetcher directory:
+    python2 benchmarks/parameters.py
+"""
+
+import functools
+import json
+import os
+import sys
+import timeit
+
+from dateutil.relativedelta import relativedelta
+from flask import Flask
+from flask import request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+    'imagefetcher'))
+
+from utils import Error
+from utils import Parser
+from utils import get_params
+from utils import param
+
+
+def get_param(param_name, parser=str, required=False, default=None):
+    """Decorator formerly used on route handlers to pass a GET parameter to
+    the function, one decorator per parameter."""
+
+    def decorator(func):
+        """Parametrized decorator."""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            """Wrapper on the function, parsing GET parameter."""
+            param_value = request.args.get(param_name)
+
+            if required and param_value is None:
+                raise Error("Expected GET parameter '%s' missing." %
+                    param_name)
+
+            if param_value is not None:
+                try:
+                    param_value = parser(param_value)
+                except Error:
+                    raise
+                except Exception as e:
+                    raise Error(str(e))
+            else:
+                param_value = default
+
+            kwargs.update({param_name: param_value})
+            return func(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+def legacy_polygon(entry):
+    """Polygon parser used before the Vertices representation."""
+    polygon = json.loads(entry)
+
+    assert type(polygon) == list, "Not a list"
+    assert all(type(p) == list for p in polygon), "Not a list of list."
+    assert all(len(p) == 2 for p in polygon), ("Some points do not have 2 "
+            "coords.")
+    assert all(all(type(c) in (int, float) for c in p)
+            for p in polygon), "Some points have invalid types."
+    assert polygon[0] == polygon[-1], "Last point must equal first point."
+
+    return polygon
+
+
+def handler(**kwargs):
+    """Route handler doing nothing."""
+    return kwargs
+
+
+legacy_handler = handler
+for name, parser, required, default in reversed([
+        ("date", Parser.date, True, None),
+        ("polygon", legacy_polygon, False, None),
+        ("place", str, False, None),
+        ("country", str, False, None),
+        ("city", str, False, None),
+        ("scale", float, False, None),
+        ("delta", Parser.date_delta, False, relativedelta(months=6))]):
+    legacy_handler = get_param(name, parser=parser, required=required,
+        default=default)(legacy_handler)
+
+schema_handler = get_params(
+    param("date", parser=Parser.date, required=True),
+    param("polygon", parser=Parser.polygon, default=None),
+    param("place", parser=str, default=None),
+    param("country", parser=str, default=None),
+    param("city", parser=str, default=None),
+    param("scale", parser=float, default=None),
+    param("delta", parser=Parser.date_delta,
+        default=relativedelta(months=6)),
+)(handler)
+
+
+def main():
+    app = Flask(__name__)
+
+    for points in (5, 500, 50000):
+        polygon = [[i * 0.001, (i % 7) * 0.5] for i in range(points - 1)]
+        polygon.append(polygon[0])
+        query = {'date': '2015-04-01', 'polygon': json.dumps(polygon)}
+        number = max(1, 100000 // points)
+
+        with app.test_request_context('/rgb', query_string=query):
+            for label, function in (('get_param stack', legacy_handler),
+                    ('get_params', schema_handler)):
+                seconds = timeit.timeit(function, number=number)
+                print("%6d points, %-16s %9.1f us/request" % (points, label,
+                    seconds / number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
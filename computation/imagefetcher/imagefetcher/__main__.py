@@ -18,4 +18,6 @@ FLAGS = gflags.FLAGS
 
 if __name__ == "__main__":
     FLAGS(sys.argv)
-    app.run(host=FLAGS.host, port=FLAGS.port, debug=FLAGS.debug)
+    # Requests are handled concurrently, the rate limit queues them.
+    app.run(host=FLAGS.host, port=FLAGS.port, debug=FLAGS.debug,
+        threaded=True)
@@ -14,23 +14,141 @@ can initialize it by running the following command:
 Defined routes are:
     /rgb
     /forestDiff
+    /forestRanking
+    /index
+    /watchlist
+    /watchlist/<name>
+    /events
+    /jobs/<job_id>
+    /prefetch
+    /profiles/<name>
+    /tiles/forestDiff/<start>/<stop>/<z>/<x>/<y>.png
+    /timelapse
+
+Routes taking an area also accept POST requests, with parameters sent as form
+fields or as a JSON object. This is useful for polygons too large to fit in a
+query string.
+
+Routes generating an image also accept an 'async' parameter. When set to 1,
+they answer at once with a 202 status and the link of a job, polled on the
+/jobs/<job_id> route until the image is generated. The image is generated on
+a bounded pool of workers instead of holding the request thread (see the
+:mod:`asyncfetcher` module).
+
+Requests are admitted by priority class (interactive, batch or background),
+given by the 'priority' parameter or the X-Priority header. Requests of a
+class are served fairly across the X-Client-ID header values, and rejected
+with a 503 status if they would wait longer than the X-Request-Timeout header
+(in seconds).
+
+While the Earth Engine or OpenStreetMap are unavailable, requests fail at once
+(see the :mod:`circuitbreaker` module), unless an older result can be served
+instead. Such responses have a 'Warning: 110' header, and a stale field.
+
+Each request is identified by a correlation ID, taken from the
+X-Correlation-ID header or generated, and echoed in the response. See the
+:mod:`tracing` module to record the time spent in each stage of the requests.
+
+The images of the date windows and areas next to the /rgb and /forestDiff
+requests are prefetched while the rate limit is idle, see the
+:mod:`prefetch` module.
+
+Routes generating an image estimate its cost (pixels, bytes, scenes and
+latency) before sending anything to the Earth Engine. Requests over the
+budgets of the server are generated at a coarser scale, or rejected, see the
+:mod:`costs` module. Requests sent with dry_run=1 only return the estimate.
+
+Requests sent with a 'profile' parameter and a valid X-Profile-Token header
+are profiled. The X-Profile header of the response gives the name of the
+profile, downloaded from the /profiles/<name> route. See the
+:mod:`profiling` module.
 """
 
 import ee
+import functools
 import gflags
+import itertools
 import json
+import os
+import threading
 
 from datetime import date
+from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from flask import Flask
+from flask import Response
+from flask import copy_current_request_context
+from flask import g
 from flask import jsonify
+from flask import request
+from flask import send_file
+from flask import stream_with_context
+from flask import url_for
 
+from asyncfetcher import AsyncImageFetcher
+from circuitbreaker import CircuitOpen
+from circuitbreaker import clear_stale
+from circuitbreaker import is_stale
+from circuitbreaker import mark_stale
+from changes import DEFAULT_EVENTS_LIMIT
+from costs import COUNTRY_AREA
+from costs import LAND_AREA
+from costs import admit_reduction
+from costs import admit_request
+from costs import bounds_area
+from costs import check_budgets
+from costs import combine_estimates
+from costs import estimate_cost
+from fetcher import ALL_COUNTRIES
+from fetcher import COMPOSITES
+from fetcher import DEFAULT_RANKING_SCALE
+from fetcher import DEFAULT_BEST_SCENES
+from fetcher import DEFAULT_MAX_CLOUD_COVER
+from fetcher import EVI_DATASETS
+from fetcher import RGB_DATASETS
+from expression import Expression
 from fetcher import ImageFetcher
+from fetcher import OUTPUT_FORMATS
+from fetcher import is_upstream_failure
+from prefetch import Prefetcher
+from prefetch import neighbour_bounds
+from prefetch import neighbour_dates
+from productindex import ProductIndex
+from profiling import PROFILE_HEADER
+from profiling import PROFILE_TOKEN_HEADER
+from profiling import PROFILES_STORE
+from profiling import Profile
+from profiling import ProfileStore
+from profiling import requested_format
+from profiling import sampled_format
+from ratelimit import clear_admission
+from ratelimit import set_admission
+from scaleplanner import bytes_per_pixel
+from scaleplanner import plan_scale
+from tiles import TILES_STORE
+from tiles import TilePyramid
+from timelapse import DEFAULT_FRAME_DURATION
+from timelapse import DEFAULT_FRAME_SIZE
+from timelapse import MAX_FRAME_SIZE
+from timelapse import MIN_FRAME_DURATION
+from timelapse import download_frame
+from timelapse import encode_gif
+from timelapse import fetch_frames
+from timelapse import frame_dates
+from tracing import CORRELATION_HEADER
+from tracing import end_trace
+from tracing import get_exporter
+from tracing import span
+from tracing import start_trace
 from utils import Error
 from utils import Parser
-from utils import get_param
+from utils import get_params
+from utils import param
+from utils import request_values
+from utils import rectangle_bounds
 from utils import get_geometry
-from utils import scale_from_geometry
+from watchlist import open_events
+from watchlist import open_store
 
 
 app = Flask(__name__)
@@ -46,6 +164,375 @@ ee.Initialize()
 
 fetcher = ImageFetcher()
 
+# Index of the generated images, opened on first use since it depends on flags.
+PRODUCT_INDEX_FILE = 'products.sqlite'
+product_index = None
+product_index_lock = threading.Lock()
+
+
+def get_product_index():
+    """Returns the index of the generated images."""
+    global product_index
+    with product_index_lock:
+        if product_index is None:
+            if not os.path.isdir(FLAGS.store_dir):
+                os.makedirs(FLAGS.store_dir)
+            product_index = ProductIndex(os.path.join(FLAGS.store_dir,
+                PRODUCT_INDEX_FILE))
+        return product_index
+
+
+# Pyramid of forest change tiles, opened on first use since it depends on flags.
+tile_pyramid = None
+tile_pyramid_lock = threading.Lock()
+
+
+def get_tile_pyramid():
+    """Returns the pyramid of forest change tiles."""
+    global tile_pyramid
+    with tile_pyramid_lock:
+        if tile_pyramid is None:
+            # Flask resolves relative files from the application directory.
+            tile_pyramid = TilePyramid(fetcher, os.path.abspath(
+                os.path.join(FLAGS.store_dir, TILES_STORE)))
+        return tile_pyramid
+
+
+# Log of the change events, opened on first use since it depends on flags.
+event_log = None
+event_log_lock = threading.Lock()
+
+
+def get_event_log():
+    """Returns the log of the change events."""
+    global event_log
+    with event_log_lock:
+        if event_log is None:
+            event_log = open_events()
+        return event_log
+
+
+# Pool of workers running the asynchronous requests, started on first use.
+async_fetcher = None
+async_fetcher_lock = threading.Lock()
+
+
+def get_async_fetcher():
+    """Returns the fetcher running the asynchronous requests."""
+    global async_fetcher
+    with async_fetcher_lock:
+        if async_fetcher is None:
+            async_fetcher = AsyncImageFetcher(fetcher)
+        return async_fetcher
+
+
+# Prefetcher of the neighbours of the requests, started on first use.
+prefetcher = None
+prefetcher_lock = threading.Lock()
+
+
+def get_prefetcher():
+    """Returns the prefetcher of the neighbours of the requests."""
+    global prefetcher
+    with prefetcher_lock:
+        if prefetcher is None:
+            prefetcher = Prefetcher(get_async_fetcher(), fetcher.rate_limiter)
+        return prefetcher
+
+
+def requested(name):
+    """Whether a boolean parameter of the request is set.
+
+    Parameters:
+        name: name of the parameter.
+    Returns:
+        True if the parameter is 1 or true.
+    """
+    return str(request_values().get(name, '')).lower() in ('1', 'true')
+
+
+def asynchronous(func):
+    """Decorator running a route handler as a job if the request asks for it.
+
+    Requests sending async=1 are answered at once with the link of the job,
+    whose result is polled on the /jobs/<job_id> route. Other requests are
+    handled synchronously, as are dry runs. Parameters are parsed before the
+    job starts, so invalid requests are still rejected at once.
+
+    Parameters:
+        func: route handler returning a JSON response.
+    Returns:
+        The wrapped function.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        """Wrapper on the function, starting a job if requested."""
+        if not requested('async') or requested('dry_run'):
+            return func(*args, **kwargs)
+
+        @copy_current_request_context
+        def job():
+            """Runs the handler in the context of the request."""
+            response = func(*args, **kwargs)
+            return response.status_code, json.loads(response.get_data())
+
+        job_id = get_async_fetcher().start_job(job)
+        href = url_for('job_handler', job_id=job_id)
+        response = jsonify(job=job_id, status='pending', href=href)
+        response.status_code = 202
+        response.headers['Location'] = href
+        return response
+
+    return wrapper
+
+
+def dry_run_response(geometry, output_format, estimate, adjusted):
+    """Answers a dry run with the cost estimate of the image.
+
+    Parameters:
+        geometry: requested area.
+        output_format: one of the OUTPUT_FORMATS.
+        estimate: Estimate of the image, see :mod:`costs`.
+        adjusted: whether the scale was coarsened to fit the budgets.
+    Returns:
+        The JSON response.
+    """
+    return jsonify(dry_run=True, format=output_format, scale=estimate.scale,
+        adjusted=adjusted, geojson=geometry.toGeoJSON(),
+        estimate=estimate._asdict())
+
+
+def generate_image(product, key, rectangle, scale, generator):
+    """Reuses an image covering the rectangle, or generates a new one.
+
+    Images previously generated with the same parameters, covering the
+    rectangle at the same scale or a finer one are reused, unless they are
+    much larger than the request (see :mod:`productindex`). While the Earth
+    Engine is unavailable, an expired image whose link is still valid is
+    served instead, as a stale result.
+
+    Parameters:
+        product: name of the product.
+        key: list of the parameters defining the pixels of the image.
+        rectangle: area to fetch.
+        scale: image resolution, in meters per pixels.
+        generator: function generating the image and returning its link.
+    Returns:
+        A tuple of the link to the image, the GeoJSON geometry of the image
+        and a boolean telling whether the image was reused.
+    """
+    key = json.dumps(key, default=str)
+    bounds = rectangle_bounds(rectangle)
+    index = get_product_index()
+
+    cached = index.find(product, key, bounds, scale)
+    if cached is not None:
+        return cached['href'], cached['image_geojson'], True
+
+    image_geojson = rectangle.toGeoJSON()
+    try:
+        href = generator()
+    except (CircuitOpen, ee.EEException) as error:
+        # While the Earth Engine is unavailable, an older image is better
+        # than an error. Errors of the request itself are returned.
+        upstream = (isinstance(error, CircuitOpen)
+            or is_upstream_failure(error))
+        stale = (index.find(product, key, bounds, scale, stale=True)
+            if upstream else None)
+        if stale is None:
+            raise
+        mark_stale()
+        return stale['href'], stale['image_geojson'], True
+
+    index.add(product, key, bounds, scale, href, image_geojson)
+    return href, image_geojson, False
+
+
+def generate_images(product, key, rectangle, plan, output_format, generator):
+    """Generates the image of an area, split in tiles if needed.
+
+    Areas too large to be downloaded at once at the planned scale are split
+    in tiles, each generated as a separate image. See
+    :func:`scaleplanner.plan_scale`.
+
+    Parameters:
+        product: name of the product.
+        key: list of the parameters defining the pixels of the image.
+        rectangle: area to fetch.
+        plan: ScalePlan of the image.
+        output_format: one of the OUTPUT_FORMATS.
+        generator: function generating the image of a rectangle and
+            returning its link.
+    Returns:
+        A dictionary containing the href, image_geojson, cached and stale
+        fields of the response. Tiled images also have a list of tiles, each
+        with their own fields, and the href of their first tile.
+    """
+    # Thumbnails are sized in pixels, so they are neither tiled nor reused.
+    if output_format == 'thumb':
+        return {
+            'href': generator(rectangle),
+            'image_geojson': rectangle.toGeoJSON(),
+            'cached': False,
+            'stale': is_stale(),
+        }
+
+    tiles = []
+    for bounds in plan.tiles:
+        tile = (rectangle if len(plan.tiles) == 1
+            else fetcher.BoundsToRectangle(bounds))
+        href, image_geojson, cached = generate_image(product, key, tile,
+            plan.scale, lambda: generator(tile))
+        if cached and prefetcher is not None:
+            prefetcher.used(href)
+        tiles.append({
+            'href': href,
+            'image_geojson': image_geojson,
+            'cached': cached,
+        })
+
+    if len(tiles) == 1:
+        return dict(tiles[0], stale=is_stale())
+    return {
+        'href': tiles[0]['href'],
+        'image_geojson': rectangle.toGeoJSON(),
+        'cached': all(tile['cached'] for tile in tiles),
+        'stale': is_stale(),
+        'tiles': tiles,
+    }
+
+
+def prefetch_neighbours(product, neighbours, plan, output_format):
+    """Prefetches the images a client is likely to request next.
+
+    See the :mod:`prefetch` module. Only images fetched at once are
+    prefetched, and nothing is while the Earth Engine is unavailable.
+
+    Parameters:
+        product: name of the product.
+        neighbours: list of the (key, bounds, generator) of the images to
+            prefetch. See :func:`generate_images` for the key and generator.
+        plan: ScalePlan of the requested image.
+        output_format: one of the OUTPUT_FORMATS.
+    """
+    if (not neighbours or output_format == 'thumb' or len(plan.tiles) > 1
+            or not fetcher.breaker.available()):
+        return
+
+    prefetcher = get_prefetcher()
+    for key, bounds, generator in neighbours:
+
+        def fetch(key=key, bounds=bounds, generator=generator):
+            """Generates the image unless it is indexed already."""
+            tile = fetcher.BoundsToRectangle(bounds)
+            href, _, cached = generate_image(product, key, tile, plan.scale,
+                lambda: generator(tile))
+            return href, cached
+
+        prefetcher.prefetch((product, json.dumps(key, default=str), bounds,
+            plan.scale), fetch)
+
+
+# Registered first, since the hooks registered after a failing one are
+# skipped.
+@app.before_request
+def reset_staleness():
+    """Marks the request as answered with fresh results, until a stale one is
+    served."""
+    clear_stale()
+
+
+@app.before_request
+def start_request_trace():
+    """Starts tracing the request, and measures it as the root span."""
+    g.correlation_id = start_trace(request.headers.get(CORRELATION_HEADER),
+        get_exporter())
+    g.request_span = span('http.request', method=request.method,
+        route=request.path)
+    g.request_span.__enter__()
+
+
+@app.before_request
+def start_request_profile():
+    """Profiles the request if the caller asks for it, or if it is sampled."""
+    profile_format = requested_format(request.args.get('profile',
+        request.headers.get(PROFILE_HEADER)),
+        request.headers.get(PROFILE_TOKEN_HEADER)) or sampled_format()
+    if profile_format is not None:
+        g.profile = Profile(profile_format)
+        g.profile.start()
+
+
+@app.before_request
+def set_request_admission():
+    """Sets the priority class and client of the request for the rate limit."""
+    priority = request_values().get('priority',
+        request.headers.get('X-Priority', 'interactive'))
+    client = request.headers.get('X-Client-ID', request.remote_addr)
+    timeout = request.headers.get('X-Request-Timeout')
+
+    try:
+        timeout = float(timeout) if timeout is not None else None
+    except ValueError:
+        raise Error("X-Request-Timeout header must be a number of seconds.")
+
+    set_admission(priority, client, timeout)
+
+
+@app.after_request
+def flag_stale_response(response):
+    """Warns callers when the response contains stale results."""
+    if is_stale():
+        response.headers['Warning'] = '110 - "Response is Stale"'
+    return response
+
+
+def get_profile_store():
+    """Returns the store of the request profiles."""
+    # Flask resolves relative files from the application directory.
+    return ProfileStore(os.path.abspath(os.path.join(FLAGS.store_dir,
+        PROFILES_STORE)))
+
+
+@app.after_request
+def save_request_profile(response):
+    """Saves the profile of the request, and sends back its name."""
+    profile = getattr(g, 'profile', None)
+    if profile is not None:
+        profile.stop()
+        g.profile = None
+        response.headers[PROFILE_HEADER] = get_profile_store().save(profile,
+            '%s-%s' % (request.endpoint, getattr(g, 'correlation_id', '')))
+    return response
+
+
+@app.after_request
+def echo_correlation_id(response):
+    """Sends back the correlation ID, so callers can log it."""
+    correlation_id = getattr(g, 'correlation_id', None)
+    if correlation_id is not None:
+        response.headers[CORRELATION_HEADER] = correlation_id
+        g.request_span.set('status_code', response.status_code)
+    return response
+
+
+@app.teardown_request
+def end_request_trace(exception):
+    """Ends the root span, and exports the spans of the request."""
+    request_span = getattr(g, 'request_span', None)
+    if request_span is not None:
+        request_span.__exit__(type(exception) if exception else None,
+            exception, None)
+    end_trace()
+    clear_admission()
+    clear_stale()
+
+    # Profiles of requests failing before their response are dropped.
+    profile = getattr(g, 'profile', None)
+    if profile is not None:
+        profile.stop()
+
 
 @app.errorhandler(Error)
 def handle_error(error):
@@ -55,22 +542,34 @@ def handle_error(error):
     return response
 
 
-@app.route('/rgb')
-@get_param("date", parser=Parser.date, required=True)
-@get_param("polygon", parser=Parser.polygon, default=None)
-@get_param('place', parser=str, default=None)
-@get_param("country", parser=str, default=None)
-@get_param('city', parser=str, default=None)
-@get_param("scale", parser=float, default=None)
-@get_param("delta", parser=Parser.date_delta, default=relativedelta(months=6))
-def rgb_handler(date, polygon, place, country, city, scale, delta):
-    """Generates a RGB image of an area. Images are in PNG (in a zip).
+@app.route('/rgb', methods=['GET', 'POST'])
+@get_params(
+    param("date", parser=Parser.date, required=True),
+    param("polygon", parser=Parser.polygon, default=None),
+    param('place', parser=str, default=None),
+    param("country", parser=str, default=None),
+    param('city', parser=str, default=None),
+    param("scale", parser=float, default=None),
+    param("delta", parser=Parser.date_delta,
+        default=relativedelta(months=6)),
+    param("format", parser=Parser.one_of(OUTPUT_FORMATS), default='png'),
+    param("composite", parser=Parser.one_of(COMPOSITES), default='median'),
+    param("cloud_cover", parser=float, default=DEFAULT_MAX_CLOUD_COVER),
+    param("scenes", parser=int, default=DEFAULT_BEST_SCENES),
+)
+@asynchronous
+def rgb_handler(date, polygon, place, country, city, scale, delta, format,
+        composite, cloud_cover, scenes):
+    """Generates a RGB image of an area. Images are in PNG (in a zip) unless
+    another format is requested.
 
     GET query parameters:
         date (yyyy-mm-dd):
             Average date of the image to fetch. Required.
         polygon (list[list[int]]):
             Area to visualize. Required, or city/country must be specified.
+            Polygons with holes and multipolygons are given as GeoJSON
+            coordinates.
         place (str):
             Place to visualize. This is automatically converted to GeoJSON by
             the OpenStreetMap API. Required, or another position must be
@@ -81,15 +580,68 @@ def rgb_handler(date, polygon, place, country, city, scale, delta):
             City to visualize. Required, or country/polygon must be specified.
         scale (float):
             Precision of the picture. Unit is meter per pixels so lower is
-            better. Attempts to automatically generate it if not specified.
+            better. If not specified, the finest scale fitting the pixel
+            budget is chosen from the true size of the area. Areas too large
+            to be downloaded at once at the given scale are split in tiles.
         delta (yyyy-mm-dd):
             Delta within images are considered valid.
+        format (str):
+            Output format of the image. One of:
+                png: RGB rendering, in a zip. Default.
+                jpg: RGB rendering, lighter than png for previews.
+                thumb: small PNG preview of the area.
+                geotiff: raw red, green and blue bands as a GeoTIFF.
+                npy: raw red, green and blue bands as a NumPy array.
+        composite (str):
+            Method reducing the scenes to one image. One of:
+                median: median of all the scenes. Default.
+                cloudless: median of the scenes under the cloud cover, with
+                    cloudy pixels masked.
+                mosaic: least cloudy pixel of the scenes under the cloud
+                    cover.
+                best: median of the least cloudy scenes, with cloudy pixels
+                    masked.
+        cloud_cover (float):
+            Maximal cloud cover of the scenes, in percents. Ignored by the
+            median composite.
+        scenes (int):
+            Number of scenes reduced by the best composite.
+        async (int):
+            Set to 1 to generate the image as a job, polled on the
+            /jobs/<job_id> route.
+        dry_run (int):
+            Set to 1 to only estimate the cost of the image, without
+            generating it. The response then has the scale, adjusted and
+            estimate fields.
     Returns:
         A JSON containing metadata about the image:
             href (link):
-                Link to download the image.
+                Link to download the image, or its first tile if the image
+                is tiled.
+            image_geojson (dict):
+                Area of the image. It may be larger than the requested area
+                when a previously generated image is reused.
+            cached (bool):
+                Whether a previously generated image is reused.
+            stale (bool):
+                Whether an expired image is served because the Earth Engine
+                is unavailable, or an expired place geometry is served while
+                being resolved again.
+            scale (float):
+                Scale of the image, in meters per pixels.
+            adjusted (bool):
+                Whether the scale was coarsened to fit the budgets of the
+                server.
+            estimate (dict):
+                Only for dry runs: scale, width, height, pixels, bytes,
+                tiles, dataset, scenes and latency (in seconds) estimated
+                for the image. Scenes are null when they are unknown.
+            tiles (list):
+                Only for tiled images: href, image_geojson and cached fields
+                of each tile.
             error (str):
-                In case of error, displays the error message.
+                In case of error, displays the error message. Requests over
+                the budgets of the server also have the estimate field.
     """
     geometry = get_geometry({
         'country': (country, fetcher.CountryToGeometry),
@@ -98,26 +650,84 @@ def rgb_handler(date, polygon, place, country, city, scale, delta):
         'city': (city, fetcher.CityToGeometry),
     })
 
+    if not 0 <= cloud_cover <= 100:
+        raise Error("Cloud cover must be within 0 and 100.")
+    if scenes < 1:
+        raise Error("At least one scene must be reduced.")
+    if scale is not None and scale <= 0:
+        raise Error("Scale must be positive.")
+
     rectangle = fetcher.GeometryToRectangle(geometry)
-    if scale is None:
-        scale = scale_from_geometry(rectangle)
-
-    start_date = date - delta
-    end_date = date + delta
-    url = fetcher.GetRGBImage(start_date, end_date, rectangle, scale)
-    return jsonify(href=url, geojson=geometry.toGeoJSON(),
-        image_geojson=rectangle.toGeoJSON())
-
-
-@app.route('/forestDiff')
-@get_param('polygon', parser=Parser.polygon, default=None)
-@get_param('place', parser=str, default=None)
-@get_param('country', parser=str, default=None)
-@get_param('city', parser=str, default=None)
-@get_param('start', parser=int, default=2000)
-@get_param('stop', parser=int, default=date.today().year)
-@get_param('scale', parser=float, default=None)
-def forest_diff_handler(polygon, place, country, city, start, stop, scale):
+    plan, estimate, adjusted = admit_request(rectangle_bounds(rectangle),
+        scale, bytes_per_pixel(format), RGB_DATASETS,
+        [(date - delta, date + delta)], composite)
+    if requested('dry_run'):
+        return dry_run_response(geometry, format, estimate, adjusted)
+
+    def key(middle):
+        """Returns the parameters of the image of a date window."""
+        return [middle - delta, middle + delta, format, composite,
+            cloud_cover, scenes]
+
+    def generator(middle):
+        """Returns the function generating the image of a tile and a date
+        window on the Earth Engine."""
+        return lambda tile: fetcher.GetRGBImage(middle - delta,
+            middle + delta, tile, plan.scale, format, composite=composite,
+            max_cloud_cover=cloud_cover, scenes=scenes)
+
+    images = generate_images('rgb', key(date), rectangle, plan, format,
+        generator(date))
+
+    bounds = rectangle_bounds(rectangle)
+    prefetch_neighbours('rgb', [(key(middle), bounds, generator(middle))
+            for middle in neighbour_dates(date, delta)]
+        + [(key(date), neighbour, generator(date))
+            for neighbour in neighbour_bounds(bounds)], plan, format)
+    return jsonify(format=format, scale=plan.scale, adjusted=adjusted,
+        geojson=geometry.toGeoJSON(), **images)
+
+
+def check_forest_years(start, stop):
+    """Checks the years compared by a forest change request.
+
+    Parameters:
+        start: reference year.
+        stop: year compared to the reference year.
+    Returns:
+        The (start, stop) years, the current year being replaced by the last
+        complete one.
+    Raises:
+        Error: if the years are invalid.
+    """
+    current_year = date.today().year
+    try:
+        assert 2000 <= start <= current_year, ("Start year must be within 2000 "
+            "and %s" % current_year)
+        assert start < stop <= current_year, ("Stop year must be within start "
+            "and %s" % current_year)
+    except AssertionError as e:
+        raise Error(str(e))
+
+    stop = min(current_year - 1, stop)
+    start = min(stop - 1, start)
+    return start, stop
+
+
+@app.route('/forestDiff', methods=['GET', 'POST'])
+@get_params(
+    param('polygon', parser=Parser.polygon, default=None),
+    param('place', parser=str, default=None),
+    param('country', parser=str, default=None),
+    param('city', parser=str, default=None),
+    param('start', parser=int, default=2000),
+    param('stop', parser=int, default=date.today().year),
+    param('scale', parser=float, default=None),
+    param('format', parser=Parser.one_of(OUTPUT_FORMATS), default='png'),
+)
+@asynchronous
+def forest_diff_handler(polygon, place, country, city, start, stop, scale,
+        format):
     """Generates a RGB image of an are representing {de,re}forestation.
 
     Generates a RGB image where red green and blue channels correspond
@@ -130,6 +740,8 @@ def forest_diff_handler(polygon, place, country, city, start, stop, scale):
     GET Parameters:
         polygon (list[list[int]]):
             Area to visualize. Required, or another position must be specified.
+            Polygons with holes and multipolygons are given as GeoJSON
+            coordinates.
         place (str):
             Place to visualize. This is automatically converted to GeoJSON by
             the OpenStreetMap API. Required, or another position must be
@@ -145,40 +757,557 @@ def forest_diff_handler(polygon, place, country, city, start, stop, scale):
             Must be greater than start year, and lower than current year.
         scale (float):
             Precision of the picture. Unit is meter per pixels so lower is
-            better. Attempts to automatically generate it if not specified.
+            better. Chosen automatically if not specified, see the /rgb
+            route.
+        format (str):
+            Output format of the image. See the /rgb route for accepted
+            values. Raw formats (geotiff, npy) contain the EVI difference and
+            the land mask instead of the RGB rendering.
+        async (int):
+            Set to 1 to generate the image as a job. See the /rgb route.
+        dry_run (int):
+            Set to 1 to only estimate the cost of the image. See the /rgb
+            route.
+    Returns:
+        A JSON containing metadata about the image:
+            href (link):
+                Link to download the image. See the /rgb route for the
+                other fields.
+            error (str):
+                In case of error, displays the error message.
+    """
+    geometry = get_geometry({
+        'country': (country, fetcher.CountryToGeometry),
+        'place': (place, fetcher.PlaceToGeometry),
+        'polygon': (polygon, fetcher.VerticesToGeometry),
+        'city': (city, fetcher.CityToGeometry),
+    })
+
+    start, stop = check_forest_years(start, stop)
+    if scale is not None and scale <= 0:
+        raise Error("Scale must be positive.")
+    rectangle = fetcher.GeometryToRectangle(geometry)
+    plan, estimate, adjusted = admit_request(rectangle_bounds(rectangle),
+        scale, bytes_per_pixel(format, bands=2), EVI_DATASETS,
+        [(datetime(year, 1, 1), datetime(year, 12, 31))
+            for year in (start, stop)])
+    if requested('dry_run'):
+        return dry_run_response(geometry, format, estimate, adjusted)
+
+    def generator(tile):
+        """Generates the image of a tile on the Earth Engine."""
+        return fetcher.GetForestIndicesImage(start, stop, tile, plan.scale,
+            format)
+
+    images = generate_images('forestDiff', [start, stop, format], rectangle,
+        plan, format, generator)
+
+    prefetch_neighbours('forestDiff', [([start, stop, format], neighbour,
+            generator) for neighbour in neighbour_bounds(
+                rectangle_bounds(rectangle))], plan, format)
+    return jsonify(format=format, scale=plan.scale, adjusted=adjusted,
+        geojson=geometry.toGeoJSON(), **images)
+
+
+@app.route('/forestRanking', methods=['GET', 'POST'])
+@get_params(
+    param('countries', parser=Parser.names, default=None),
+    param('places', parser=Parser.names, default=None),
+    param('watchlist', parser=int, default=0),
+    param('start', parser=int, default=2000),
+    param('stop', parser=int, default=date.today().year),
+    param('scale', parser=float, default=DEFAULT_RANKING_SCALE),
+    param('sort', parser=Parser.one_of(['loss_area', 'gain_area']),
+        default='loss_area'),
+)
+@asynchronous
+def forest_ranking_handler(countries, places, watchlist, start, stop, scale,
+        sort):
+    """Ranks regions by their {de,re}forestation.
+
+    All regions are analyzed in a single Earth Engine reduction, instead of
+    one /forestDiff request per region. See
+    :meth:`ImageFetcher.GetForestChangeRanking` for more informations.
+
+    GET Parameters:
+        countries (str):
+            Comma separated names of the countries to rank, or 'all' for all
+            countries.
+        places (str):
+            Comma separated names of places to rank. These are converted to
+            GeoJSON by the geocoder.
+        watchlist (int):
+            Set to 1 to rank the regions precomputed by the watchlist mode.
+            At least countries, places or watchlist must be specified.
+        start (int):
+            Reference year. See the /forestDiff route.
+        stop (int):
+            Year compared to the reference year. See the /forestDiff route.
+        scale (float):
+            Precision of the analysis, in meters per pixels. Defaults to 1
+            kilometer.
+        sort (str):
+            Area the regions are sorted by, decreasing. One of loss_area
+            (default) or gain_area.
+        async (int):
+            Set to 1 to rank the regions as a job. See the /rgb route.
+        dry_run (int):
+            Set to 1 to only estimate the cost of the ranking, from the area
+            of the regions at the scale. Countries are counted with an
+            average area. See the /rgb route.
+    Returns:
+        A JSON containing:
+            scale (float):
+                Precision of the analysis, coarser than requested if adjusted.
+            adjusted (bool):
+                Whether the scale was coarsened to fit the budgets of the
+                server.
+            regions (list):
+                Name, deforested (loss_area) and reforested (gain_area) areas
+                of each region, in square meters.
+            missing (list):
+                Requested countries which are unknown.
+            error (str):
+                In case of error, displays the error message.
+    """
+    start, stop = check_forest_years(start, stop)
+    if scale <= 0:
+        raise Error("Scale must be positive.")
+
+    all_countries = countries is not None and [name.lower()
+        for name in countries] == [ALL_COUNTRIES]
+    regions = []
+    if places:
+        regions += zip(places, fetcher.PlacesToGeometries(places))
+    if watchlist:
+        store = open_store()
+        for name in store.keys():
+            document = store.get(name)
+            regions.append((document['name'],
+                ee.Geometry(document['geojson'])))
+
+    if not countries and not regions:
+        raise Error("Expected countries, places or watchlist parameter.")
+
+    areas = [bounds_area(rectangle_bounds(fetcher.GeometryToRectangle(
+        geometry))) for _, geometry in regions]
+    if all_countries:
+        areas.append(LAND_AREA)
+    else:
+        areas += [COUNTRY_AREA] * len(countries or [])
+    scale, estimate, adjusted = admit_reduction(areas, scale, EVI_DATASETS,
+        [(datetime(year, 1, 1), datetime(year, 12, 31))
+            for year in (start, stop)])
+    if requested('dry_run'):
+        return jsonify(dry_run=True, start=start, stop=stop, scale=scale,
+            adjusted=adjusted, estimate=estimate._asdict())
+
+    ranking = fetcher.GetForestChangeRanking(start, stop, scale,
+        countries=ALL_COUNTRIES if all_countries else countries,
+        regions=regions, sort_by=sort)
+
+    ranked = set(region['name'] for region in ranking)
+    missing = [] if all_countries else [name for name in countries or []
+        if name.capitalize() not in ranked]
+    return jsonify(start=start, stop=stop, scale=scale, adjusted=adjusted,
+        sort=sort, regions=ranking, missing=missing)
+
+
+@app.route('/index', methods=['GET', 'POST'])
+@get_params(
+    param('expression', parser=str, required=True),
+    param('polygon', parser=Parser.polygon, default=None),
+    param('place', parser=str, default=None),
+    param('country', parser=str, default=None),
+    param('city', parser=str, default=None),
+    param('date', parser=Parser.date, default=None),
+    param('delta', parser=Parser.date_delta,
+        default=relativedelta(months=6)),
+    param('scale', parser=float, default=None),
+    param('min', parser=float, default=-1.),
+    param('max', parser=float, default=1.),
+    param('palette', parser=str, default='FF0000,FFFFFF,00FF00'),
+    param('format', parser=Parser.one_of(OUTPUT_FORMATS), default='png'),
+)
+@asynchronous
+def index_handler(expression, polygon, place, country, city, date, delta,
+        scale, min, max, palette, format):
+    """Generates an image of a custom index defined by a band-math expression.
+
+    Expressions combine bands of several datasets reduced over date windows,
+    for instance the NDVI of 2015:
+        median((landsat.B5 - landsat.B4) / (landsat.B5 + landsat.B4), 2015)
+    See the :mod:`expression` module for the complete syntax.
+
+    GET Parameters:
+        expression (str):
+            Band-math expression computing the index. Required.
+        polygon (list[list[int]]):
+            Area to visualize. Required, or another position must be specified.
+            Polygons with holes and multipolygons are given as GeoJSON
+            coordinates.
+        place (str):
+            Place to visualize. Required, or another position must be
+            specified.
+        country (str):
+            Country to visualize. Required, or other position must be specified.
+        city (str):
+            City to visualize. Required, or another position must be specified.
+        date (yyyy-mm-dd):
+            Average date of the window used by reductions not specifying one.
+        delta (yyyy-mm-dd):
+            Delta within images are considered valid around the date.
+        scale (float):
+            Precision of the picture. Unit is meter per pixels so lower is
+            better. Chosen automatically if not specified, see the /rgb
+            route.
+        min (float):
+            Index value rendered with the first color of the palette.
+        max (float):
+            Index value rendered with the last color of the palette.
+        palette (str):
+            Comma separated colors used to render the index.
+        format (str):
+            Output format of the image. See the /rgb route for accepted
+            values. Raw formats contain the index values.
+        async (int):
+            Set to 1 to generate the image as a job. See the /rgb route.
+        dry_run (int):
+            Set to 1 to only estimate the cost of the image. See the /rgb
+            route. The scenes of the expressions are not estimated.
     Returns:
         A JSON containing metadata about the image:
             href (link):
-                Link to download the image.
+                Link to download the image. See the /rgb route for the
+                other fields.
+            expression (str):
+                Normalized expression.
             error (str):
                 In case of error, displays the error message.
     """
+    normalized = Expression(expression).text
+
     geometry = get_geometry({
         'country': (country, fetcher.CountryToGeometry),
         'place': (place, fetcher.PlaceToGeometry),
         'polygon': (polygon, fetcher.VerticesToGeometry),
         'city': (city, fetcher.CityToGeometry),
     })
+    if scale is not None and scale <= 0:
+        raise Error("Scale must be positive.")
 
     rectangle = fetcher.GeometryToRectangle(geometry)
-    if scale is None:
-        scale = scale_from_geometry(rectangle)
+    plan, estimate, adjusted = admit_request(rectangle_bounds(rectangle),
+        scale, bytes_per_pixel(format, bands=1))
+    if requested('dry_run'):
+        return dry_run_response(geometry, format, estimate, adjusted)
+
+    start_date, end_date = None, None
+    if date is not None:
+        start_date, end_date = date - delta, date + delta
+
+    def generator(tile):
+        """Generates the image of a tile on the Earth Engine."""
+        return fetcher.GetIndexImage(expression, tile, plan.scale,
+            start_date=start_date, end_date=end_date, output_format=format,
+            visualization={'min': min, 'max': max, 'palette': palette})
 
+    images = generate_images('index', [normalized, start_date, end_date, min,
+        max, palette, format], rectangle, plan, format, generator)
+    return jsonify(expression=normalized, format=format, scale=plan.scale,
+        adjusted=adjusted, geojson=geometry.toGeoJSON(), **images)
+
+
+@app.route('/tiles/forestDiff/<int:start>/<int:stop>/<int:z>/<int:x>/'
+    '<int:y>.png')
+def forest_diff_tile_handler(start, stop, z, x, y):
+    """Returns a tile of the forest changes within two years.
+
+    Tiles follow the z/x/y Web Mercator grid of web maps, and are rendered as
+    the /forestDiff images. They are generated on first request, then served
+    from the disk. See the :mod:`tiles` module for more informations.
+
+    Returns:
+        The 256x256 PNG tile.
+    """
     current_year = date.today().year
-    try:
-        assert 2000 <= start <= current_year, ("Start year must be within 2000 "
-            "and %s" % current_year)
-        assert start < stop <= current_year, ("Stop year must be within start "
-            "and %s" % current_year)
-    except AssertionError as e:
-        raise Error(str(e))
+    if not 2000 <= start < stop < current_year:
+        raise Error("Years must be within 2000 and %s, the start year "
+            "first." % (current_year - 1))
+    if FLAGS.tile_years and "%s:%s" % (start, stop) not in FLAGS.tile_years:
+        raise Error("Tiles are not served from %s to %s." % (start, stop),
+            404)
 
-    stop = min(current_year - 1, stop)
-    start = min(stop - 1, start)
+    response = send_file(get_tile_pyramid().get(start, stop, z, x, y),
+        mimetype='image/png')
+    # Tiles of past years never change.
+    response.cache_control.max_age = 7 * 24 * 3600
+    response.cache_control.public = True
+    return response
+
+
+@app.route('/timelapse', methods=['GET', 'POST'])
+@get_params(
+    param('polygon', parser=Parser.polygon, default=None),
+    param('place', parser=str, default=None),
+    param('country', parser=str, default=None),
+    param('city', parser=str, default=None),
+    param('start', parser=Parser.date, required=True),
+    param('stop', parser=Parser.date, required=True),
+    param('step', parser=Parser.date_delta, default=relativedelta(years=1)),
+    param('delta', parser=Parser.date_delta,
+        default=relativedelta(months=6)),
+    param('size', parser=int, default=DEFAULT_FRAME_SIZE),
+    param('duration', parser=int, default=DEFAULT_FRAME_DURATION),
+    param('composite', parser=Parser.one_of(COMPOSITES), default='median'),
+    param('cloud_cover', parser=float, default=DEFAULT_MAX_CLOUD_COVER),
+)
+def timelapse_handler(polygon, place, country, city, start, stop, step, delta,
+        size, duration, composite, cloud_cover):
+    """Generates an animated GIF showing how an area changes over time.
+
+    Each frame is the RGB image of a date window, as generated by the /rgb
+    route. The animation is streamed while the next frames are generated.
+    See the :mod:`timelapse` module for more informations.
+
+    GET Parameters:
+        polygon (list[list[int]]):
+            Area to visualize. Required, or another position must be specified.
+            See the /rgb route.
+        place (str):
+            Place to visualize. Required, or another position must be
+            specified.
+        country (str):
+            Country to visualize. Required, or other position must be specified.
+        city (str):
+            City to visualize. Required, or another position must be specified.
+        start (yyyy-mm-dd):
+            Middle date of the first frame. Required.
+        stop (yyyy-mm-dd):
+            Date after which there is no more frame. Required.
+        step (yyyy-mm-dd):
+            Delta between the middle dates of two frames. Defaults to a year.
+        delta (yyyy-mm-dd):
+            Delta around the middle date within images are considered valid
+            for a frame. Defaults to 6 months.
+        size (int):
+            Largest side of the frames, in pixels.
+        duration (int):
+            Display time of each frame, in milliseconds.
+        composite (str):
+            Method reducing the scenes of a frame to one image. See the /rgb
+            route.
+        cloud_cover (float):
+            Maximal cloud cover of the scenes, in percents. See the /rgb
+            route.
+        dry_run (int):
+            Set to 1 to only estimate the cost of the time-lapse: the sum of
+            the estimates of its frames. See the /rgb route.
+    Returns:
+        The animated GIF, or a JSON containing the error message if the first
+        frame cannot be generated. Time-lapses over the budgets of the server
+        are rejected, their frames being sized in pixels.
+    """
+    geometry = get_geometry({
+        'country': (country, fetcher.CountryToGeometry),
+        'polygon': (polygon, fetcher.VerticesToGeometry),
+        'place': (place, fetcher.PlaceToGeometry),
+        'city': (city, fetcher.CityToGeometry),
+    })
+    rectangle = fetcher.GeometryToRectangle(geometry)
+
+    if not 0 < size <= MAX_FRAME_SIZE:
+        raise Error("Size must be within 1 and %s." % MAX_FRAME_SIZE)
+    if duration < MIN_FRAME_DURATION:
+        raise Error("Duration must be at least %s." % MIN_FRAME_DURATION)
+    if not 0 <= cloud_cover <= 100:
+        raise Error("Cloud cover must be within 0 and 100.")
+    dates = frame_dates(start, stop, step)
+
+    # Resolution of the frames, choosing their dataset.
+    bounds = rectangle_bounds(rectangle)
+    plan = plan_scale(bounds, None, target_pixels=size * size)
+    scale = plan.scale
+
+    estimate = combine_estimates([estimate_cost(plan, bounds, RGB_DATASETS,
+        [(middle - delta, middle + delta)], composite) for middle in dates])
+    check_budgets(estimate)
+    if requested('dry_run'):
+        return dry_run_response(geometry, 'gif', estimate, False)
+
+    def load(middle):
+        """Generates and downloads the frame of a date window."""
+        return download_frame(fetcher.GetRGBFrame(middle - delta,
+            middle + delta, rectangle, scale, size, composite=composite,
+            max_cloud_cover=cloud_cover))
+
+    # Errors on the first frame are still reported with a proper status.
+    frames = fetch_frames(get_async_fetcher().submit, load, dates)
+    first = next(frames)
+
+    return Response(stream_with_context(encode_gif(itertools.chain([first],
+        frames), duration)), mimetype='image/gif')
+
+
+@app.route('/watchlist')
+def watchlist_handler():
+    """Lists the regions precomputed by the watchlist mode.
+
+    See the :mod:`watchlist` module for more informations.
+
+    Returns:
+        A JSON containing the watched regions:
+            regions (list):
+                Name, image bounds and last computed year of each region.
+    """
+    store = open_store()
+    regions = []
+    for name in store.keys():
+        document = store.get(name)
+        years = [int(year) for year in document['results']]
+        regions.append({
+            'name': document['name'],
+            'start': document['start'],
+            'last_year': max(years) if years else None,
+            'image_geojson': document['image_geojson'],
+        })
+
+    return jsonify(regions=regions)
+
+
+@app.route('/watchlist/<name>')
+def watchlist_region_handler(name):
+    """Returns the results precomputed by the watchlist mode on a region.
+
+    Earth Engine links expire, so only the statistics are stored. The image
+    links are generated on read, and indexed like the /forestDiff images.
+
+    Returns:
+        A JSON containing the region and its results per year:
+            results (dict):
+                Results of each computed year, containing the image link
+                (href), the deforested and reforested areas (stats) and the
+                largest deforested areas (clusters). Links are null while
+                the Earth Engine is unavailable.
+            error (str):
+                In case of error, displays the error message.
+    """
+    document = open_store().get(name)
+    if document is None:
+        raise Error("Region '%s' is not watched." % name, 404)
+
+    rectangle = ee.Geometry(document['image_geojson'])
+    scale = document['scale']
+    for summary in document['results'].values():
+        start, stop = summary['start'], summary['stop']
+
+        def generator(start=start, stop=stop):
+            """Generates the image of the year on the Earth Engine."""
+            return fetcher.GetForestIndicesImage(start, stop, rectangle,
+                scale)
+
+        try:
+            summary['href'], _, _ = generate_image('forestDiff',
+                [start, stop, 'png'], rectangle, scale, generator)
+        except (CircuitOpen, ee.EEException):
+            summary['href'] = None
+
+    return jsonify(**document)
+
+
+@app.route('/events')
+@get_params(
+    param('since', parser=int, default=0),
+    param('region', parser=str, default=None),
+    param('limit', parser=int, default=DEFAULT_EVENTS_LIMIT),
+)
+def events_handler(since, region, limit):
+    """Returns the forest change events detected by the watchlist mode.
+
+    Clients poll this route with the cursor of the previous response, so they
+    only receive the events they did not see yet. See the :mod:`changes`
+    module for the format of the events.
+
+    Returns:
+        A JSON containing:
+            events (list):
+                GeoJSON features of the new or grown deforested clusters,
+                oldest first.
+            cursor (int):
+                Value of the 'since' parameter of the next poll.
+    """
+    if not 0 < limit <= DEFAULT_EVENTS_LIMIT:
+        raise Error("Limit must be between 1 and %s." % DEFAULT_EVENTS_LIMIT)
+
+    events, cursor = get_event_log().since(since, region, limit)
+    return jsonify(events=events, cursor=cursor)
+
+
+@app.route('/jobs/<job_id>')
+def job_handler(job_id):
+    """Returns the result of a request run asynchronously.
+
+    Returns:
+        The JSON response of the request once it is finished, with its status
+        code. Until then, a 202 status and a JSON containing:
+            job (str):
+                ID of the job.
+            status (str):
+                'pending'.
+    """
+    result = get_async_fetcher().job(job_id)
+    if result is None:
+        raise Error("Unknown or expired job '%s'." % job_id, 404)
+
+    if result == 'pending':
+        response = jsonify(job=job_id, status='pending')
+        response.status_code = 202
+        return response
+
+    status_code, document = result
+    response = jsonify(**document)
+    response.status_code = status_code
+    return response
+
+
+@app.route('/prefetch')
+def prefetch_handler():
+    """Returns the counters of the prefetching of neighbours.
+
+    Returns:
+        A JSON containing:
+            level (int):
+                Aggressiveness of the prefetching, see --prefetch_level.
+            scheduled, generated, skipped, dropped, failed (int):
+                Number of prefetches scheduled, and of those which generated
+                an image, found it indexed already, were dropped for lack of
+                budget, or failed.
+            used (int):
+                Number of prefetched images later requested.
+            hit_rate (float):
+                Share of the prefetched images later requested.
+            saved_seconds (float):
+                Time spent generating and downloading the prefetched images
+                later requested, which their requests did not wait for.
+    """
+    return jsonify(level=FLAGS.prefetch_level, **get_prefetcher().stats())
+
+
+@app.route('/profiles/<name>')
+def profile_handler(name):
+    """Downloads the profile of a request.
+
+    Requires the X-Profile-Token header, see the :mod:`profiling` module.
+
+    Returns:
+        The pstats or collapsed stacks file.
+    """
+    requested_format('1', request.headers.get(PROFILE_TOKEN_HEADER))
+    path = get_profile_store().path(name)
+    if path is None:
+        raise Error("Unknown profile '%s'." % name, 404)
 
-    url = fetcher.GetForestIndicesImage(start, stop, rectangle, scale)
-    return jsonify(href=url, geojson=geometry.toGeoJSON(),
-        image_geojson=rectangle.toGeoJSON())
+    return send_file(path, mimetype='application/octet-stream')
 
 
 @app.route("/")
@@ -0,0 +1,197 @@
+#!/usr/bin/env python2
+
+"""Non-blocking variant of the image fetcher.
+
+The Earth Engine client and the HTTP calls are blocking, so every request
+waiting for the Earth Engine holds a server thread. The asynchronous fetcher
+runs these calls on a bounded pool of workers instead, and returns at once:
+    - calls return AsyncResult objects, which can be waited for later, or
+      gathered in order with :meth:`AsyncImageFetcher.map`;
+    - jobs are identified by an ID, and their result is polled later. This is
+      how routes called with async=1 answer before the image is generated.
+
+Workers run the calls with the admission parameters (see :mod:`ratelimit`)
+and the correlation ID of the request submitting them, so the rate limit
+still serves them by priority, and their spans belong to the request trace.
+The number of calls waiting for a worker is bounded, further calls being
+rejected with an Overloaded error.
+"""
+
+import logging
+import threading
+import uuid
+
+from multiprocessing.pool import ThreadPool
+
+from cache import LRUCache
+from circuitbreaker import clear_stale
+from ratelimit import Overloaded
+from ratelimit import admission
+from ratelimit import current_admission
+from tracing import correlation_id
+from tracing import end_trace
+from tracing import get_exporter
+from tracing import start_trace
+from tracing import trace_id
+from utils import Error
+
+# Number of calls running at the same time. Calls mostly wait for the Earth
+# Engine, so this is larger than the rate limit.
+DEFAULT_WORKERS = 16
+
+# Maximal number of calls submitted and not finished yet.
+DEFAULT_MAX_PENDING = 512
+
+# Number of finished jobs whose result is kept until polled.
+DEFAULT_MAX_JOBS = 1024
+
+
+class AsyncImageFetcher:
+    """Runs the calls of an ImageFetcher on a bounded pool of workers."""
+
+    def __init__(self, fetcher, workers=DEFAULT_WORKERS,
+            max_pending=DEFAULT_MAX_PENDING, max_jobs=DEFAULT_MAX_JOBS):
+        """Constructor. Starts the workers.
+
+        Parameters:
+            fetcher: ImageFetcher whose methods are called.
+            workers: number of calls running at the same time.
+            max_pending: maximal number of calls submitted and not finished.
+            max_jobs: number of finished jobs whose result is kept.
+        """
+        self.fetcher = fetcher
+        self.max_pending = max_pending
+        self.pool = ThreadPool(workers)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.running_jobs = set()
+        self.finished_jobs = LRUCache(max_jobs)
+
+    def _in_context(self, function):
+        """Wraps a function to run it in the context of the current
+        request: admission parameters and trace."""
+        context = current_admission()
+        trace = correlation_id()
+        exporter = get_exporter() if trace is not None else None
+        parent_trace = trace_id()
+
+        def wrapper(*args, **kwargs):
+            """Runs the function in the context of the submitting request."""
+            start_trace(trace, exporter, parent_trace)
+            clear_stale()
+            try:
+                with admission(*context):
+                    return function(*args, **kwargs)
+            finally:
+                end_trace()
+                with self.lock:
+                    self.pending -= 1
+
+        return wrapper
+
+    def submit(self, function, *args, **kwargs):
+        """Runs a function on the workers.
+
+        Parameters:
+            function: function to run. Typically a fetcher method.
+            args, kwargs: arguments of the function.
+        Returns:
+            The AsyncResult of the call. Its get() method waits for the value
+            returned by the function, or raises its exception.
+        Raises:
+            Overloaded: if too many calls are pending.
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise Overloaded("Server overloaded: %s calls pending." %
+                    self.pending)
+            self.pending += 1
+
+        return self.pool.apply_async(self._in_context(function), args, kwargs)
+
+    def call(self, method, *args, **kwargs):
+        """Calls a fetcher method on the workers.
+
+        Parameters:
+            method: name of the ImageFetcher method, e.g. 'GetRGBImage'.
+            args, kwargs: arguments of the method.
+        Returns:
+            The AsyncResult of the call.
+        """
+        return self.submit(getattr(self.fetcher, method), *args, **kwargs)
+
+    def map(self, function, arguments):
+        """Runs a function on several arguments concurrently.
+
+        Must not be called from a worker, which would wait for its own pool.
+
+        Parameters:
+            function: function to run.
+            arguments: list of argument tuples.
+        Returns:
+            The list of values returned by the calls, in the arguments order.
+        Raises:
+            The exception of the first failing call, in the arguments order.
+        """
+        results = [self.submit(function, *args) for args in arguments]
+        return [result.get() for result in results]
+
+    def start_job(self, function):
+        """Runs a function in the background, its result being polled later.
+
+        Parameters:
+            function: function without arguments, returning a tuple of an
+                HTTP status code and a JSON serializable document. Error
+                exceptions are converted to their status code and message.
+        Returns:
+            The ID of the job.
+        """
+        job_id = uuid.uuid4().hex
+
+        def job():
+            """Runs the function, and keeps its result until polled."""
+            try:
+                result = function()
+            except Error as e:
+                result = e.status_code, e.to_dict()
+            except Exception:
+                logging.exception("Job %s failed.", job_id)
+                result = 500, {'error': 'Internal error.'}
+
+            self.finished_jobs.put(job_id, result)
+            with self.lock:
+                self.running_jobs.discard(job_id)
+
+        with self.lock:
+            self.running_jobs.add(job_id)
+        try:
+            self.submit(job)
+        except Overloaded:
+            with self.lock:
+                self.running_jobs.discard(job_id)
+            raise
+
+        return job_id
+
+    def job(self, job_id):
+        """Returns the state of a job.
+
+        Parameters:
+            job_id: ID of the job, as returned by :meth:`start_job`.
+        Returns:
+            None if the job is unknown or expired, 'pending' if it is not
+            finished yet, or its (status code, document) result.
+        """
+        result = self.finished_jobs.get(job_id)
+        if result is not None:
+            return result
+
+        with self.lock:
+            if job_id in self.running_jobs:
+                return 'pending'
+        return None
+
+    def close(self):
+        """Stops the workers once the submitted calls are finished."""
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python2
+
+"""In-memory caches shared by the fetcher components."""
+
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread safe cache, evicting the least recently used entries."""
+
+    def __init__(self, capacity):
+        """Constructor.
+
+        Parameters:
+            capacity: maximal number of entries kept in the cache.
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value associated to a key.
+
+        Parameters:
+            key: key of the entry.
+            default: value returned if the key is not cached.
+        Returns:
+            The cached value, or the default one.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return default
+
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """Caches a value, evicting the least recently used one if full.
+
+        Parameters:
+            key: key of the entry.
+            value: value to cache.
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Removes an entry.
+
+        Parameters:
+            key: key of the entry.
+            default: value returned if the key is not cached.
+        Returns:
+            The removed value, or the default one.
+        """
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python2
+
+"""Change detection, turning consecutive forest loss masks into events.
+
+Each watchlist run keeps the mask of the deforested pixels of a region in the
+raster store. The mask of the next run is compared with it, and only the
+clusters of deforested pixels which appeared or grew since are emitted, as
+GeoJSON features:
+    {
+        "type": "Feature",
+        "geometry": {"type": "Polygon", ...},  // Bounding box.
+        "properties": {
+            "change": "new",  // Or "grown".
+            "area": 1250000.0,  // Area of the cluster, in square meters.
+            "new_area": 250000.0,  // Area deforested since the last run.
+            "center": [-63.2, -8.7]
+        }
+    }
+
+Events are appended to a log, read by the clients from a cursor so they only
+download the events they did not see yet.
+"""
+
+import json
+import numpy
+import sqlite3
+import threading
+import time
+
+from utils import METERS_PER_DEGREE
+
+# Number of events returned at most by a read of the log.
+DEFAULT_EVENTS_LIMIT = 100
+
+
+def label_clusters(mask):
+    """Labels the 8-connected clusters of a mask.
+
+    Each iteration propagates the labels to the neighbours, then follows
+    them to the label of their own pixel until they no longer change
+    (pointer jumping), and the iterations stop once the labels are stable.
+    Jumping lets labels travel much further than one pixel per iteration in
+    most clusters, but long serpentine clusters can still need a number of
+    iterations proportional to their length.
+
+    Parameters:
+        mask: 2D boolean array.
+    Returns:
+        A 2D array of the same shape, where the pixels of a cluster have the
+        flat index of one of its pixels, and the pixels outside of the mask
+        have the size of the mask.
+    """
+    rows, columns = mask.shape
+    background = mask.size
+    labels = numpy.where(mask, numpy.arange(mask.size).reshape(mask.shape),
+        background)
+
+    while True:
+        padded = numpy.pad(labels, 1, mode='constant',
+            constant_values=background)
+        propagated = labels.copy()
+        for dy in range(3):
+            for dx in range(3):
+                numpy.minimum(propagated, padded[dy:dy + rows,
+                    dx:dx + columns], out=propagated)
+        propagated[~mask] = background
+
+        # Jump to the label of the labelling pixel.
+        flat = propagated.ravel()
+        inside = flat < background
+        while True:
+            jumped = flat[flat[inside]]
+            if numpy.array_equal(jumped, flat[inside]):
+                break
+            flat[inside] = jumped
+
+        if numpy.array_equal(propagated, labels):
+            return labels
+        labels = propagated
+
+
+def pixel_areas(shape, bounds):
+    """Computes the area of the pixels of each row of a raster.
+
+    Parameters:
+        shape: (rows, columns) of the raster.
+        bounds: (x_min, y_min, x_max, y_max) bounds of the raster.
+    Returns:
+        The array of the pixel areas of each row, in square meters.
+    """
+    rows, columns = shape
+    x_min, y_min, x_max, y_max = bounds
+    height = float(y_max - y_min) / rows
+    width = float(x_max - x_min) / columns
+    latitudes = y_max - (numpy.arange(rows) + 0.5) * height
+    return (width * METERS_PER_DEGREE * numpy.cos(numpy.radians(latitudes))
+        * height * METERS_PER_DEGREE)
+
+
+def detect_changes(previous, current, bounds):
+    """Finds the clusters of a mask which are new or grew.
+
+    Parameters:
+        previous: 2D boolean array of the previous mask, or None if there is
+            none. Masks of different shapes are not compared.
+        current: 2D boolean array of the current mask.
+        bounds: (x_min, y_min, x_max, y_max) bounds of the masks.
+    Returns:
+        The list of GeoJSON features of the new or grown clusters, largest
+        new area first.
+    """
+    current = numpy.asarray(current, dtype=bool)
+    if previous is None or previous.shape != current.shape:
+        previous = numpy.zeros(current.shape, dtype=bool)
+    else:
+        previous = numpy.asarray(previous, dtype=bool)
+
+    added = current & ~previous
+    if not added.any():
+        return []
+
+    labels = label_clusters(current)
+    areas = numpy.repeat(pixel_areas(current.shape, bounds)[:, None],
+        current.shape[1], axis=1)
+
+    # Aggregate each cluster at once, indexed by its label.
+    inside = labels < labels.size
+    cluster_labels = labels[inside]
+    area = numpy.bincount(cluster_labels, areas[inside], labels.size)
+    new_area = numpy.bincount(cluster_labels, (areas * added)[inside],
+        labels.size)
+    old_pixels = numpy.bincount(cluster_labels, previous[inside],
+        labels.size)
+
+    rows, columns = numpy.nonzero(inside)
+    row_min = numpy.full(labels.size, current.shape[0])
+    row_max = numpy.full(labels.size, -1)
+    column_min = numpy.full(labels.size, current.shape[1])
+    column_max = numpy.full(labels.size, -1)
+    numpy.minimum.at(row_min, cluster_labels, rows)
+    numpy.maximum.at(row_max, cluster_labels, rows)
+    numpy.minimum.at(column_min, cluster_labels, columns)
+    numpy.maximum.at(column_max, cluster_labels, columns)
+
+    x_min, y_min, x_max, y_max = bounds
+    width = float(x_max - x_min) / current.shape[1]
+    height = float(y_max - y_min) / current.shape[0]
+
+    features = []
+    for label in numpy.unique(labels[added]):
+        west = x_min + column_min[label] * width
+        east = x_min + (column_max[label] + 1) * width
+        north = y_max - row_min[label] * height
+        south = y_max - (row_max[label] + 1) * height
+        features.append({
+            'type': 'Feature',
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [[[west, south], [east, south], [east, north],
+                    [west, north], [west, south]]],
+            },
+            'properties': {
+                'change': 'grown' if old_pixels[label] else 'new',
+                'area': float(area[label]),
+                'new_area': float(new_area[label]),
+                'center': [(west + east) / 2., (south + north) / 2.],
+            },
+        })
+
+    features.sort(key=lambda feature: -feature['properties']['new_area'])
+    return features
+
+
+class EventLog:
+    """Persistent log of the change events, read from a cursor."""
+
+    def __init__(self, path):
+        """Constructor. Creates the database if it does not exist yet.
+
+        Parameters:
+            path: path of the SQLite database.
+        """
+        self.path = path
+        self.local = threading.local()
+
+        connection = self._connection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS events ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, region TEXT, '
+                'year INTEGER, created REAL, feature TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS events_region ON '
+                'events (region, id)')
+
+    def _connection(self):
+        """Returns the database connection of the current thread."""
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = sqlite3.connect(self.path)
+        return self.local.connection
+
+    def append(self, region, year, features):
+        """Appends the change events of a region.
+
+        Parameters:
+            region: name of the region.
+            year: year of the changes.
+            features: GeoJSON features of the changes.
+        """
+        connection = self._connection()
+        with connection:
+            connection.executemany('INSERT INTO events (region, year, '
+                'created, feature) VALUES (?, ?, ?, ?)', [(region, year,
+                    time.time(), json.dumps(feature)) for feature in features])
+
+    def since(self, cursor=0, region=None, limit=DEFAULT_EVENTS_LIMIT):
+        """Reads the events appended after a cursor.
+
+        Parameters:
+            cursor: ID of the last event already read. 0 reads the whole log.
+            region: name of the region whose events are read. All regions if
+                None.
+            limit: maximal number of events read.
+        Returns:
+            A tuple of the list of events, and the cursor of the last one. The
+            cursor is unchanged if there is no new event.
+        """
+        query = ('SELECT id, region, year, feature FROM events WHERE id > ?'
+            '%s ORDER BY id LIMIT ?' % (' AND region = ?' if region else ''))
+        params = [cursor] + ([region] if region else []) + [limit]
+
+        events = []
+        for event_id, event_region, year, feature in (
+                self._connection().execute(query, params)):
+            feature = json.loads(feature)
+            feature['id'] = event_id
+            feature['properties'].update(region=event_region, year=year)
+            events.append(feature)
+
+        return events, events[-1]['id'] if events else cursor
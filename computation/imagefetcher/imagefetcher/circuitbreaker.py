@@ -0,0 +1,157 @@
+#!/usr/bin/env python2
+
+"""Circuit breakers, failing fast while an upstream is down.
+
+Each upstream (the Earth Engine, Nominatim) has its own breaker. After
+--breaker_failures consecutive failures, the breaker opens: calls fail at
+once with a CircuitOpen error instead of waiting for the upstream to time
+out. After --breaker_reset seconds, one probe call is let through
+(half-open state), closing the breaker if it succeeds.
+
+While an upstream is down, callers serve the results they cached earlier
+even if they are expired. Such results are marked as stale on the current
+thread (see :func:`mark_stale`), and the API flags the response.
+"""
+
+import gflags
+import logging
+import threading
+import time
+
+from utils import Error
+
+FLAGS = gflags.FLAGS
+gflags.DEFINE_integer("breaker_failures", 5, "Number of consecutive upstream "
+    "failures opening its circuit breaker.")
+gflags.DEFINE_float("breaker_reset", 30, "Time, in seconds, after which an "
+    "open circuit breaker lets a probe call through.")
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+# Whether the request handled by the current thread used stale results.
+_staleness = threading.local()
+
+
+class CircuitOpen(Error):
+    """Exception raised when calling an upstream whose breaker is open."""
+
+    def __init__(self, name):
+        Error.__init__(self, "%s is unavailable, please retry later." % name,
+            503)
+
+
+def mark_stale():
+    """Marks the current request as answered with stale results."""
+    _staleness.stale = True
+
+
+def clear_stale():
+    """Resets the staleness of the current thread."""
+    _staleness.stale = False
+
+
+def is_stale():
+    """Returns whether the current request used stale results."""
+    return getattr(_staleness, 'stale', False)
+
+
+class CircuitBreaker:
+    """Circuit breaker of an upstream.
+
+    Used as a context manager around the upstream calls. Exceptions of the
+    failure types count as upstream failures, while other exceptions (e.g.
+    invalid requests) do not change the state of the breaker.
+    """
+
+    def __init__(self, name, failures=(Exception,), is_failure=None,
+            failure_threshold=None, reset_timeout=None):
+        """Constructor.
+
+        Parameters:
+            name: name of the upstream, used in error messages.
+            failures: exception types counting as upstream failures.
+            is_failure: function telling whether an exception of the failure
+                types is an upstream failure, for upstreams raising the same
+                type for the errors of the caller. All are if None.
+            failure_threshold: number of consecutive failures opening the
+                breaker. Defaults to --breaker_failures.
+            reset_timeout: time, in seconds, after which a probe is let
+                through. Defaults to --breaker_reset.
+        """
+        self.name = name
+        self.failures = failures
+        self.is_failure = is_failure
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.local = threading.local()
+
+    @property
+    def failure_threshold(self):
+        """Number of consecutive failures opening the breaker."""
+        if self._failure_threshold is not None:
+            return self._failure_threshold
+        return FLAGS.breaker_failures
+
+    @property
+    def reset_timeout(self):
+        """Time, in seconds, after which a probe is let through."""
+        if self._reset_timeout is not None:
+            return self._reset_timeout
+        return FLAGS.breaker_reset
+
+    def available(self):
+        """Returns whether a call would currently be let through."""
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                return time.time() - self.opened_at >= self.reset_timeout
+            return not self.probing
+
+    def __enter__(self):
+        """Context management: lets the call through, or fails fast."""
+        with self.lock:
+            probe = False
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpen(self.name)
+                self.state = HALF_OPEN
+
+            if self.state == HALF_OPEN:
+                # Only one probe at a time, the others still fail fast.
+                if self.probing:
+                    raise CircuitOpen(self.name)
+                self.probing = probe = True
+
+        self.local.probe = probe
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Context management: records the outcome of the call."""
+        failed = (exc_type is not None and issubclass(exc_type, self.failures)
+            and (self.is_failure is None or self.is_failure(exc_value)))
+
+        with self.lock:
+            if self.local.probe:
+                self.probing = False
+
+            if not failed:
+                if exc_type is None or self.local.probe:
+                    self.state = CLOSED
+                    self.consecutive_failures = 0
+                return
+
+            self.consecutive_failures += 1
+            if (self.local.probe
+                    or self.consecutive_failures >= self.failure_threshold):
+                if self.state != OPEN:
+                    logging.warning("Circuit breaker of %s opened after %s "
+                        "failures.", self.name, self.consecutive_failures)
+                self.state = OPEN
+                self.opened_at = time.time()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python2
+
+"""Cost estimates of the image requests, checked before the Earth Engine.
+
+The Earth Engine only rejects oversized requests once their graph is built
+and their download link requested, after they took a slot of the rate limit
+and a worker. The cost of a request is estimated from its area, scale, date
+windows and dataset instead, and checked against the budgets of the server
+before anything is sent upstream:
+    pixels: size of the whole image, all tiles included;
+    bytes: uncompressed size of the whole image;
+    scenes: number of images reduced to compose the image;
+    latency: expected generation time, in seconds.
+
+Requests over budget are either rejected, or generated at a coarser scale
+(fewer pixels, and possibly a coarser dataset with fewer scenes), depending
+on --cost_policy. Estimates are rough: they tell the order of magnitude of a
+request, not its exact cost.
+
+Requests generating several images, like time-lapses, sum the estimates of
+their images (see :func:`combine_estimates`). Reductions over regions, like
+rankings, download no image: their pixels are the ones reduced over the
+regions (see :func:`estimate_reduction`).
+"""
+
+import gflags
+import math
+
+from collections import namedtuple
+
+from fetcher import plan_dataset
+from scaleplanner import geodesic_dimensions
+from scaleplanner import plan_scale
+from utils import Error
+
+FLAGS = gflags.FLAGS
+gflags.DEFINE_integer("max_request_pixels", 400 * 1000 * 1000, "Maximal "
+    "number of pixels of an image, all tiles included.")
+gflags.DEFINE_integer("max_request_bytes", 1024 * 1024 * 1024, "Maximal "
+    "uncompressed size of an image, all tiles included, in bytes.")
+gflags.DEFINE_integer("max_request_scenes", 5000, "Maximal number of scenes "
+    "reduced to compose an image.")
+gflags.DEFINE_float("max_request_latency", 300, "Maximal expected generation "
+    "time of an image, in seconds.")
+gflags.DEFINE_enum("cost_policy", "adjust", ["adjust", "reject"], "Handling "
+    "of the requests over budget: generated at a coarser scale, or rejected.")
+
+BUDGETS = ('pixels', 'bytes', 'scenes', 'latency')
+
+# Side of the scenes of the collections split in scenes, in meters. Images of
+# the other collections cover the whole world.
+SCENE_SIDES = {
+    'LANDSAT/LC8_L1T': 185000,
+}
+
+# Rough costs of the Earth Engine, estimating the latency: building the graph
+# and requesting the link of a tile, then computing the pixels and reducing
+# the scenes.
+TILE_SECONDS = 2.
+MEGAPIXEL_SECONDS = 0.5
+SCENE_SECONDS = 0.05
+
+# Number of times the scale of a request over budget is coarsened at most.
+MAX_ADJUSTMENTS = 8
+
+# Area of the lands, and of an average country, in square meters. Country
+# geometries are only known by the Earth Engine.
+LAND_AREA = 1.49e14
+COUNTRY_AREA = LAND_AREA / 250
+
+Estimate = namedtuple('Estimate', ('scale', 'width', 'height', 'pixels',
+    'bytes', 'tiles', 'dataset', 'scenes', 'latency'))
+Estimate.__doc__ = """Cost of an image request.
+
+    scale: resolution, in meters per pixels.
+    width, height: size of the whole image, in pixels, or None if no image
+        is downloaded.
+    pixels: number of pixels of the whole image.
+    bytes: uncompressed size of the whole image, or None if no image is
+        downloaded.
+    tiles: number of images generated on the Earth Engine.
+    dataset: ID of the collection of the scenes, or None if unknown.
+    scenes: number of scenes reduced, or None if unknown.
+    latency: expected generation time, in seconds.
+"""
+
+
+class OverBudget(Error):
+    """Exception raised when a request exceeds the budgets of the server."""
+
+    def __init__(self, estimate, exceeded):
+        Error.__init__(self, "Request exceeds the %s budget%s. Request a "
+            "smaller area, a coarser scale or a shorter date window." % (
+                ", ".join(exceeded), "s" if len(exceeded) > 1 else ""))
+        self.estimate = estimate
+
+    def to_dict(self):
+        return dict(Error.to_dict(self), estimate=self.estimate._asdict())
+
+
+def bounds_area(bounds):
+    """Returns the area of bounds on the ground, in square meters."""
+    width, height = geodesic_dimensions(bounds)
+    return width * height
+
+
+def count_scenes(dataset, bounds, start_date, end_date):
+    """Estimates the number of scenes of a dataset covering an area.
+
+    Parameters:
+        dataset: Dataset of the scenes, see :mod:`fetcher`.
+        bounds: (x_min, y_min, x_max, y_max) bounds of the area, or None if
+            unknown, counting one scene per acquisition.
+        start_date: start of the date window.
+        end_date: end of the date window.
+    Returns:
+        The number of scenes: the acquisitions within the window, times the
+        number of scenes an acquisition needs to cover the area.
+    """
+    days = (end_date - max(start_date, dataset.first_date)).days
+    if days < 0:
+        return 0
+    acquisitions = max(1, int(math.ceil(float(days) / dataset.revisit)))
+
+    side = SCENE_SIDES.get(dataset.collection)
+    if side is None or bounds is None:
+        return acquisitions
+    width, height = geodesic_dimensions(bounds)
+    return acquisitions * (max(1, int(math.ceil(width / side)))
+        * max(1, int(math.ceil(height / side))))
+
+
+def estimate_cost(plan, bounds, datasets=None, windows=(), composite=None):
+    """Estimates the cost of an image.
+
+    Parameters:
+        plan: ScalePlan of the image, see :func:`scaleplanner.plan_scale`.
+        bounds: (x_min, y_min, x_max, y_max) bounds of the area.
+        datasets: catalog of the datasets the image is generated from, as
+            given to :func:`fetcher.plan_dataset`. The scenes are unknown if
+            None.
+        windows: (start, end) date windows whose scenes are reduced.
+        composite: composite method of the image, if any.
+    Returns:
+        The Estimate of the image.
+    """
+    pixels = plan.width * plan.height
+    dataset, scenes = None, None
+    if datasets is not None and windows:
+        dataset = plan_dataset(datasets, plan.scale, min(start
+            for start, _ in windows), max(end for _, end in windows),
+            composite)
+        scenes = sum(count_scenes(dataset, bounds, start, end)
+            for start, end in windows)
+
+    latency = (len(plan.tiles) * TILE_SECONDS
+        + pixels / 1e6 * MEGAPIXEL_SECONDS + (scenes or 0) * SCENE_SECONDS)
+    return Estimate(plan.scale, plan.width, plan.height, pixels, plan.bytes,
+        len(plan.tiles), dataset.collection if dataset else None, scenes,
+        round(latency, 1))
+
+
+def combine_estimates(estimates):
+    """Sums the estimates of the images generated by a single request.
+
+    Parameters:
+        estimates: non empty list of the Estimate of each image.
+    Returns:
+        The Estimate of the request, with the scale, size and dataset of its
+        first image.
+    """
+    first = estimates[0]
+    scenes = [estimate.scenes for estimate in estimates]
+    return first._replace(
+        pixels=sum(estimate.pixels for estimate in estimates),
+        bytes=sum(estimate.bytes for estimate in estimates),
+        tiles=sum(estimate.tiles for estimate in estimates),
+        scenes=None if None in scenes else sum(scenes),
+        latency=round(sum(estimate.latency for estimate in estimates), 1))
+
+
+def estimate_reduction(areas, scale, datasets=None, windows=()):
+    """Estimates the cost of a reduction over regions.
+
+    Parameters:
+        areas: area of each region, in square meters.
+        scale: resolution of the reduction, in meters per pixels.
+        datasets, windows: see :func:`estimate_cost`.
+    Returns:
+        The Estimate of the reduction, downloading no image.
+    """
+    pixels = int(sum(areas) / (float(scale) * scale))
+    dataset, scenes = None, None
+    if datasets is not None and windows:
+        dataset = plan_dataset(datasets, scale, min(start
+            for start, _ in windows), max(end for _, end in windows))
+        scenes = sum(count_scenes(dataset, None, start, end)
+            for start, end in windows)
+
+    latency = (TILE_SECONDS + pixels / 1e6 * MEGAPIXEL_SECONDS
+        + (scenes or 0) * SCENE_SECONDS)
+    return Estimate(scale, None, None, pixels, None, 1,
+        dataset.collection if dataset else None, scenes, round(latency, 1))
+
+
+def exceeded_budgets(estimate):
+    """Returns the names of the BUDGETS an estimate exceeds."""
+    limits = {
+        'pixels': FLAGS.max_request_pixels,
+        'bytes': FLAGS.max_request_bytes,
+        'scenes': FLAGS.max_request_scenes,
+        'latency': FLAGS.max_request_latency,
+    }
+    return [budget for budget in BUDGETS if getattr(estimate, budget)
+        is not None and getattr(estimate, budget) > limits[budget]]
+
+
+def check_budgets(estimate):
+    """Checks a request fits the budgets of the server, as it is.
+
+    Parameters:
+        estimate: Estimate of the request.
+    Raises:
+        OverBudget: if the request does not fit the budgets.
+    """
+    exceeded = exceeded_budgets(estimate)
+    if exceeded:
+        raise OverBudget(estimate, exceeded)
+
+
+def _admit(estimate_at, scale, policy):
+    """Coarsens the scale of a request until it fits the budgets.
+
+    Parameters:
+        estimate_at: function returning the plan of the request at a scale
+            (None to choose it automatically), and its Estimate.
+        scale: requested resolution, in meters per pixels.
+        policy: see :func:`admit_request`.
+    Returns:
+        A tuple of the plan, the Estimate, and whether the scale was
+        coarsened.
+    Raises:
+        OverBudget: if the request does not fit the budgets.
+    """
+    if policy is None:
+        policy = FLAGS.cost_policy
+
+    plan, estimate = estimate_at(scale)
+    exceeded = exceeded_budgets(estimate)
+    adjusted = False
+
+    for _ in range(MAX_ADJUSTMENTS if policy == 'adjust' else 0):
+        if not exceeded:
+            break
+        # Scale down to the pixels and bytes budgets at once, and at least
+        # halve the resolution when the scenes or the latency are over
+        # budget.
+        factor = math.sqrt(float(estimate.pixels) / FLAGS.max_request_pixels)
+        if estimate.bytes is not None:
+            factor = max(factor, math.sqrt(float(estimate.bytes)
+                / FLAGS.max_request_bytes))
+        if not set(exceeded) <= set(['pixels', 'bytes']):
+            factor = max(2., factor)
+        plan, estimate = estimate_at(int(math.ceil(estimate.scale * factor)))
+        exceeded = exceeded_budgets(estimate)
+        adjusted = True
+
+    if exceeded:
+        raise OverBudget(estimate, exceeded)
+    return plan, estimate, adjusted
+
+
+def admit_request(bounds, scale, pixel_bytes, datasets=None, windows=(),
+        composite=None, policy=None):
+    """Plans an image within the budgets of the server.
+
+    Parameters:
+        bounds: (x_min, y_min, x_max, y_max) bounds of the area.
+        scale: requested resolution, in meters per pixels, or None to choose
+            it automatically.
+        pixel_bytes: uncompressed size of a pixel, see
+            :func:`scaleplanner.bytes_per_pixel`.
+        datasets, windows, composite: see :func:`estimate_cost`.
+        policy: 'adjust' to coarsen the scale of requests over budget, or
+            'reject'. Defaults to --cost_policy.
+    Returns:
+        A tuple of the ScalePlan, the Estimate of the image, and whether the
+        scale was coarsened to fit the budgets.
+    Raises:
+        OverBudget: if the image does not fit the budgets.
+    """
+    def estimate_at(scale):
+        """Plans the image at a scale, and estimates it."""
+        plan = plan_scale(bounds, scale, pixel_bytes)
+        return plan, estimate_cost(plan, bounds, datasets, windows, composite)
+
+    return _admit(estimate_at, scale, policy)
+
+
+def admit_reduction(areas, scale, datasets=None, windows=(), policy=None):
+    """Chooses the scale of a reduction over regions within the budgets of
+    the server.
+
+    Parameters:
+        areas, datasets, windows: see :func:`estimate_reduction`.
+        scale: requested resolution, in meters per pixels.
+        policy: see :func:`admit_request`.
+    Returns:
+        A tuple of the scale, the Estimate of the reduction, and whether the
+        scale was coarsened to fit the budgets.
+    Raises:
+        OverBudget: if the reduction does not fit the budgets.
+    """
+    return _admit(lambda scale: (scale, estimate_reduction(areas, scale,
+        datasets, windows)), scale, policy)
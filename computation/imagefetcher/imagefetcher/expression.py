@@ -0,0 +1,341 @@
+#!/usr/bin/env python2
+
+"""Band-math expressions, used to generate custom indices.
+
+Expressions are a small, safe subset of the Python syntax, compiled to an
+Earth Engine image. They support:
+    numbers and bands, referenced as dataset.band (e.g. landsat.B5)
+    arithmetic: + - * / ** and unary -
+    comparisons: < <= > >= == !=, combined with and/or
+    reductions of an expression over a date window:
+        median(expr, window), mean(expr, window), min(expr, window),
+        max(expr, window)
+    the difference between two windows:
+        change(expr, window, window), equal to
+        median(expr, second window) - median(expr, first window)
+
+A window is either a year (2015), two dates ("2015-01-01", "2015-06-30"), or
+omitted to use the dates of the request. Bands must be reduced over a window,
+and a reduction only reads bands of one dataset.
+
+For example, the NDVI of 2015 and the burn ratio change within two years:
+    median((landsat.B5 - landsat.B4) / (landsat.B5 + landsat.B4), 2015)
+    change((landsat.B5 - landsat.B7) / (landsat.B5 + landsat.B7), 2014, 2015)
+"""
+
+import ast
+import ee
+
+from datetime import datetime
+
+from utils import Error
+
+# Datasets available in the expressions, associated to their collection.
+DATASETS = {
+    'landsat': 'LANDSAT/LC8_L1T',
+    'modis': 'MODIS/MOD13A1',
+    'modis_sr': 'MODIS/MOD09GA',
+}
+
+REDUCERS = ('median', 'mean', 'min', 'max')
+
+BINARY_OPERATORS = {
+    ast.Add: '+',
+    ast.Sub: '-',
+    ast.Mult: '*',
+    ast.Div: '/',
+    ast.Pow: '**',
+}
+
+COMPARISON_OPERATORS = {
+    ast.Lt: '<',
+    ast.LtE: '<=',
+    ast.Gt: '>',
+    ast.GtE: '>=',
+    ast.Eq: '==',
+    ast.NotEq: '!=',
+}
+
+BOOLEAN_OPERATORS = {
+    ast.And: 'and',
+    ast.Or: 'or',
+}
+
+# Earth Engine image methods implementing the operators.
+IMAGE_METHODS = {
+    '+': 'add',
+    '-': 'subtract',
+    '*': 'multiply',
+    '/': 'divide',
+    '**': 'pow',
+    '<': 'lt',
+    '<=': 'lte',
+    '>': 'gt',
+    '>=': 'gte',
+    '==': 'eq',
+    '!=': 'neq',
+    'and': 'And',
+    'or': 'Or',
+}
+
+# Longest accepted expression, in characters.
+MAX_EXPRESSION_LENGTH = 2000
+
+# Year of the first images of the datasets, Landsat starting in 1972.
+MIN_WINDOW_YEAR = 1972
+
+try:
+    STRING_TYPES = basestring
+except NameError:
+    STRING_TYPES = str
+
+
+def _constant(node):
+    """Returns the value of a literal node, or None if it is not one."""
+    if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, getattr(ast, 'Num', ())):
+        return node.n
+    if isinstance(node, getattr(ast, 'Str', ())):
+        return node.s
+    return None
+
+
+def _window(arguments):
+    """Converts the window arguments of a reduction to two dates.
+
+    Parameters:
+        arguments: literal values following the reduced expression.
+    Returns:
+        The window as a tuple of two yyyy-mm-dd strings, or None if the
+        request window must be used.
+    Raises:
+        Error: if the window is invalid, or its year has no image.
+    """
+    if len(arguments) == 0:
+        return None
+
+    if (len(arguments) == 1 and isinstance(arguments[0], int)
+            and not isinstance(arguments[0], bool)):
+        year = arguments[0]
+        if not MIN_WINDOW_YEAR <= year <= datetime.now().year:
+            raise Error("Window year must be within %s and %s." % (
+                MIN_WINDOW_YEAR, datetime.now().year))
+        return ('%04d-01-01' % year, '%04d-12-31' % year)
+
+    if len(arguments) == 2 and all(isinstance(a, STRING_TYPES)
+            for a in arguments):
+        try:
+            start, end = [datetime.strptime(a, '%Y-%m-%d') for a in arguments]
+        except ValueError:
+            raise Error("Window dates must be formatted as yyyy-mm-dd.")
+        if start > end:
+            raise Error("Window start must be before its end.")
+        return tuple(arguments)
+
+    raise Error("A window is either a year or two dates.")
+
+
+class Expression:
+    """Parsed band-math expression.
+
+    The expression is converted to a tree of tuples:
+        ('num', value)
+        ('band', dataset, band)
+        ('op', operator, left, right)
+        ('neg', operand)
+        ('reduce', reducer, operand, window)
+    """
+
+    def __init__(self, text):
+        """Constructor. Parses and validates the expression.
+
+        Parameters:
+            text: the expression.
+        Raises:
+            Error: if the expression is invalid.
+        """
+        if len(text) > MAX_EXPRESSION_LENGTH:
+            raise Error("Expression is longer than %s characters." %
+                MAX_EXPRESSION_LENGTH)
+
+        try:
+            body = ast.parse(text.strip(), mode='eval').body
+        except SyntaxError as e:
+            raise Error("Invalid expression: %s" % e.msg)
+
+        self.tree = self._convert(body, dataset=None)
+        self.text = self._format(self.tree)
+
+    def _convert(self, node, dataset):
+        """Converts an AST node to the expression tree.
+
+        Parameters:
+            node: the AST node.
+            dataset: list containing the dataset read by the enclosing
+                reduction, or None outside of reductions.
+        Returns:
+            The expression tree.
+        """
+        value = _constant(node)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return ('num', value)
+
+        if isinstance(node, ast.Attribute):
+            if not isinstance(node.value, ast.Name):
+                raise Error("Bands are referenced as dataset.band.")
+            name, band = node.value.id, node.attr
+            if name not in DATASETS:
+                raise Error("Unknown dataset '%s'. Expected one of %s." %
+                    (name, ", ".join(sorted(DATASETS))))
+            if dataset is None:
+                raise Error("Band %s.%s must be reduced over a window, e.g. "
+                    "median(%s.%s, 2015)." % (name, band, name, band))
+            if dataset and dataset[0] != name:
+                raise Error("A reduction cannot read both %s and %s bands." %
+                    (dataset[0], name))
+            dataset[:] = [name]
+            return ('band', name, band)
+
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            return ('op', BINARY_OPERATORS[type(node.op)],
+                self._convert(node.left, dataset),
+                self._convert(node.right, dataset))
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op,
+                (ast.USub, ast.UAdd)):
+            operand = self._convert(node.operand, dataset)
+            return ('neg', operand) if isinstance(node.op, ast.USub) else operand
+
+        if isinstance(node, ast.Compare):
+            if len(node.ops) != 1:
+                raise Error("Comparisons cannot be chained.")
+            if type(node.ops[0]) not in COMPARISON_OPERATORS:
+                raise Error("Unsupported comparison: %s." %
+                    type(node.ops[0]).__name__)
+            return ('op', COMPARISON_OPERATORS[type(node.ops[0])],
+                self._convert(node.left, dataset),
+                self._convert(node.comparators[0], dataset))
+
+        if isinstance(node, ast.BoolOp):
+            operator = BOOLEAN_OPERATORS[type(node.op)]
+            tree = self._convert(node.values[0], dataset)
+            for value in node.values[1:]:
+                tree = ('op', operator, tree, self._convert(value, dataset))
+            return tree
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            return self._convert_call(node, dataset)
+
+        raise Error("Unsupported syntax in expression: %s." %
+            type(node).__name__)
+
+    def _convert_call(self, node, dataset):
+        """Converts a reduction call to the expression tree."""
+        function = node.func.id
+        if function not in REDUCERS + ('change',):
+            raise Error("Unknown function '%s'." % function)
+        if dataset is not None:
+            raise Error("Reductions cannot be nested.")
+        if getattr(node, 'keywords', None) or len(node.args) == 0:
+            raise Error("Expected %s(expression, window)." % function)
+
+        operand = self._convert(node.args[0], dataset=[])
+        arguments = [_constant(a) for a in node.args[1:]]
+        if any(a is None for a in arguments):
+            raise Error("Windows must be literal years or dates.")
+
+        if function != 'change':
+            return ('reduce', function, operand, _window(arguments))
+
+        if len(arguments) != 2:
+            raise Error("Expected change(expression, window, window).")
+        return ('op', '-',
+            ('reduce', 'median', operand, _window(arguments[1:])),
+            ('reduce', 'median', operand, _window(arguments[:1])))
+
+    def _format(self, tree):
+        """Formats an expression tree as a normalized text."""
+        kind = tree[0]
+        if kind == 'num':
+            return repr(float(tree[1]))
+        if kind == 'band':
+            return '%s.%s' % tree[1:]
+        if kind == 'neg':
+            return '(-%s)' % self._format(tree[1])
+        if kind == 'op':
+            return '(%s %s %s)' % (self._format(tree[2]), tree[1],
+                self._format(tree[3]))
+
+        window = '' if tree[3] is None else ', "%s", "%s"' % tree[3]
+        return '%s(%s%s)' % (tree[1], self._format(tree[2]), window)
+
+    def uses_request_window(self):
+        """Checks if a reduction uses the dates of the request."""
+        return any(self._request_windows(self.tree))
+
+    def _request_windows(self, tree):
+        """Yields True for each reduction using the request window."""
+        if tree[0] == 'reduce':
+            yield tree[3] is None
+        elif tree[0] == 'op':
+            for child in tree[2:]:
+                for value in self._request_windows(child):
+                    yield value
+        elif tree[0] == 'neg':
+            for value in self._request_windows(tree[1]):
+                yield value
+
+    def compile(self, window=None):
+        """Compiles the expression to an Earth Engine image.
+
+        Parameters:
+            window: tuple of two dates used by the reductions without window.
+        Returns:
+            The single band ('index') image computed by the expression.
+        Raises:
+            Error: if a reduction needs the request window but none is given.
+        """
+        return self._compile(self.tree, None, window).rename(['index'])
+
+    def _compile(self, tree, image, window):
+        """Compiles an expression tree, reading bands from an image."""
+        kind = tree[0]
+        if kind == 'num':
+            return ee.Image.constant(tree[1]).toFloat()
+        if kind == 'band':
+            return image.select([tree[2]]).toFloat()
+        if kind == 'neg':
+            return self._compile(tree[1], image, window).multiply(-1)
+        if kind == 'op':
+            left = self._compile(tree[2], image, window)
+            right = self._compile(tree[3], image, window)
+            return getattr(left, IMAGE_METHODS[tree[1]])(right)
+
+        _, reducer, operand, reduce_window = tree
+        if reduce_window is None:
+            reduce_window = window
+        if reduce_window is None:
+            raise Error("The expression needs date/delta parameters.")
+
+        dataset = self._dataset(operand)
+        if dataset is None:
+            # Only constants are reduced, the window does not matter.
+            return self._compile(operand, None, window)
+
+        collection = (ee.ImageCollection(DATASETS[dataset])
+                .filterDate(reduce_window[0], reduce_window[1]))
+        collection = collection.map(
+            lambda scene: self._compile(operand, scene, window))
+        return getattr(collection, reducer)()
+
+    def _dataset(self, tree):
+        """Returns the dataset read by a tree, or None if it is constant."""
+        if tree[0] == 'band':
+            return tree[1]
+        for child in tree[1:]:
+            if isinstance(child, tuple):
+                dataset = self._dataset(child)
+                if dataset is not None:
+                    return dataset
+        return None
@@ -3,78 +3,201 @@
 """Image fetcher, reaching the Google Earth Engine to get images from it."""
 
 import ee
-import requests
-import time
-import threading
+import re
 
-from collections import deque
+from collections import namedtuple
 from datetime import datetime
 
+from cache import LRUCache
+from circuitbreaker import CircuitBreaker
+from expression import Expression
+from geocoder import Geocoder
+from ratelimit import FairRateLimit
+from tracing import span
+from tracing import traced
 from utils import Error
+from utils import Vertices
+from utils import dimensions_from_scale
 
 # We cannot use a flag here, because of how the application is designed.
 DEFAULT_QUERY_PER_SECONDS = 3
-OPENSTREETMAP_URL = 'http://nominatim.openstreetmap.org/search'
 
-class RateLimit:
-    """Implementation of a rate limiter.
-
-    This class is highly inspired from the Riot Watcher project, with some
-    cool functionalities added.
+# Output formats supported by the image generators, associated to the format
+# name expected by the Earth Engine. Raw formats keep the original band values
+# while the others are 8-bit RGB renderings of the image.
+RAW_FORMATS = {
+    'geotiff': 'GEO_TIFF',
+    'npy': 'NPY',
+}
+VISUALIZED_FORMATS = {
+    'png': 'png',
+    'jpg': 'jpg',
+    'thumb': 'png',
+}
+OUTPUT_FORMATS = sorted(list(RAW_FORMATS) + list(VISUALIZED_FORMATS))
+
+# Largest side, in pixels, of images generated in thumbnail mode.
+THUMBNAIL_SIZE = 256
+
+# Messages of the Earth Engine errors caused by the Earth Engine itself
+# (timeouts, quotas, server errors), rather than by the request (invalid
+# band, request too large...).
+UPSTREAM_ERRORS = re.compile(r'timed out|deadline exceeded|quota|'
+    r'too many (concurrent|requests)|rate limit|internal error|server error|'
+    r'backend error|service unavailable|try again|HTTP code: (429|5\d\d)',
+    re.IGNORECASE)
+
+# Compositing methods reducing the Landsat scenes to one image:
+#   median: median of all the scenes.
+#   cloudless: median of the least cloudy scenes, clouds being masked.
+#   mosaic: least cloudy pixel among the least cloudy scenes.
+#   best: median of the N least cloudy scenes, clouds being masked.
+COMPOSITES = ('median', 'cloudless', 'mosaic', 'best')
+
+# Maximal cloud cover of a scene, in percents, for cloud aware composites.
+DEFAULT_MAX_CLOUD_COVER = 30
+
+# Number of scenes reduced by the 'best' composite.
+DEFAULT_BEST_SCENES = 5
+
+# Pixels having a higher cloud score (from 0 to 100) are masked.
+CLOUD_SCORE_THRESHOLD = 20
+
+# Number of compiled band-math expressions kept in memory.
+EXPRESSION_CACHE_SIZE = 256
+
+# Minimal EVI difference for a pixel to be considered as {de,re}forested.
+# EVI values of the MOD13A1 dataset are scaled by 10000.
+FOREST_CHANGE_THRESHOLD = 500
+
+# Maximal number of deforestation clusters returned by the change summary,
+# largest first.
+MAX_FOREST_CLUSTERS = 50
+
+# Fusion table of the countries boundaries, with their name in the Country
+# column.
+COUNTRIES_TABLE = 'ft:1tdSwUL7MVpOauSgRzqVTOwdfy17KDbw-1d9omPw'
+
+# Value of the countries of the forest ranking selecting all of them.
+ALL_COUNTRIES = 'all'
+
+# Properties of the regions returned by the forest ranking.
+RANKING_PROPERTIES = ['name', 'loss_area', 'gain_area']
+
+# Default resolution of the forest ranking, in meters per pixels. Selects the
+# 1 kilometer EVI dataset, light enough to reduce all countries at once.
+DEFAULT_RANKING_SCALE = 1000
+
+# Reducing all countries at once needs smaller tiles to fit in the Earth Engine
+# memory.
+RANKING_TILE_SCALE = 4
+
+Dataset = namedtuple('Dataset', ('collection', 'resolution', 'revisit',
+    'first_date', 'bands', 'visualization', 'composites'))
+Dataset.__doc__ = """Collection of the Earth Engine images are generated from.
+
+    collection: ID of the image collection.
+    resolution: native resolution, in meters per pixels.
+    revisit: interval between two images of a same place, in days.
+    first_date: date of the first image.
+    bands: bands used, e.g. red, green and blue for RGB images.
+    visualization: parameters rendering the bands as an 8-bit image.
+    composites: COMPOSITES supported by the collection.
+"""
+
+# Catalog of the datasets of the RGB images, finest first. Coarse requests
+# reduce far fewer and lighter MODIS images than Landsat scenes. MOD09A1
+# images are already 8-day composites of the clearest observations, so cloud
+# aware composites are only computed on Landsat.
+RGB_DATASETS = (
+    Dataset('LANDSAT/LC8_L1T', 30, 16, datetime(2013, 4, 11),
+        ['B4', 'B3', 'B2'], {'min': 6000, 'max': 18000}, COMPOSITES),
+    Dataset('MODIS/MOD09A1', 500, 8, datetime(2000, 2, 18),
+        ['sur_refl_b01', 'sur_refl_b04', 'sur_refl_b03'],
+        {'min': 0, 'max': 3000}, ('median',)),
+)
+
+# Catalog of the datasets of the EVI, finest first. Within many datasets,
+# the MODIS/MOD13A1 is the most accurate on the amazon rainforest, and
+# MOD13A2 is its 1 kilometer aggregate. Other datasets contains noise on some
+# part of the image.
+EVI_DATASETS = (
+    Dataset('MODIS/MOD13A1', 500, 16, datetime(2000, 2, 18), ['EVI'], None,
+        ()),
+    Dataset('MODIS/MOD13A2', 1000, 16, datetime(2000, 2, 18), ['EVI'], None,
+        ()),
+)
+
+
+def is_upstream_failure(exception):
+    """Returns whether an error is caused by the Earth Engine itself.
+
+    Transport errors are, as well as the Earth Engine errors telling of a
+    timeout, an exhausted quota or a server error. Errors of the request,
+    like an invalid band or a request too large, are not.
     """
-
-    def __init__(self, allowed_requests, seconds):
-        """Constructor.
-
-        Parameters:
-            allowed_requests: number of allowed requests during the time frame.
-            seconds: time frame, in seconds.
-        """
-        self.allowed_requests = allowed_requests
-        self.seconds = seconds
-        self.made_requests = deque()
-        self.lock = threading.Lock()
-
-    def _reload(self):
-        """Remove old requests."""
-        t = time.time()
-        while len(self.made_requests) > 0 and self.made_requests[0] < t:
-            self.made_requests.popleft()
-
-    def add_request(self):
-        """Add a request to the counter."""
-        self.made_requests.append(time.time() + self.seconds)
-
-    def requests_available(self):
-        """Check if a request is available.
-
-        Returns:
-            False if the rate limit is reached.
-        """
-        self._reload()
-        return len(self.made_requests) < self.allowed_requests
-
-    def __enter__(self):
-        """Context management: blocking requests in a threaded context."""
-        self.lock.acquire()
-        while not self.requests_available():
-            time.sleep(0.1)
-
-    def __exit__(self, *args):
-        """Context management: release the lock in threaded context."""
-        self.lock.release()
+    if isinstance(exception, ee.EEException):
+        return UPSTREAM_ERRORS.search(str(exception)) is not None
+    return isinstance(exception, IOError)
+
+
+def plan_dataset(datasets, scale, start_date, end_date, composite=None):
+    """Chooses the cheapest dataset satisfying a request.
+
+    The coarsest dataset which is at least as fine as the requested scale,
+    and has images within the requested dates, is chosen. Coarser images are
+    lighter to reduce, and fewer scenes cover the area.
+
+    Parameters:
+        datasets: catalog of the datasets, finest first.
+        scale: requested resolution, in meters per pixels. The finest dataset
+            is chosen if None.
+        start_date: start of the requested time window.
+        end_date: end of the requested time window.
+        composite: one of the COMPOSITES the dataset must support, if any.
+    Returns:
+        The chosen Dataset. When none satisfies the request, the finest
+        dataset having images within the dates, or the finest dataset.
+    """
+    window = (end_date - start_date).days
+    available = [dataset for dataset in datasets
+        if (composite is None or composite in dataset.composites)
+        and dataset.first_date <= end_date]
+    if not available:
+        return datasets[0]
+
+    # A window shorter than the revisit interval may not contain any image.
+    satisfying = [dataset for dataset in available
+        if scale is not None and dataset.resolution <= scale
+        and window >= dataset.revisit]
+    if satisfying:
+        return satisfying[-1]
+    return available[0]
 
 
 class ImageFetcher:
     """Implementation of the image fetcher."""
 
-    def __init__(self, query_per_seconds=DEFAULT_QUERY_PER_SECONDS):
-        """Constructor. Initializes a rate limit.
+    def __init__(self, query_per_seconds=DEFAULT_QUERY_PER_SECONDS,
+            geocoder=None):
+        """Constructor. Initializes a rate limit and a circuit breaker.
+
+        The rate limit is shared fairly within the priority classes of the
+        requests. See :class:`ratelimit.FairRateLimit`. The circuit breaker
+        rejects requests at once while the Earth Engine fails, instead of
+        queuing them in the rate limit. See :mod:`circuitbreaker`.
 
         Parameters:
             query_per_seconds: number of query per seconds on the backend.
+            geocoder: Geocoder used to convert place names to geometries.
         """
-        self.rate_limiter = RateLimit(query_per_seconds, 1)
+        self.rate_limiter = FairRateLimit(query_per_seconds, 1)
+        self.breaker = CircuitBreaker('Earth Engine',
+            failures=(ee.EEException, IOError),
+            is_failure=is_upstream_failure)
+        self.geocoder = geocoder if geocoder is not None else Geocoder()
+        self.yearly_evi = {}
+        self.expressions = LRUCache(EXPRESSION_CACHE_SIZE)
 
     def _load_land_mask(self):
         """Load a mask of lands and rivers.
@@ -87,40 +210,135 @@ class ImageFetcher:
                 .select(['Land_Cover_Type_1'])
                 .neq(0))
 
-    def _GetRGBImage(self, start_date, end_date, geometry, scale):
-        """Generates a RGB satellite image of an area within two dates.
+    def _ExportImage(self, image, visualization, geometry, scale,
+            output_format):
+        """Generates a link to download an image in the requested format.
 
-        See :meth:`GetRGBImage` for information about the parameters.
+        Parameters:
+            image: image to export, with its original band values.
+            visualization: parameters given to the Earth Engine to render
+                the image as an 8-bit RGB picture.
+            geometry: area to fetch; Earth Engine Geometry object.
+            scale: image resolution, in meters per pixels.
+            output_format: one of the OUTPUT_FORMATS.
+        Returns:
+            An URL to the generated image.
         """
-        # Get the Landsat 8 collection.
-        # TODO(funkysayu) might be good taking a look at other ones.
-        raw_collection = (ee.ImageCollection('LANDSAT/LC8_L1T')
+        region = geometry.toGeoJSONString()
+
+        # Raw formats skip the visualization, so analysis tools get the band
+        # values instead of colors.
+        if output_format in RAW_FORMATS:
+            export, params = image.getDownloadURL, {
+                'region': region,
+                'scale': scale,
+                'format': RAW_FORMATS[output_format],
+            }
+        elif output_format not in VISUALIZED_FORMATS:
+            raise Error('Unsupported output format: %s' % output_format)
+        elif output_format == 'png':
+            export, params = image.visualize(**visualization).getDownloadURL, {
+                'region': region,
+                'scale': scale,
+                'format': 'png',
+            }
+        else:
+            # Other formats are served by the thumbnail API, which is sized in
+            # pixels rather than in meters per pixels.
+            if output_format == 'thumb':
+                dimensions = THUMBNAIL_SIZE
+            else:
+                dimensions = dimensions_from_scale(geometry, scale)
+
+            export, params = image.visualize(**visualization).getThumbURL, {
+                'region': region,
+                'dimensions': dimensions,
+                'format': VISUALIZED_FORMATS[output_format],
+            }
+
+        with span('ee.getDownloadUrl', format=output_format):
+            return export(params)
+
+    def _GetComposite(self, dataset, start_date, end_date, geometry,
+            composite, max_cloud_cover, scenes):
+        """Reduces the scenes of an area to one image.
+
+        Parameters:
+            dataset: Dataset of the scenes, as chosen by
+                :func:`plan_dataset`.
+        See :meth:`GetRGBImage` for information about the other parameters.
+        """
+        collection = (ee.ImageCollection(dataset.collection)
                 .filterDate(start_date, end_date)
                 .filterBounds(geometry))
 
-        # Reduce the collection to one image, and clip it to the bounds.
-        image = raw_collection.median().clip(geometry)
+        if composite == 'median':
+            return collection.median()
+
+        if composite not in COMPOSITES:
+            raise Error('Unsupported composite: %s' % composite)
+
+        # Drop cloudy scenes based on their metadata first, so the per pixel
+        # cloud score is only computed on the remaining ones.
+        collection = collection.filter(ee.Filter.lte('CLOUD_COVER',
+            max_cloud_cover))
+        if composite == 'best':
+            collection = collection.sort('CLOUD_COVER').limit(scenes)
+
+        def mask_clouds(image):
+            """Masks cloudy pixels, and adds the pixel clearness as a band."""
+            # The cloud score is computed on top of atmosphere reflectance,
+            # but the raw values are kept for the visualization.
+            cloud = ee.Algorithms.Landsat.simpleCloudScore(
+                ee.Algorithms.Landsat.TOA(image)).select('cloud')
+            clearness = ee.Image(100).subtract(cloud).rename(['clearness'])
+            return (image.updateMask(cloud.lte(CLOUD_SCORE_THRESHOLD))
+                    .addBands(clearness.toFloat()))
+
+        collection = collection.map(mask_clouds)
+        if composite == 'mosaic':
+            return collection.qualityMosaic('clearness')
+        return collection.median()
+
+    def _BuildRGBImage(self, start_date, end_date, geometry, scale,
+            composite, max_cloud_cover, scenes):
+        """Builds the RGB satellite image of an area within two dates.
 
-        # Create a visualization of the image
-        visualization = image.visualize(
-            min=6000,
-            max=18000,
-            bands=['B4', 'B3', 'B2'],
-        )
+        See :meth:`GetRGBImage` for information about the parameters.
+
+        Returns:
+            A tuple of the image and its visualization parameters.
+        """
+        dataset = plan_dataset(RGB_DATASETS, scale, start_date, end_date,
+            composite)
 
-        # Finally generate the png
-        return visualization.getDownloadUrl({
-            'region': geometry.toGeoJSONString(),
-            'scale': scale,
-            'format': 'png',
-        })
+        # Reduce the collection to one image, and clip it to the bounds.
+        with span('ee.buildGraph', composite=composite,
+                dataset=dataset.collection):
+            image = self._GetComposite(dataset, start_date, end_date,
+                geometry, composite, max_cloud_cover, scenes).clip(geometry)
+
+        visualization = dict(dataset.visualization, bands=dataset.bands)
+        return image.select(dataset.bands), visualization
+
+    def _GetRGBImage(self, start_date, end_date, geometry, scale,
+            output_format='png', composite='median',
+            max_cloud_cover=DEFAULT_MAX_CLOUD_COVER,
+            scenes=DEFAULT_BEST_SCENES):
+        """Generates a RGB satellite image of an area within two dates.
 
-    @staticmethod
-    def PlaceToGeometry(place_name, place_type=None):
+        See :meth:`GetRGBImage` for information about the parameters.
+        """
+        image, visualization = self._BuildRGBImage(start_date, end_date,
+            geometry, scale, composite, max_cloud_cover, scenes)
+        return self._ExportImage(image, visualization, geometry, scale,
+            output_format)
+
+    def PlaceToGeometry(self, place_name, place_type=None):
         """Converts a place name to a polygon representation.
 
-        Uses the OpenStreetMap public database to convert a city to a GeoJSON
-        representation.
+        Uses the geocoder (local gazetteer, then the OpenStreetMap public
+        database) to convert a place to a GeoJSON representation.
 
         Parameters:
             place_name: name of the place.
@@ -128,31 +346,23 @@ class ImageFetcher:
         Returns:
             A Geometry object representing area of the place.
         """
-        params = {
-            'format': 'json',
-            'polygon_geojson': 1,
-            'limit': 1,
-        }
-
-        if place_type is None:
-            params['q'] = place_name
-        else:
-            params['place_type'] = place_name
-
-        result = requests.get(OPENSTREETMAP_URL, params=params)
+        return ee.Geometry(self.geocoder.resolve(place_name, place_type))
 
-        if not result.ok:
-            raise Error('Unable to fetch city name. OpenStreetMap status '
-                'code: %s' % result.status_code, 500)
+    def PlacesToGeometries(self, place_names, place_type=None):
+        """Converts several place names to polygon representations.
 
-        result_json = result.json()
-        if len(result_json) == 0:
-            raise Error('Empty result received from the OpenStreetMap.', 500)
+        Places are resolved concurrently. See :meth:`PlaceToGeometry`.
 
-        return ee.Geometry(result_json[0].get("geojson", []))
+        Parameters:
+            place_names: list of place names.
+            place_type: type of the places (city, country...).
+        Returns:
+            The list of Geometry objects, in the same order as the names.
+        """
+        return [ee.Geometry(geojson) for geojson in
+            self.geocoder.resolve_many(place_names, place_type)]
 
-    @staticmethod
-    def CityToGeometry(city_name):
+    def CityToGeometry(self, city_name):
         """Converts a city name to a polygon representation.
 
         Uses the OpenStreetMap public database to convert a city to a GeoJSON
@@ -163,7 +373,7 @@ class ImageFetcher:
         Returns:
             A Geometry object representing area of the city.
         """
-        return ImageFetcher.PlaceToGeometry(city_name, place_type='city')
+        return self.PlaceToGeometry(city_name, place_type='city')
 
     @staticmethod
     def CountryToGeometry(country_name):
@@ -174,8 +384,7 @@ class ImageFetcher:
         Returns:
             A Geometry object representing area of the country.
         """
-        feature_id = 'ft:1tdSwUL7MVpOauSgRzqVTOwdfy17KDbw-1d9omPw'
-        countries = ee.FeatureCollection(feature_id)
+        countries = ee.FeatureCollection(COUNTRIES_TABLE)
         name = country_name.capitalize()
         server_geo = countries.filter(ee.Filter.eq('Country', name)).geometry()
 
@@ -183,20 +392,25 @@ class ImageFetcher:
         # generate the geo json object in order to specify a region to fetch,
         # we will dump the object data and put it in a new, client side
         # geometry.
-        return ee.Geometry(server_geo.getInfo())
+        with span('ee.getInfo', country=name):
+            return ee.Geometry(server_geo.getInfo())
 
     @staticmethod
     def VerticesToGeometry(vertices):
         """Converts a list of vertices to an Earth Engine geometry.
 
         Parameters:
-            vertices: A list of vertices representing a polygon.
+            vertices: A list of vertices representing a polygon, or the
+                Vertices parsed from a request.
         Returns:
             The Geometry object corresponding to these vertices.
         """
+        if isinstance(vertices, Vertices):
+            return ee.Geometry(vertices.to_geojson())
         return ee.Geometry.Polygon(vertices)
 
     @staticmethod
+    @traced('GeometryToRectangle')
     def GeometryToRectangle(geometry):
         """Converts a polygon geometry to the minimal rectangle containing it.
 
@@ -250,24 +464,153 @@ class ImageFetcher:
 
         return ee.Geometry.Rectangle(*max_bounds)
 
-    def _GetForestIndicesImage(self, start_year, end_year, geometry, scale):
-        """Generates a RGB image representing forestation within two years
+    @staticmethod
+    def BoundsToRectangle(bounds):
+        """Converts bounds to a rectangle, e.g. a tile of a larger image.
 
-        See :meth:`GetForestIndicesImage` for information about the parameters.
+        Parameters:
+            bounds: (x_min, y_min, x_max, y_max) bounds of the rectangle.
+        Returns:
+            The Geometry.Rectangle object.
+        """
+        return ee.Geometry.Rectangle(*bounds)
+
+    def _CompileExpression(self, expression, start_date, end_date):
+        """Compiles a band-math expression to an Earth Engine image.
+
+        Compiled images are cached by normalized expression, so equivalent
+        expressions share the same graph.
+
+        See :meth:`GetIndexImage` for information about the parameters.
+        """
+        expression = Expression(expression)
+        window = None
+        if expression.uses_request_window():
+            if start_date is None or end_date is None:
+                raise Error("The expression needs date/delta parameters.")
+            window = (start_date.strftime('%Y-%m-%d'),
+                end_date.strftime('%Y-%m-%d'))
+
+        key = (expression.text, window)
+        image = self.expressions.get(key)
+        if image is None:
+            with span('ee.buildGraph', expression=expression.text):
+                image = expression.compile(window)
+            self.expressions.put(key, image)
+
+        return image
+
+    def _GetYearlyEVI(self, year, dataset=EVI_DATASETS[0]):
+        """Returns the median EVI composite of a year.
+
+        Composites are only graph definitions, so they are kept and shared
+        between requests on the same year instead of being rebuilt.
+
+        Parameters:
+            year: year of the composite.
+            dataset: one of the EVI_DATASETS.
+        Returns:
+            The EVI composite image.
+        """
+        key = (dataset.collection, year)
+        if key not in self.yearly_evi:
+            # Select EVI, which is more accurate than NDVI here.
+            collection = ee.ImageCollection(dataset.collection).select(
+                dataset.bands)
+            self.yearly_evi[key] = collection.filterDate(
+                datetime(year, 1, 1), datetime(year, 12, 31)).median()
+
+        return self.yearly_evi[key]
+
+    def _GetEVIDifference(self, start_year, end_year, scale=None):
+        """Returns the difference between the EVI of two years.
+
+        The EVI dataset is chosen from the scale, see :func:`plan_dataset`.
+        The finest one is used if the scale is None.
+        """
+        dataset = plan_dataset(EVI_DATASETS, scale, datetime(start_year, 1, 1),
+            datetime(end_year, 12, 31))
+        return self._GetYearlyEVI(end_year, dataset).subtract(
+            self._GetYearlyEVI(start_year, dataset))
+
+    def _GetForestChanges(self, start_year, end_year, scale):
+        """Returns the masks of the deforested and reforested lands.
+
+        See :meth:`GetForestChangeSummary` for information about the
+        parameters.
+
+        Returns:
+            A tuple of the deforested and reforested masks.
         """
         mask = self._load_land_mask()
+        difference = self._GetEVIDifference(start_year, end_year,
+            scale).updateMask(mask)
+
+        return (difference.lt(-FOREST_CHANGE_THRESHOLD),
+            difference.gt(FOREST_CHANGE_THRESHOLD))
 
-        # Within many datasets, the MODIS/MOD13A1 is the most accurate on the
-        # amazon rainforest. Other datasets contains noise on some part of the
-        # image. Also select EVI, which is more accurate than NDVI here.
-        collection = ee.ImageCollection('MODIS/MOD13A1').select(['EVI'])
+    @staticmethod
+    def _GetForestChangeAreas(loss, gain):
+        """Returns the image of the changed area of each pixel, in square
+        meters, in its loss_area and gain_area bands."""
+        return (ee.Image.pixelArea().multiply(ee.Image.cat(loss, gain))
+                .rename(['loss_area', 'gain_area']))
+
+    def _GetForestChangeSummary(self, start_year, end_year, geometry, scale):
+        """Computes statistics about forestation within two years.
+
+        See :meth:`GetForestChangeSummary` for information about the
+        parameters.
+        """
+        loss, gain = self._GetForestChanges(start_year, end_year, scale)
+
+        # Sum the area of the changed pixels, in square meters.
+        areas = self._GetForestChangeAreas(loss, gain)
+        stats = areas.reduceRegion(
+            reducer=ee.Reducer.sum(),
+            geometry=geometry,
+            scale=scale,
+            maxPixels=1e9,
+        )
+
+        # Group connected deforested pixels as polygons, largest first.
+        clusters = loss.selfMask().reduceToVectors(
+            geometry=geometry,
+            scale=scale,
+            geometryType='polygon',
+            eightConnected=True,
+            maxPixels=1e9,
+        )
+        clusters = (clusters
+                .map(lambda f: f.set('area', f.geometry().area(1)))
+                .sort('area', False)
+                .limit(MAX_FOREST_CLUSTERS))
+
+        # Fetch both in a single round trip.
+        with span('ee.getInfo'):
+            return ee.Dictionary({
+                'stats': stats,
+                'clusters': clusters,
+            }).getInfo()
+
+    def _BuildForestIndicesImage(self, start_year, end_year, geometry,
+            output_format='png', scale=None):
+        """Builds the image representing forestation within two years.
+
+        See :meth:`GetForestIndicesImage` for information about the parameters.
+
+        Returns:
+            A tuple of the image and its visualization parameters.
+        """
+        mask = self._load_land_mask()
+        difference = self._GetEVIDifference(start_year, end_year, scale)
 
-        # Do the difference between EVI on one year.
-        older_evi = collection.filterDate(datetime(start_year, 1, 1),
-            datetime(start_year, 12, 31)).median()
-        newest_evi = collection.filterDate(datetime(end_year, 1, 1),
-            datetime(end_year, 12, 31)).median()
-        difference = newest_evi.subtract(older_evi)
+        # Raw formats export the signed EVI difference along with the land
+        # mask, which is what analysis tools need.
+        if output_format in RAW_FORMATS:
+            raw_image = (difference.unmask().addBands(mask)
+                    .rename(['EVI_difference', 'land']))
+            return raw_image.clip(geometry), {}
 
         # Set to 0 masked parts, and remove the mask. Thanks to this, image
         # will still be generated on masked parts.
@@ -282,16 +625,32 @@ class ImageFetcher:
         scaled_mask = mask.where(mask.eq(0), 2000).where(mask.eq(1), 0)
 
         rgb_image = ee.Image.rgb(negatives, positives, scaled_mask)
-        clipped = rgb_image.clip(geometry)
-        return clipped.visualize(min=0, max=2000).getDownloadURL({
-            'region': geometry.toGeoJSONString(),
-            'scale': scale,
-            'format': 'png',
-        })
-
-    def GetRGBImage(self, start_date, end_date, geometry, scale=100):
+        return rgb_image.clip(geometry), {'min': 0, 'max': 2000}
+
+    def _GetForestIndicesImage(self, start_year, end_year, geometry, scale,
+            output_format='png'):
+        """Generates a RGB image representing forestation within two years
+
+        See :meth:`GetForestIndicesImage` for information about the parameters.
+        """
+        with span('ee.buildGraph'):
+            image, visualization = self._BuildForestIndicesImage(start_year,
+                end_year, geometry, output_format, scale)
+
+        return self._ExportImage(image, visualization, geometry, scale,
+            output_format)
+
+    @traced('GetRGBImage')
+    def GetRGBImage(self, start_date, end_date, geometry, scale=100,
+            output_format='png', composite='median',
+            max_cloud_cover=DEFAULT_MAX_CLOUD_COVER,
+            scenes=DEFAULT_BEST_SCENES):
         """Generates a RGB satellite image of an area within two dates.
 
+        The scenes are taken from the coarsest dataset of the RGB_DATASETS
+        fine enough for the scale: MODIS for overviews of large areas, and
+        Landsat 8 when zoomed in. See :func:`plan_dataset`.
+
         Parameters:
             start_date: images in the collection generating the final picture
                 must have a later date than this one.
@@ -299,13 +658,58 @@ class ImageFetcher:
                 must have a earlier date than this one.
             geometry: area to fetch. Earth Enging Geometry object.
             scale: image resolution, in meters per pixels.
+            output_format: one of the OUTPUT_FORMATS. Defaults to a PNG
+                rendering of the red, green and blue bands. Raw formats keep
+                the band names of the dataset.
+            composite: one of the COMPOSITES, reducing the scenes taken
+                within the dates to one image. Cloud aware composites give
+                clean images on narrower date windows.
+            max_cloud_cover: maximal cloud cover of the scenes, in percents.
+                Ignored by the median composite.
+            scenes: number of scenes reduced by the best composite.
         Returns:
             An URL to the generated image.
         """
-        with self.rate_limiter:
-            return self._GetRGBImage(start_date, end_date, geometry, scale)
+        with self.breaker, self.rate_limiter:
+            return self._GetRGBImage(start_date, end_date, geometry, scale,
+                output_format, composite, max_cloud_cover, scenes)
+
+    @traced('GetRGBFrame')
+    def GetRGBFrame(self, start_date, end_date, geometry, scale, size,
+            composite='median', max_cloud_cover=DEFAULT_MAX_CLOUD_COVER,
+            scenes=DEFAULT_BEST_SCENES):
+        """Generates a RGB frame of a time-lapse, sized in pixels.
+
+        Frames of a time-lapse must all have the same size, whatever the
+        dataset of their window. See the :mod:`timelapse` module.
 
-    def GetForestIndicesImage(self, start_year, end_year, geometry, scale):
+        Parameters:
+            start_date: start of the window of the frame.
+            end_date: end of the window of the frame.
+            geometry: area to fetch; Earth Engine Geometry object.
+            scale: approximate resolution of the frame, in meters per pixels,
+                choosing the dataset.
+            size: largest side of the frame, in pixels.
+            composite: one of the COMPOSITES. See :meth:`GetRGBImage`.
+            max_cloud_cover: maximal cloud cover of the scenes, in percents.
+            scenes: number of scenes reduced by the best composite.
+        Returns:
+            An URL to the PNG frame.
+        """
+        with self.breaker, self.rate_limiter:
+            image, visualization = self._BuildRGBImage(start_date, end_date,
+                geometry, scale, composite, max_cloud_cover, scenes)
+
+            with span('ee.getDownloadUrl', format='frame'):
+                return image.visualize(**visualization).getThumbURL({
+                    'region': geometry.toGeoJSONString(),
+                    'dimensions': size,
+                    'format': 'png',
+                })
+
+    @traced('GetForestIndicesImage')
+    def GetForestIndicesImage(self, start_year, end_year, geometry, scale,
+            output_format='png'):
         """Generates a RGB image representing forestation within two years.
 
         Generates a RGB image where red green and blue channels correspond
@@ -321,7 +725,8 @@ class ImageFetcher:
         The dataset used to generate this image is the MOD13A1.005 Vegetation
         Indices 16-Day L3 Global 500m [1], provided publicly by the NASA. It is
         updated every 16 days, with a maximum scale of 500 meter per pixels.
-        This is the most accurate on the amazon rainforest.
+        This is the most accurate on the amazon rainforest. Images of a scale
+        of 1 kilometer or more use its 1 kilometer version, MOD13A2.
 
         Parameters:
             start_year: integer representing the reference year. Must be
@@ -331,9 +736,204 @@ class ImageFetcher:
                 start_year, and lower than or equal to the current year.
             geometry: area to fetch; Earth Engin Geometry object.
             scale: image resolution, in meters per pixels.
+            output_format: one of the OUTPUT_FORMATS. Raw formats contain the
+                EVI difference and the land mask bands instead of the RGB
+                rendering.
         Returns:
             An URL to the generated image.
         """
-        with self.rate_limiter:
+        with self.breaker, self.rate_limiter:
             return self._GetForestIndicesImage(start_year, end_year, geometry,
+                scale, output_format)
+
+    @traced('GetForestIndicesTile')
+    def GetForestIndicesTile(self, start_year, end_year, bounds, size):
+        """Generates a Web Mercator tile of the forestation image.
+
+        See :meth:`GetForestIndicesImage` for the rendering, and the
+        :mod:`tiles` module for the tiles pyramid.
+
+        Parameters:
+            start_year: integer representing the reference year.
+            end_year: integer representing the year on which we will subtract
+                the data generated from the start_year.
+            bounds: (x_min, y_min, x_max, y_max) bounds of the tile, in
+                degrees.
+            size: side of the tile, in pixels.
+        Returns:
+            An URL to the PNG tile.
+        """
+        # Tiles are rendered in the Web Mercator projection of web maps,
+        # whose edges are straight lines in degrees.
+        rectangle = ee.Geometry.Rectangle(list(bounds), 'EPSG:4326', False)
+
+        with self.breaker, self.rate_limiter:
+            with span('ee.buildGraph'):
+                image, visualization = self._BuildForestIndicesImage(
+                    start_year, end_year, rectangle)
+
+            with span('ee.getDownloadUrl', format='tile'):
+                return image.visualize(**visualization).getThumbURL({
+                    'region': rectangle.toGeoJSONString(),
+                    'dimensions': '%dx%d' % (size, size),
+                    'crs': 'EPSG:3857',
+                    'format': 'png',
+                })
+
+    @traced('GetForestChangeSummary')
+    def GetForestChangeSummary(self, start_year, end_year, geometry, scale):
+        """Computes statistics about forestation within two years.
+
+        Uses the same EVI difference as :meth:`GetForestIndicesImage`. Pixels
+        whose EVI changed by more than FOREST_CHANGE_THRESHOLD are considered
+        as deforested or reforested.
+
+        Parameters:
+            start_year: integer representing the reference year.
+            end_year: integer representing the year on which we will subtract
+                the data generated from the start_year.
+            geometry: area to analyze; Earth Engine Geometry object.
+            scale: analysis resolution, in meters per pixels.
+        Returns:
+            A dictionary containing:
+                stats: deforested (loss_area) and reforested (gain_area)
+                    areas, in square meters.
+                clusters: GeoJSON FeatureCollection of the largest deforested
+                    areas, with their area in square meters.
+        """
+        with self.breaker, self.rate_limiter:
+            return self._GetForestChangeSummary(start_year, end_year, geometry,
                 scale)
+
+    def _GetForestChangeRanking(self, start_year, end_year, scale, countries,
+            regions, sort_by):
+        """Ranks regions by their forest changes within two years.
+
+        See :meth:`GetForestChangeRanking` for information about the
+        parameters.
+        """
+        collections = []
+        if countries:
+            table = ee.FeatureCollection(COUNTRIES_TABLE)
+            if countries != ALL_COUNTRIES:
+                table = table.filter(ee.Filter.inList('Country',
+                    [name.capitalize() for name in countries]))
+            collections.append(table.map(lambda feature: ee.Feature(
+                feature.geometry(), {'name': feature.get('Country')})))
+        if regions:
+            collections.append(ee.FeatureCollection([ee.Feature(geometry,
+                {'name': name}) for name, geometry in regions]))
+
+        collection = collections[0]
+        for other in collections[1:]:
+            collection = collection.merge(other)
+
+        # Sum the changed areas of all regions in a single reduction.
+        areas = self._GetForestChangeAreas(*self._GetForestChanges(start_year,
+            end_year, scale))
+        ranking = (areas.reduceRegions(
+                    collection=collection,
+                    reducer=ee.Reducer.sum(),
+                    scale=scale,
+                    tileScale=RANKING_TILE_SCALE)
+                .sort(sort_by, False)
+                .select(RANKING_PROPERTIES, None, False))
+
+        with span('ee.getInfo'):
+            features = ranking.getInfo()['features']
+
+        return [dict((key, feature['properties'].get(key))
+            for key in RANKING_PROPERTIES) for feature in features]
+
+    @traced('GetForestChangeRanking')
+    def GetForestChangeRanking(self, start_year, end_year, scale,
+            countries=None, regions=None, sort_by='loss_area'):
+        """Ranks regions by their forest changes within two years.
+
+        The EVI difference is built once, and reduced over all the regions in
+        a single Earth Engine call, instead of one call per region. Countries
+        are taken from the same table as :meth:`CountryToGeometry`, on the
+        server side.
+
+        Parameters:
+            start_year: integer representing the reference year.
+            end_year: integer representing the year on which we will subtract
+                the data generated from the start_year.
+            scale: analysis resolution, in meters per pixels.
+            countries: list of country names, or ALL_COUNTRIES.
+            regions: list of (name, Geometry) tuples of other regions.
+            sort_by: 'loss_area' or 'gain_area', regions being sorted by
+                decreasing value.
+        Returns:
+            The list of the regions, each a dictionary containing its name,
+            and its deforested (loss_area) and reforested (gain_area) areas in
+            square meters. Unknown countries are missing.
+        Raises:
+            Error: if there is no region to rank.
+        """
+        if not countries and not regions:
+            raise Error('No region to rank.')
+
+        with self.breaker, self.rate_limiter:
+            return self._GetForestChangeRanking(start_year, end_year, scale,
+                countries, regions, sort_by)
+
+    @traced('GetForestLossMask')
+    def GetForestLossMask(self, start_year, end_year, geometry, scale):
+        """Generates the mask of the deforested pixels within two years.
+
+        Pixels are deforested as in :meth:`GetForestChangeSummary`. The mask
+        is meant to be compared locally with the one of a previous run, see
+        the :mod:`changes` module.
+
+        Parameters:
+            start_year: integer representing the reference year.
+            end_year: integer representing the year on which we will subtract
+                the data generated from the start_year.
+            geometry: area to fetch; Earth Engine Geometry object.
+            scale: image resolution, in meters per pixels.
+        Returns:
+            An URL to the mask, as a NPY array whose 'loss' band is 1 on
+            deforested pixels and 0 elsewhere.
+        """
+        with self.breaker, self.rate_limiter:
+            with span('ee.buildGraph'):
+                loss = (self._GetEVIDifference(start_year, end_year, scale)
+                        .lt(-FOREST_CHANGE_THRESHOLD)
+                        .And(self._load_land_mask())
+                        .unmask(0)
+                        .toByte()
+                        .rename(['loss']))
+
+            return self._ExportImage(loss.clip(geometry), {}, geometry, scale,
+                'npy')
+
+    @traced('GetIndexImage')
+    def GetIndexImage(self, expression, geometry, scale, start_date=None,
+            end_date=None, visualization=None, output_format='png'):
+        """Generates an image of a custom index defined by an expression.
+
+        See the :mod:`expression` module for the expression syntax.
+
+        Parameters:
+            expression: band-math expression computing the index.
+            geometry: area to fetch; Earth Engine Geometry object.
+            scale: image resolution, in meters per pixels.
+            start_date: start of the window used by reductions of the
+                expression not specifying one.
+            end_date: end of the window used by reductions of the expression
+                not specifying one.
+            visualization: parameters given to the Earth Engine to render the
+                index (min, max, palette).
+            output_format: one of the OUTPUT_FORMATS. Raw formats contain the
+                index values.
+        Returns:
+            An URL to the generated image.
+        Raises:
+            Error: if the expression is invalid.
+        """
+        # Invalid expressions are rejected before waiting for the limiter.
+        image = self._CompileExpression(expression, start_date, end_date)
+        with self.breaker, self.rate_limiter:
+            return self._ExportImage(image.clip(geometry),
+                visualization or {}, geometry, scale, output_format)
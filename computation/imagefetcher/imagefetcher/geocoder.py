@@ -0,0 +1,338 @@
+#!/usr/bin/env python2
+
+"""Geocoding client, converting place names to GeoJSON geometries.
+
+Names are resolved by a chain of providers: the first provider knowing a
+place answers it. By default, a local gazetteer file answers common names
+without reaching the network, and the OpenStreetMap Nominatim API answers
+everything else.
+
+Resolved places are cached. Expired entries are still answered, marked as
+stale, while they are resolved again in the background, so an unavailable
+provider does not delay requests on known places.
+"""
+
+import json
+import logging
+import os
+import requests
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+
+from cache import LRUCache
+from circuitbreaker import CircuitBreaker
+from circuitbreaker import clear_stale
+from circuitbreaker import is_stale
+from circuitbreaker import mark_stale
+from ratelimit import RateLimit
+from tracing import span
+from utils import Error
+
+OPENSTREETMAP_URL = 'http://nominatim.openstreetmap.org/search'
+
+# Nominatim usage policy allows at most one request per second.
+NOMINATIM_QUERY_PER_SECONDS = 1
+
+# Connect and read timeouts of the HTTP requests, in seconds.
+DEFAULT_TIMEOUT = (3.05, 10)
+
+# Number of places resolved concurrently in bulk lookups. This is also the
+# size of the HTTP connection pool.
+DEFAULT_WORKERS = 4
+
+# Place types that can be sent as a structured query to Nominatim. Other types
+# fall back to a free form query.
+STRUCTURED_PLACE_TYPES = ('city', 'county', 'state', 'country', 'postalcode')
+
+# Status codes of the OpenStreetMap replies caused by the API itself, rather
+# than by the request: throttling and server errors.
+UPSTREAM_STATUS_CODES = (429,) + tuple(range(500, 600))
+
+# Number of resolved places kept in memory.
+CACHE_SIZE = 4096
+
+# Time, in seconds, after which a resolved place is resolved again. Expired
+# places are served as stale results during GEOCODING_STALE_TTL.
+GEOCODING_TTL = 24 * 3600
+GEOCODING_STALE_TTL = 30 * 24 * 3600
+
+# Optional gazetteer shipped next to the module. See GazetteerProvider for the
+# file format.
+DEFAULT_GAZETTEER_PATH = os.path.join(os.path.dirname(__file__),
+    'gazetteer.json')
+
+
+def is_upstream_failure(error):
+    """Returns whether an OpenStreetMap lookup failed because of the API.
+
+    Transport errors and invalid responses are, as well as the replies with
+    one of the UPSTREAM_STATUS_CODES. Other rejected requests are not.
+    """
+    return getattr(error, 'status', None) in (None,) + UPSTREAM_STATUS_CODES
+
+
+class GazetteerProvider:
+    """Offline provider, answering places from a local gazetteer file.
+
+    The gazetteer is a JSON list of entries such as:
+        {"name": "Pau", "type": "city", "geojson": {...}}
+    The type is optional. Names are matched case insensitively.
+    """
+
+    def __init__(self, entries):
+        """Constructor. Indexes the gazetteer entries.
+
+        Parameters:
+            entries: list of gazetteer entries.
+        """
+        self.places = {}
+        for entry in entries:
+            name = entry['name'].strip().lower()
+            place_type = entry.get('type')
+            self.places[(name, place_type)] = entry['geojson']
+            self.places.setdefault((name, None), entry['geojson'])
+
+    @classmethod
+    def from_file(cls, path):
+        """Loads a gazetteer from a JSON file.
+
+        Parameters:
+            path: path of the gazetteer file.
+        Returns:
+            The GazetteerProvider answering the gazetteer places.
+        """
+        with open(path) as gazetteer:
+            return cls(json.load(gazetteer))
+
+    def lookup(self, place_name, place_type=None):
+        """Converts a place name to a GeoJSON geometry.
+
+        Parameters:
+            place_name: name of the place.
+            place_type: type of the place (city, country...).
+        Returns:
+            The GeoJSON geometry of the place, or None if the place is unknown.
+        """
+        return self.places.get((place_name.strip().lower(), place_type))
+
+
+class NominatimProvider:
+    """Online provider, answering places from the OpenStreetMap database."""
+
+    def __init__(self, url=OPENSTREETMAP_URL, timeout=DEFAULT_TIMEOUT,
+            pool_size=DEFAULT_WORKERS,
+            query_per_seconds=NOMINATIM_QUERY_PER_SECONDS):
+        """Constructor. Initializes the HTTP session and the rate limit.
+
+        Parameters:
+            url: URL of the Nominatim search API.
+            timeout: connect and read timeouts of the requests, in seconds.
+            pool_size: maximum number of connections kept alive.
+            query_per_seconds: number of query per seconds on the API.
+        """
+        self.url = url
+        self.timeout = timeout
+        self.rate_limiter = RateLimit(query_per_seconds, 1)
+        self.breaker = CircuitBreaker('OpenStreetMap',
+            failures=(requests.RequestException, Error),
+            is_failure=is_upstream_failure)
+
+        # Keep connections alive instead of opening a new one on each lookup.
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+        self.session.headers['User-Agent'] = 'EnvironmentalDisasterGoggles'
+
+    def lookup(self, place_name, place_type=None):
+        """Converts a place name to a GeoJSON geometry.
+
+        Parameters:
+            place_name: name of the place.
+            place_type: type of the place (city, country...).
+        Returns:
+            The GeoJSON geometry of the place.
+        Raises:
+            Error: if the API is unreachable or does not know the place.
+            CircuitOpen: if the API failed too many times recently.
+        """
+        params = {
+            'format': 'json',
+            'polygon_geojson': 1,
+            'limit': 1,
+        }
+
+        if place_type in STRUCTURED_PLACE_TYPES:
+            params[place_type] = place_name
+        else:
+            params['q'] = place_name
+
+        # Unknown places are not failures of the API, so only the request
+        # itself is watched by the breaker.
+        with self.breaker:
+            # Only the request emission is throttled, so concurrent lookups
+            # still wait for their responses in parallel.
+            with self.rate_limiter:
+                self.rate_limiter.add_request()
+
+            try:
+                result = self.session.get(self.url, params=params,
+                    timeout=self.timeout)
+            except requests.RequestException as e:
+                raise Error('Unable to reach OpenStreetMap: %s' % e, 500)
+
+            if not result.ok:
+                error = Error('Unable to fetch city name. OpenStreetMap status '
+                    'code: %s' % result.status_code, 500)
+                error.status = result.status_code
+                raise error
+
+            try:
+                result_json = result.json()
+            except ValueError:
+                raise Error('Invalid response from OpenStreetMap', 500)
+
+        if len(result_json) == 0:
+            raise Error('Empty result received from the OpenStreetMap.', 500)
+
+        return result_json[0].get("geojson", [])
+
+
+class Geocoder:
+    """Resolves place names using a chain of providers."""
+
+    def __init__(self, providers=None, workers=DEFAULT_WORKERS,
+            ttl=GEOCODING_TTL, stale_ttl=GEOCODING_STALE_TTL):
+        """Constructor.
+
+        Parameters:
+            providers: providers to query, in order. Defaults to the local
+                gazetteer (if any) followed by Nominatim.
+            workers: number of places resolved concurrently in bulk lookups.
+            ttl: time, in seconds, after which a place is resolved again.
+            stale_ttl: time, in seconds, during which expired places are
+                served while being resolved again.
+        """
+        if providers is None:
+            providers = []
+            if os.path.exists(DEFAULT_GAZETTEER_PATH):
+                providers.append(
+                    GazetteerProvider.from_file(DEFAULT_GAZETTEER_PATH))
+            providers.append(NominatimProvider(pool_size=workers))
+
+        self.providers = providers
+        self.workers = workers
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.cache = LRUCache(CACHE_SIZE)
+        self.revalidating = set()
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def _get_pool(self):
+        """Returns the workers of the bulk lookups, started on first use."""
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+            return self.pool
+
+    def close(self):
+        """Stops the workers of the bulk lookups."""
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def resolve(self, place_name, place_type=None):
+        """Converts a place name to a GeoJSON geometry.
+
+        Expired places are answered from the cache and marked as stale,
+        while being resolved again in the background.
+
+        Parameters:
+            place_name: name of the place.
+            place_type: type of the place (city, country...).
+        Returns:
+            The GeoJSON geometry of the place.
+        Raises:
+            Error: if no provider knows the place.
+        """
+        key = (place_name.strip().lower(), place_type)
+        cached = self.cache.get(key)
+        if cached is not None:
+            geojson, resolved_at = cached
+            age = time.time() - resolved_at
+            if age < self.ttl:
+                return geojson
+            if age < self.stale_ttl:
+                mark_stale()
+                self._revalidate(key, place_name, place_type)
+                return geojson
+
+        geojson = self._lookup(place_name, place_type)
+        self.cache.put(key, (geojson, time.time()))
+        return geojson
+
+    def _revalidate(self, key, place_name, place_type):
+        """Resolves an expired place again, in the background."""
+        with self.lock:
+            if key in self.revalidating:
+                return
+            self.revalidating.add(key)
+
+        def revalidate():
+            """Refreshes the cached place."""
+            try:
+                self.cache.put(key, (self._lookup(place_name, place_type),
+                    time.time()))
+            except Error as e:
+                logging.warning("Unable to resolve %s again: %s", place_name,
+                    e.message)
+            finally:
+                with self.lock:
+                    self.revalidating.discard(key)
+
+        thread = threading.Thread(target=revalidate)
+        thread.daemon = True
+        thread.start()
+
+    def _lookup(self, place_name, place_type):
+        """Queries the providers for a place. See :meth:`resolve`."""
+        with span('geocoding', place=place_name) as current:
+            for provider in self.providers:
+                geojson = provider.lookup(place_name, place_type)
+                if geojson is not None:
+                    current.set('provider', type(provider).__name__)
+                    return geojson
+
+        raise Error("Unknown place: '%s'." % place_name, 500)
+
+    def resolve_many(self, place_names, place_type=None):
+        """Converts several place names to GeoJSON geometries concurrently.
+
+        Parameters:
+            place_names: list of place names.
+            place_type: type of the places (city, country...).
+        Returns:
+            The list of GeoJSON geometries, in the same order as the names.
+        Raises:
+            Error: if a place cannot be resolved.
+        """
+        if len(place_names) <= 1:
+            return [self.resolve(name, place_type) for name in place_names]
+
+        def resolve(name):
+            """Resolves a place, telling whether it is stale."""
+            clear_stale()
+            return self.resolve(name, place_type), is_stale()
+
+        # Worker threads are not traced, so the whole lookup is measured here.
+        with span('geocoding.bulk', places=len(place_names)):
+            results = self._get_pool().map(resolve, place_names)
+
+        if any(stale for _, stale in results):
+            mark_stale()
+        return [geojson for geojson, _ in results]
@@ -0,0 +1,255 @@
+#!/usr/bin/env python2
+
+"""Predictive prefetching of the images a client is likely to request next.
+
+Clients of the frontend usually follow a request with the neighbouring date
+windows, or pan to an adjacent area. After each request, the images of these
+neighbours are generated speculatively and indexed like any other image, so
+the next request is answered from the index instead of the Earth Engine.
+
+Generating an image only builds its graph and creates its link: the Earth
+Engine computes the pixels when the link is downloaded. Prefetched links are
+therefore downloaded once and discarded, so the pixels are computed, and
+cached by the Earth Engine, ahead of the client's download. The benefit is
+still limited to the time of these two steps, reported as saved_seconds.
+
+Prefetches run on the asynchronous fetcher workers, and are only started
+while the rate limit is idle: no request waits, and a slot is free. They then
+wait for their slot with the background priority of the rate limit (see
+:mod:`ratelimit`) and a short admission timeout, and are dropped otherwise.
+
+The --prefetch_level flag sets how aggressive prefetching is:
+    0: disabled;
+    1: previous and next date windows;
+    2: and the 4 adjacent areas;
+    3: and the 4 diagonal areas.
+
+The counters of :meth:`Prefetcher.stats` tell whether prefetching pays off:
+the hit rate is the share of the prefetched images later requested, and the
+saved time is the time spent prefetching the images later requested.
+"""
+
+import gflags
+import logging
+import requests
+import threading
+import time
+
+from datetime import datetime
+
+from cache import LRUCache
+from ratelimit import Overloaded
+from ratelimit import admission
+from ratelimit import current_admission
+
+FLAGS = gflags.FLAGS
+gflags.DEFINE_integer("prefetch_level", 0, "Neighbours of each request "
+    "prefetched: 0 for none, 1 for the previous and next date windows, 2 for "
+    "the adjacent areas too, 3 for the diagonal areas too.")
+
+# Time, in seconds, a prefetch accepts to wait for a slot of the rate limit.
+PREFETCH_TIMEOUT = 2
+
+# Maximal number of prefetches scheduled and not finished yet.
+DEFAULT_MAX_PENDING = 32
+
+# Number of prefetched images tracked to measure the hit rate.
+DEFAULT_TRACKED = 4096
+
+# Time, in seconds, after which the download of a prefetched image is aborted.
+DOWNLOAD_TIMEOUT = 60
+
+# Size, in bytes, of the chunks of the downloaded images.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+COUNTERS = ('scheduled', 'generated', 'skipped', 'dropped', 'failed', 'used')
+
+
+def neighbour_dates(date, delta, level=None):
+    """Computes the dates of the windows next to a request window.
+
+    Parameters:
+        date: middle date of the window.
+        delta: half length of the window.
+        level: aggressiveness of the prefetching. Defaults to
+            --prefetch_level.
+    Returns:
+        The middle dates of the previous and next windows, or an empty list
+        if they are not prefetched. Windows starting in the future are
+        skipped.
+    """
+    if level is None:
+        level = FLAGS.prefetch_level
+    if level < 1:
+        return []
+    return [middle for middle in (date - delta - delta, date + delta + delta)
+        if middle - delta <= datetime.now()]
+
+
+def neighbour_bounds(bounds, level=None):
+    """Computes the areas next to a request area.
+
+    Parameters:
+        bounds: (x_min, y_min, x_max, y_max) bounds of the area.
+        level: aggressiveness of the prefetching. Defaults to
+            --prefetch_level.
+    Returns:
+        The bounds of the adjacent (level 2) and diagonal (level 3) areas of
+        the same size, within the valid longitudes and latitudes.
+    """
+    if level is None:
+        level = FLAGS.prefetch_level
+    if level < 2:
+        return []
+
+    offsets = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+    if level >= 3:
+        offsets += [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+    x_min, y_min, x_max, y_max = bounds
+    width, height = x_max - x_min, y_max - y_min
+    neighbours = []
+    for dx, dy in offsets:
+        neighbour = (x_min + dx * width, y_min + dy * height,
+            x_max + dx * width, y_max + dy * height)
+        if (neighbour[0] >= -180 and neighbour[2] <= 180
+                and neighbour[1] >= -90 and neighbour[3] <= 90):
+            neighbours.append(neighbour)
+    return neighbours
+
+
+def download_image(href):
+    """Downloads an image and discards it, so that the Earth Engine computes
+    its pixels.
+
+    Parameters:
+        href: link of the image.
+    Raises:
+        IOError: if the download fails.
+    """
+    response = requests.get(href, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    try:
+        response.raise_for_status()
+        for _ in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            pass
+    finally:
+        response.close()
+
+
+class Prefetcher:
+    """Generates images speculatively, on the idle rate limit budget."""
+
+    def __init__(self, async_fetcher, rate_limiter=None,
+            max_pending=DEFAULT_MAX_PENDING, tracked=DEFAULT_TRACKED):
+        """Constructor.
+
+        Parameters:
+            async_fetcher: AsyncImageFetcher running the prefetches.
+            rate_limiter: FairRateLimit of the Earth Engine, prefetches only
+                starting while it is idle. Prefetches are not gated if None.
+            max_pending: maximal number of prefetches scheduled and not
+                finished. Further ones are dropped.
+            tracked: number of prefetched images tracked for the hit rate.
+        """
+        self.async_fetcher = async_fetcher
+        self.rate_limiter = rate_limiter
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.prefetched = LRUCache(tracked)
+        self.counters = dict((counter, 0) for counter in COUNTERS)
+        self.saved_seconds = 0.
+
+    def _count(self, counter):
+        """Increments a counter."""
+        with self.lock:
+            self.counters[counter] += 1
+
+    def prefetch(self, name, fetch):
+        """Schedules a prefetch, unless too many are pending.
+
+        Parameters:
+            name: hashable identifier of the image, so the same image is not
+                prefetched twice at once.
+            fetch: function generating the image unless it is indexed
+                already, and returning a tuple of its link and whether it was
+                indexed.
+        """
+        client = current_admission()[1]
+
+        def run():
+            """Generates the image with the background priority, and
+            downloads it."""
+            try:
+                if (self.rate_limiter is not None
+                        and not self.rate_limiter.idle()):
+                    raise Overloaded("Rate limit busy.")
+                with admission('background', client, PREFETCH_TIMEOUT):
+                    started = time.time()
+                    href, cached = fetch()
+                if not cached:
+                    self._download(name, href)
+            except Overloaded:
+                self._count('dropped')
+            except Exception as e:
+                logging.info("Prefetch of %s failed: %s", name,
+                    getattr(e, 'message', e))
+                self._count('failed')
+            else:
+                if cached:
+                    self._count('skipped')
+                else:
+                    self.prefetched.put(href, time.time() - started)
+                    self._count('generated')
+            finally:
+                with self.lock:
+                    self.pending.discard(name)
+
+        with self.lock:
+            if name in self.pending or len(self.pending) >= self.max_pending:
+                self.counters['dropped'] += 1
+                return
+            self.pending.add(name)
+            self.counters['scheduled'] += 1
+
+        try:
+            self.async_fetcher.submit(run)
+        except Overloaded:
+            with self.lock:
+                self.pending.discard(name)
+                self.counters['dropped'] += 1
+
+    def _download(self, name, href):
+        """Downloads a prefetched image. The link being generated already,
+        a failed download is only logged."""
+        try:
+            download_image(href)
+        except IOError as e:
+            logging.info("Download of the prefetched %s failed: %s", name, e)
+
+    def used(self, href):
+        """Records that a request was answered with an indexed image.
+
+        Parameters:
+            href: link of the image.
+        """
+        seconds = self.prefetched.pop(href)
+        if seconds is not None:
+            with self.lock:
+                self.counters['used'] += 1
+                self.saved_seconds += seconds
+
+    def stats(self):
+        """Returns the prefetching counters.
+
+        Returns:
+            A dictionary of the COUNTERS, the hit rate: the share of the
+            generated images later used, or None if none was generated, and
+            the saved_seconds spent prefetching the images later used.
+        """
+        with self.lock:
+            stats = dict(self.counters, saved_seconds=round(
+                self.saved_seconds, 3))
+        stats['hit_rate'] = (float(stats['used']) / stats['generated']
+            if stats['generated'] else None)
+        return stats
@@ -0,0 +1,166 @@
+#!/usr/bin/env python2
+
+"""Spatial index of the images previously generated.
+
+Generated images are indexed by product (e.g. rgb or forestDiff), by the
+parameters defining their pixels (dates, composite, format...), by scale and
+by the bounds of their rectangle. A request for an area fully covered by an
+image generated with the same parameters and a finer scale is then answered
+with that image instead of reaching the Earth Engine again. Images are only
+reused if they have at most MAX_REUSE_RATIO times the pixels of the request,
+so small requests are not answered with the link of a much larger image.
+
+Images are reused during a short time, but kept longer so that they can still
+be served, as stale results, while the Earth Engine is unavailable. Their
+links expire after LINK_LIFETIME seconds, so stale images are only served
+while their link is still valid. Links are downloaded from the Earth Engine
+as well: stale images help when images cannot be generated (quota, timeouts,
+server errors), not when the Earth Engine is down altogether.
+
+The index is persisted in a SQLite database, using its R*Tree module when
+available.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+# Time, in seconds, after which Earth Engine download links expire.
+LINK_LIFETIME = 3600
+
+# Time, in seconds, left to the clients to download the links served.
+DOWNLOAD_DELAY = 300
+
+# Time, in seconds, during which images are reused.
+DEFAULT_PRODUCT_TTL = LINK_LIFETIME // 2
+
+# Time, in seconds, during which images can be served as stale results.
+DEFAULT_STALE_TTL = LINK_LIFETIME - DOWNLOAD_DELAY
+
+# Maximal ratio between the pixels of a reused image and the pixels of the
+# request.
+MAX_REUSE_RATIO = 2.
+
+# Smallest area of a request, in square degrees, so the pixels of points are
+# still compared.
+MIN_AREA = 1e-12
+
+
+class ProductIndex:
+    """Persistent spatial index of the generated images."""
+
+    def __init__(self, path, ttl=DEFAULT_PRODUCT_TTL,
+            stale_ttl=DEFAULT_STALE_TTL):
+        """Constructor. Creates the database if it does not exist yet.
+
+        Parameters:
+            path: path of the SQLite database.
+            ttl: time, in seconds, during which generated images are reused.
+            stale_ttl: time, in seconds, during which generated images are
+                kept to be served as stale results.
+        Both are capped so that the links served are still valid for
+        DOWNLOAD_DELAY seconds.
+        """
+        self.path = path
+        self.ttl = min(ttl, LINK_LIFETIME - DOWNLOAD_DELAY)
+        self.stale_ttl = min(max(ttl, stale_ttl),
+            LINK_LIFETIME - DOWNLOAD_DELAY)
+        self.local = threading.local()
+
+        connection = self._connection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS products ('
+                'id INTEGER PRIMARY KEY, product TEXT, key TEXT, scale REAL, '
+                'href TEXT, image_geojson TEXT, created REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS products_key ON '
+                'products (product, key)')
+            connection.execute('CREATE INDEX IF NOT EXISTS products_created '
+                'ON products (created)')
+            try:
+                connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS bounds '
+                    'USING rtree(id, min_x, max_x, min_y, max_y)')
+            except sqlite3.OperationalError:
+                # SQLite was built without R*Tree. A plain table answers the
+                # same queries, only slower.
+                connection.execute('CREATE TABLE IF NOT EXISTS bounds ('
+                    'id INTEGER PRIMARY KEY, min_x REAL, max_x REAL, '
+                    'min_y REAL, max_y REAL)')
+
+    def _connection(self):
+        """Returns the database connection of the current thread."""
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = sqlite3.connect(self.path)
+        return self.local.connection
+
+    def find(self, product, key, bounds, scale, stale=False):
+        """Looks for a recent image covering an area.
+
+        Parameters:
+            product: name of the product.
+            key: parameters defining the pixels of the image.
+            bounds: (x_min, y_min, x_max, y_max) bounds of the area.
+            scale: requested resolution, in meters per pixels. Only images of
+                this scale or finer are returned.
+            stale: whether images older than the ttl, but kept as stale
+                results, are returned.
+        Returns:
+            A dictionary containing the href, scale and image_geojson of the
+            coarsest covering image, or None if there is none. Images having
+            more than MAX_REUSE_RATIO times the pixels of the area at the
+            requested scale are not returned.
+        """
+        x_min, y_min, x_max, y_max = bounds
+        # Pixels are proportional to the area divided by the squared scale.
+        pixels = max(MIN_AREA, (x_max - x_min) * (y_max - y_min)) / (
+            float(scale) * scale)
+        row = self._connection().execute('SELECT p.href, p.scale, '
+            'p.image_geojson FROM bounds b JOIN products p ON p.id = b.id '
+            'WHERE b.min_x <= ? AND b.max_x >= ? AND b.min_y <= ? AND '
+            'b.max_y >= ? AND p.product = ? AND p.key = ? AND p.scale <= ? '
+            'AND p.created >= ? AND (b.max_x - b.min_x) * (b.max_y - b.min_y) '
+            '/ (p.scale * p.scale) <= ? ORDER BY p.scale DESC LIMIT 1',
+            (x_min, x_max, y_min, y_max, product, key, scale,
+                time.time() - (self.stale_ttl if stale else self.ttl),
+                pixels * MAX_REUSE_RATIO)).fetchone()
+
+        if row is None:
+            return None
+        return {
+            'href': row[0],
+            'scale': row[1],
+            'image_geojson': json.loads(row[2]),
+        }
+
+    def add(self, product, key, bounds, scale, href, image_geojson):
+        """Indexes a generated image.
+
+        Parameters:
+            product: name of the product.
+            key: parameters defining the pixels of the image.
+            bounds: (x_min, y_min, x_max, y_max) bounds of the image.
+            scale: resolution of the image, in meters per pixels.
+            href: link to download the image.
+            image_geojson: GeoJSON geometry of the image.
+        """
+        x_min, y_min, x_max, y_max = bounds
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute('INSERT INTO products (product, key, '
+                'scale, href, image_geojson, created) VALUES (?, ?, ?, ?, ?, '
+                '?)', (product, key, scale, href, json.dumps(image_geojson),
+                    time.time()))
+            connection.execute('INSERT INTO bounds VALUES (?, ?, ?, ?, ?)',
+                (cursor.lastrowid, x_min, x_max, y_min, y_max))
+
+        self.expire()
+
+    def expire(self):
+        """Removes the images too old to be served, even as stale results."""
+        oldest = time.time() - self.stale_ttl
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM bounds WHERE id IN (SELECT id '
+                'FROM products WHERE created < ?)', (oldest,))
+            connection.execute('DELETE FROM products WHERE created < ?',
+                (oldest,))
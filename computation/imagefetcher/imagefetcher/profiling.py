@@ -0,0 +1,262 @@
+#!/usr/bin/env python2
+
+"""Request profiling, showing where the Python time of a request goes.
+
+A request is profiled from the start of its handling to its response, which
+covers the parameters parsing (get_params), the geometry resolution
+(get_geometry) and the fetcher methods. Asynchronous jobs run on other
+threads, and are not covered.
+
+Two kinds of profiles are written:
+    - pstats: the deterministic cProfile statistics, read with the pstats
+      module or tools like snakeviz;
+    - collapsed: the time spent in each call stack, one stack per line, as
+      expected by flame graph tools (e.g. flamegraph.pl).
+
+Requests are profiled on demand, by callers sending the 'profile' parameter
+(or the X-Profile header) along with the X-Profile-Token header matching
+--profile_token. A fraction of the traffic can also be sampled with
+--profile_sample_rate. Profiles are kept in the profiles directory of the
+store, only the --profile_keep latest ones being kept.
+
+Profiling costs nothing but a flag check when no profile is requested.
+"""
+
+import cProfile
+import gflags
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import timeit
+
+from collections import defaultdict
+
+from utils import Error
+
+FLAGS = gflags.FLAGS
+gflags.DEFINE_string("profile_token", "", "Token of the X-Profile-Token "
+    "header allowing callers to profile their requests. On demand profiling "
+    "is disabled if empty.")
+gflags.DEFINE_float("profile_sample_rate", 0, "Fraction of the requests "
+    "profiled, from 0 to 1.")
+gflags.DEFINE_enum("profile_format", "pstats", ["pstats", "collapsed"],
+    "Format of the sampled profiles.")
+gflags.DEFINE_integer("profile_keep", 200, "Number of profiles kept, older "
+    "ones being removed.")
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN_HEADER = 'X-Profile-Token'
+
+# Sub directory of the store containing the profiles.
+PROFILES_STORE = 'profiles'
+
+# Values of the profile parameter, associated to the profile format.
+PROFILE_MODES = {
+    '1': 'pstats',
+    'pstats': 'pstats',
+    'collapsed': 'collapsed',
+}
+
+# Extensions of the profile files.
+EXTENSIONS = {
+    'pstats': '.prof',
+    'collapsed': '.folded',
+}
+
+
+def requested_format(value, token):
+    """Checks an on demand profile request.
+
+    Parameters:
+        value: value of the profile parameter or header, or None.
+        token: value of the X-Profile-Token header, or None.
+    Returns:
+        The format of the requested profile, or None if none is requested.
+    Raises:
+        Error: if the token is invalid, or the format unknown.
+    """
+    if value is None:
+        return None
+
+    if not FLAGS.profile_token or token != FLAGS.profile_token:
+        raise Error("Profiling requires a valid %s header." %
+            PROFILE_TOKEN_HEADER, 403)
+    if value not in PROFILE_MODES:
+        raise Error("Profile must be one of %s." %
+            ", ".join(sorted(PROFILE_MODES)))
+    return PROFILE_MODES[value]
+
+
+def sampled_format():
+    """Decides whether the current request is sampled.
+
+    Returns:
+        The format of the sampled profile, or None if the request is not
+        sampled.
+    """
+    rate = FLAGS.profile_sample_rate
+    if rate > 0 and random.random() < rate:
+        return FLAGS.profile_format
+    return None
+
+
+def _frame_name(code):
+    """Returns the name of a Python function in the collapsed stacks."""
+    return '%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename),
+        code.co_firstlineno)
+
+
+def _builtin_name(function):
+    """Returns the name of a built-in function in the collapsed stacks."""
+    module = getattr(function, '__module__', None)
+    name = getattr(function, '__name__', repr(function))
+    return '%s.%s' % (module, name) if module else name
+
+
+class StackProfiler:
+    """Deterministic profiler measuring the time spent in each call stack.
+
+    Follows the interface of cProfile.Profile used by :class:`Profile`.
+    Stacks are relative to the frame enabling the profiler.
+    """
+
+    def __init__(self):
+        self.stack = []
+        self.times = defaultdict(float)
+        self.last = None
+
+    def _account(self):
+        """Adds the time elapsed since the last event to the current stack."""
+        now = timeit.default_timer()
+        if self.stack:
+            self.times[tuple(self.stack)] += now - self.last
+        self.last = now
+
+    def _event(self, frame, event, arg):
+        """Profile function, called on each call and return."""
+        self._account()
+        if event == 'call':
+            self.stack.append(_frame_name(frame.f_code))
+        elif event == 'c_call':
+            self.stack.append(_builtin_name(arg))
+        elif self.stack:
+            # Returns of the frames entered before enabling are ignored.
+            self.stack.pop()
+
+    def enable(self):
+        """Starts profiling the current thread."""
+        self.last = timeit.default_timer()
+        sys.setprofile(self._event)
+
+    def disable(self):
+        """Stops profiling the current thread."""
+        sys.setprofile(None)
+        self._account()
+
+    def dump_stats(self, path):
+        """Writes the collapsed stacks, with their time in microseconds."""
+        with open(path, 'w') as output:
+            for stack, seconds in sorted(self.times.items()):
+                microseconds = int(seconds * 1e6)
+                if microseconds:
+                    output.write('%s %s\n' % (';'.join(stack), microseconds))
+
+
+class Profile:
+    """Profile of a request."""
+
+    def __init__(self, profile_format):
+        """Constructor.
+
+        Parameters:
+            profile_format: 'pstats' or 'collapsed'.
+        """
+        self.format = profile_format
+        if profile_format == 'collapsed':
+            self.profiler = StackProfiler()
+        else:
+            self.profiler = cProfile.Profile()
+
+    def start(self):
+        """Starts profiling the current thread."""
+        self.profiler.enable()
+
+    def stop(self):
+        """Stops profiling the current thread."""
+        self.profiler.disable()
+
+    def save(self, directory, name):
+        """Writes the profile to a directory.
+
+        Parameters:
+            directory: directory of the profiles.
+            name: name of the profile, without extension.
+        Returns:
+            The name of the written file.
+        """
+        filename = re.sub(r'[^\w.-]', '_', name) + EXTENSIONS[self.format]
+        fd, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        os.close(fd)
+        self.profiler.dump_stats(path)
+        os.rename(path, os.path.join(directory, filename))
+        return filename
+
+
+class ProfileStore:
+    """Rotating directory of profiles."""
+
+    def __init__(self, directory, keep=None):
+        """Constructor.
+
+        Parameters:
+            directory: directory of the profiles. Created if it does not
+                exist yet.
+            keep: number of profiles kept. Defaults to --profile_keep.
+        """
+        self.directory = directory
+        self._keep = keep
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @property
+    def keep(self):
+        """Number of profiles kept."""
+        return self._keep if self._keep is not None else FLAGS.profile_keep
+
+    def save(self, profile, label):
+        """Saves a profile, removing the oldest ones beyond the limit.
+
+        Parameters:
+            profile: stopped Profile.
+            label: description of the request, e.g. its route and
+                correlation ID.
+        Returns:
+            The name of the profile file.
+        """
+        name = profile.save(self.directory, '%s-%s' % (
+            time.strftime('%Y%m%d%H%M%S'), label))
+        self.rotate()
+        return name
+
+    def rotate(self):
+        """Removes the oldest profiles beyond the limit."""
+        paths = [os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if os.path.splitext(name)[1] in EXTENSIONS.values()]
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:max(0, len(paths) - self.keep)]:
+            try:
+                os.remove(path)
+            except OSError:
+                # Removed by a concurrent request.
+                pass
+
+    def path(self, name):
+        """Returns the path of a profile, or None if it does not exist."""
+        if os.path.splitext(name)[1] not in EXTENSIONS.values():
+            return None
+        path = os.path.join(self.directory, os.path.basename(name))
+        return path if os.path.isfile(path) else None
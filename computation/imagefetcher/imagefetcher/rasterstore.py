@@ -0,0 +1,306 @@
+#!/usr/bin/env python2
+
+"""Local store of downloaded rasters, read through memory maps.
+
+Rasters are persisted as uncompressed NumPy (NPY) files, next to a JSON
+document holding their georeference: the bounds of the image in degrees and
+the names of its bands. Rows go from north to south, and columns from west to
+east, as in the images downloaded from the Earth Engine.
+
+Files are opened as memory maps, so reading a window of a raster only loads
+the pages of the file covering that window. Crops, clusters and statistics
+over a small area of a large raster then cost as much as the area itself.
+
+Rasters are either 2D arrays with one field per band (the NPY format of the
+Earth Engine), or 2D arrays of a single band.
+"""
+
+import json
+import numpy
+import os
+import re
+import requests
+import shutil
+import tempfile
+import zipfile
+
+# Number of rows read at once when computing statistics, to bound the memory
+# used on large windows.
+STATISTICS_ROWS = 256
+
+# Connect and read timeouts of the raster downloads, in seconds.
+DOWNLOAD_TIMEOUT = (3.05, 120)
+
+
+class Raster:
+    """Georeferenced raster, memory mapped from the store."""
+
+    def __init__(self, array, bounds):
+        """Constructor.
+
+        Parameters:
+            array: 2D array of the pixels, usually a read-only memory map.
+            bounds: (x_min, y_min, x_max, y_max) bounds of the raster, in
+                degrees.
+        """
+        self.array = array
+        self.bounds = tuple(bounds)
+
+    @property
+    def bands(self):
+        """Names of the bands, or None if the raster has a single band."""
+        return self.array.dtype.names
+
+    @property
+    def pixel_size(self):
+        """(width, height) of a pixel, in degrees."""
+        x_min, y_min, x_max, y_max = self.bounds
+        rows, columns = self.array.shape[:2]
+        return (x_max - x_min) / columns, (y_max - y_min) / rows
+
+    def window(self, bounds):
+        """Computes the pixels covering an area.
+
+        Parameters:
+            bounds: (x_min, y_min, x_max, y_max) bounds of the area.
+        Returns:
+            A tuple of the rows slice and the columns slice of the pixels
+            intersecting the area. Slices are empty if the area is outside
+            of the raster.
+        """
+        x_min, y_min, x_max, y_max = bounds
+        width, height = self.pixel_size
+        rows, columns = self.array.shape[:2]
+
+        def clamp(value, limit):
+            """Restricts a pixel index to the raster."""
+            return max(0, min(limit, int(value)))
+
+        # Pixels partially covered by the area are included.
+        first_column = clamp(numpy.floor((x_min - self.bounds[0]) / width),
+            columns)
+        last_column = clamp(numpy.ceil((x_max - self.bounds[0]) / width),
+            columns)
+        first_row = clamp(numpy.floor((self.bounds[3] - y_max) / height),
+            rows)
+        last_row = clamp(numpy.ceil((self.bounds[3] - y_min) / height), rows)
+
+        return (slice(first_row, max(first_row, last_row)),
+            slice(first_column, max(first_column, last_column)))
+
+    def window_bounds(self, rows, columns):
+        """Returns the (x_min, y_min, x_max, y_max) bounds of a window."""
+        width, height = self.pixel_size
+        return (self.bounds[0] + columns.start * width,
+            self.bounds[3] - rows.stop * height,
+            self.bounds[0] + columns.stop * width,
+            self.bounds[3] - rows.start * height)
+
+    def read(self, bounds, band=None):
+        """Reads the pixels covering an area, without loading the others.
+
+        Parameters:
+            bounds: (x_min, y_min, x_max, y_max) bounds of the area.
+            band: name of the band to read. All bands are read if None.
+        Returns:
+            A tuple of the pixels, as a view on the memory map, and the
+            bounds of the pixels. These are larger than the area when it is
+            not aligned on pixels, and smaller when it exceeds the raster.
+        """
+        rows, columns = self.window(bounds)
+        array = self.array if band is None else self.array[band]
+        return array[rows, columns], self.window_bounds(rows, columns)
+
+    def crop(self, bounds):
+        """Extracts the area of the raster as a new raster.
+
+        Parameters:
+            bounds: (x_min, y_min, x_max, y_max) bounds of the area.
+        Returns:
+            The Raster of the area, loaded in memory.
+        """
+        array, bounds = self.read(bounds)
+        return Raster(numpy.array(array), bounds)
+
+    def statistics(self, bounds, band=None, nodata=None):
+        """Computes the statistics of a band over an area.
+
+        Rows are read by blocks, so the memory used does not depend on the
+        size of the area.
+
+        Parameters:
+            bounds: (x_min, y_min, x_max, y_max) bounds of the area.
+            band: name of the band. Required if the raster has several bands.
+            nodata: value of the pixels to ignore, in addition to NaNs.
+        Returns:
+            A dictionary containing the count, min, max and mean of the valid
+            pixels. Min, max and mean are None if there is no valid pixel.
+        """
+        if band is None and self.bands is not None:
+            raise ValueError("A band of %s must be given." %
+                ", ".join(self.bands))
+
+        array, _ = self.read(bounds, band)
+        count, total = 0, 0.
+        minimum, maximum = None, None
+
+        for row in range(0, array.shape[0], STATISTICS_ROWS):
+            block = numpy.asarray(array[row:row + STATISTICS_ROWS],
+                dtype=numpy.float64)
+            valid = ~numpy.isnan(block)
+            if nodata is not None:
+                valid &= block != nodata
+            values = block[valid]
+            if not values.size:
+                continue
+
+            count += values.size
+            total += values.sum()
+            minimum = values.min() if minimum is None else min(minimum,
+                values.min())
+            maximum = values.max() if maximum is None else max(maximum,
+                values.max())
+
+        return {
+            'count': count,
+            'min': None if minimum is None else float(minimum),
+            'max': None if maximum is None else float(maximum),
+            'mean': total / count if count else None,
+        }
+
+
+class RasterStore:
+    """Persists georeferenced rasters in a directory of the local disk."""
+
+    def __init__(self, directory):
+        """Constructor.
+
+        Parameters:
+            directory: directory containing the rasters. Created if it does
+                not exist yet.
+        """
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key, extension):
+        """Returns the path of a file of a raster."""
+        return os.path.join(self.directory,
+            re.sub(r'[^\w.-]', '_', key) + extension)
+
+    def _commit(self, key, path, bounds):
+        """Moves a complete NPY file to the store, with its georeference."""
+        os.rename(path, self._path(key, '.npy'))
+
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as temporary:
+            json.dump({'bounds': list(bounds)}, temporary)
+        os.rename(path, self._path(key, '.json'))
+
+    def put(self, key, array, bounds):
+        """Saves a raster, replacing the previous one.
+
+        Parameters:
+            key: name of the raster.
+            array: 2D array of the pixels.
+            bounds: (x_min, y_min, x_max, y_max) bounds of the raster, in
+                degrees.
+        Returns:
+            The stored Raster.
+        """
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        output = numpy.lib.format.open_memmap(path, mode='w+',
+            dtype=array.dtype, shape=array.shape)
+        output[:] = array
+        output.flush()
+        del output
+
+        self._commit(key, path, bounds)
+        return self.open(key)
+
+    def fetch(self, key, url, bounds, session=requests):
+        """Downloads an Earth Engine NPY image to the store.
+
+        The image is streamed to the disk, so it is never entirely loaded in
+        memory.
+
+        Parameters:
+            key: name of the raster.
+            url: download link of the image, in the NPY format.
+            bounds: (x_min, y_min, x_max, y_max) bounds of the image.
+            session: requests session used to download the image.
+        Returns:
+            The stored Raster.
+        Raises:
+            IOError: if the image cannot be downloaded.
+        """
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        temporaries = [path]
+        try:
+            with os.fdopen(fd, 'wb') as temporary:
+                response = session.get(url, stream=True,
+                    timeout=DOWNLOAD_TIMEOUT)
+                if not response.ok:
+                    raise IOError("Unable to download %s: status code %s." %
+                        (url, response.status_code))
+                for chunk in response.iter_content(1 << 20):
+                    temporary.write(chunk)
+
+            # Downloads are zipped unless requested otherwise.
+            if zipfile.is_zipfile(path):
+                with zipfile.ZipFile(path) as archive:
+                    names = [name for name in archive.namelist()
+                        if name.endswith('.npy')]
+                    if not names:
+                        raise IOError("No NPY file in the download of %s." %
+                            url)
+                    fd, path = tempfile.mkstemp(dir=self.directory,
+                        suffix='.tmp')
+                    temporaries.append(path)
+                    with os.fdopen(fd, 'wb') as output:
+                        with archive.open(names[0]) as source:
+                            shutil.copyfileobj(source, output)
+
+            self._commit(key, path, bounds)
+        finally:
+            # The committed file was moved, only the others remain.
+            for temporary in temporaries:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+
+        return self.open(key)
+
+    def open(self, key):
+        """Opens a raster without loading its pixels.
+
+        Parameters:
+            key: name of the raster.
+        Returns:
+            The Raster, or None if it does not exist.
+        """
+        try:
+            with open(self._path(key, '.json')) as document:
+                bounds = json.load(document)['bounds']
+            array = numpy.load(self._path(key, '.npy'), mmap_mode='r')
+        except IOError:
+            return None
+
+        return Raster(array, bounds)
+
+    def delete(self, key):
+        """Removes a raster, if it exists.
+
+        Parameters:
+            key: name of the raster.
+        """
+        for extension in ('.json', '.npy'):
+            try:
+                os.remove(self._path(key, extension))
+            except OSError:
+                pass
+
+    def keys(self):
+        """Returns the names of the stored rasters."""
+        return sorted(name[:-len('.json')]
+            for name in os.listdir(self.directory) if name.endswith('.json'))
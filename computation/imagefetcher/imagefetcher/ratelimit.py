@@ -0,0 +1,303 @@
+#!/usr/bin/env python2
+
+"""Rate limiting utilities, used to throttle requests sent to upstreams."""
+
+import itertools
+import time
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+
+from tracing import span
+from utils import Error
+
+# Priority classes of the requests, from the most to the least urgent.
+PRIORITIES = ('interactive', 'batch', 'background')
+
+# Share of the rate limit given to each class when all of them are waiting.
+PRIORITY_WEIGHTS = {
+    'interactive': 8,
+    'batch': 2,
+    'background': 1,
+}
+
+# Maximal number of requests of each class running at the same time.
+PRIORITY_CONCURRENCY = {
+    'interactive': 8,
+    'batch': 2,
+    'background': 1,
+}
+
+# Time, in seconds, a request of each class accepts to wait for a slot.
+PRIORITY_TIMEOUTS = {
+    'interactive': 30,
+    'batch': 300,
+    'background': 600,
+}
+
+# Number of flows (class and client) whose finish tag is remembered at most.
+MAX_FLOWS = 10000
+
+# Admission parameters of the request handled by the current thread.
+_admission = threading.local()
+
+
+class RateLimit:
+    """Implementation of a rate limiter.
+
+    This class is highly inspired from the Riot Watcher project, with some
+    cool functionalities added.
+    """
+
+    def __init__(self, allowed_requests, seconds):
+        """Constructor.
+
+        Parameters:
+            allowed_requests: number of allowed requests during the time frame.
+            seconds: time frame, in seconds.
+        """
+        self.allowed_requests = allowed_requests
+        self.seconds = seconds
+        self.made_requests = deque()
+        self.lock = threading.Lock()
+
+    def _reload(self):
+        """Remove old requests."""
+        t = time.time()
+        while len(self.made_requests) > 0 and self.made_requests[0] < t:
+            self.made_requests.popleft()
+
+    def add_request(self):
+        """Add a request to the counter."""
+        self.made_requests.append(time.time() + self.seconds)
+
+    def requests_available(self):
+        """Check if a request is available.
+
+        Returns:
+            False if the rate limit is reached.
+        """
+        self._reload()
+        return len(self.made_requests) < self.allowed_requests
+
+    def __enter__(self):
+        """Context management: blocking requests in a threaded context."""
+        with span('rate_limit.wait'):
+            self.lock.acquire()
+            while not self.requests_available():
+                time.sleep(0.1)
+
+    def __exit__(self, *args):
+        """Context management: release the lock in threaded context."""
+        self.lock.release()
+
+
+class Overloaded(Error):
+    """Exception raised when a request cannot be admitted before its
+    deadline."""
+
+    def __init__(self, message):
+        Error.__init__(self, message, 503)
+
+
+def set_admission(priority='interactive', client=None, timeout=None):
+    """Sets the admission parameters of the current thread's requests.
+
+    Parameters:
+        priority: one of the PRIORITIES.
+        client: identifier of the client, requests of different clients of a
+            same class being served fairly.
+        timeout: time, in seconds, the request accepts to wait for a slot.
+            Defaults to the PRIORITY_TIMEOUTS of the class.
+    """
+    if priority not in PRIORITIES:
+        raise Error("Priority must be one of %s." % ", ".join(PRIORITIES))
+
+    _admission.priority = priority
+    _admission.client = client
+    _admission.timeout = timeout
+
+
+def clear_admission():
+    """Resets the admission parameters of the current thread."""
+    set_admission()
+
+
+@contextmanager
+def admission(priority='interactive', client=None, timeout=None):
+    """Context manager setting the admission parameters of the current
+    thread's requests. See :func:`set_admission`."""
+    previous = current_admission()
+    set_admission(priority, client, timeout)
+    try:
+        yield
+    finally:
+        set_admission(*previous)
+
+
+def current_admission():
+    """Returns the (priority, client, timeout) of the current thread."""
+    return (getattr(_admission, 'priority', 'interactive'),
+        getattr(_admission, 'client', None),
+        getattr(_admission, 'timeout', None))
+
+
+class FairRateLimit:
+    """Rate limiter sharing its requests fairly within priority classes.
+
+    Waiting requests are served by start-time fair queuing: each (class,
+    client) pair is a flow, and flows get a share of the rate limit
+    proportional to the PRIORITY_WEIGHTS of their class. Each class also
+    has a maximal number of running requests, so a bulk of batch requests
+    cannot hold all slots.
+
+    Requests which would wait longer than their timeout are rejected early
+    with an Overloaded error instead of waiting.
+
+    When used as a context manager, the admission parameters are read from
+    the current thread (see :func:`set_admission`).
+    """
+
+    def __init__(self, allowed_requests, seconds, weights=PRIORITY_WEIGHTS,
+            concurrency=PRIORITY_CONCURRENCY, timeouts=PRIORITY_TIMEOUTS):
+        """Constructor.
+
+        Parameters:
+            allowed_requests: number of allowed requests during the time frame.
+            seconds: time frame, in seconds.
+            weights: share of the rate limit given to each class.
+            concurrency: maximal number of running requests of each class.
+            timeouts: default waiting timeout of each class, in seconds.
+        """
+        self.limit = RateLimit(allowed_requests, seconds)
+        self.weights = weights
+        self.concurrency = concurrency
+        self.timeouts = timeouts
+
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.running = dict((priority, 0) for priority in weights)
+        self.virtual_time = 0.
+        self.finish_tags = {}
+        self.sequence = itertools.count()
+        self.acquired = threading.local()
+
+    def _prune(self):
+        """Forgets the flows whose finish tag no longer delays them.
+
+        Tags not ahead of the virtual time are equivalent to no tag. Without
+        backlog, all flows start again from the latest tag. Clients are
+        chosen by the callers, so the flows are also bounded to MAX_FLOWS,
+        keeping the latest tags.
+        """
+        if not self.waiting:
+            if self.finish_tags:
+                self.virtual_time = max(self.virtual_time,
+                    max(self.finish_tags.values()))
+            self.finish_tags.clear()
+        elif len(self.finish_tags) > MAX_FLOWS:
+            latest = sorted(self.finish_tags.items(),
+                key=lambda item: item[1])[-(MAX_FLOWS // 2):]
+            self.finish_tags = dict((flow, tag) for flow, tag in latest
+                if tag > self.virtual_time)
+
+    def _eligible(self):
+        """Returns the waiting ticket to admit next, if any can be."""
+        candidates = [t for t in self.waiting
+            if self.running[t[2]] < self.concurrency[t[2]]]
+        return min(candidates) if candidates else None
+
+    def _estimated_wait(self, tag):
+        """Estimates the time before a ticket is admitted, in seconds."""
+        ahead = sum(1 for t in self.waiting if t[0] <= tag)
+        self.limit._reload()
+        if not self.limit.requests_available():
+            ahead += 1
+        return ahead * float(self.limit.seconds) / self.limit.allowed_requests
+
+    def _next_slot(self):
+        """Returns the time before the rate limit frees a request."""
+        self.limit._reload()
+        if self.limit.requests_available():
+            return 0
+        return max(0, self.limit.made_requests[0] - time.time())
+
+    def idle(self):
+        """Returns whether no request is waiting, and one would be let
+        through at once."""
+        with self.condition:
+            return not self.waiting and self._next_slot() == 0
+
+    def acquire(self, priority='interactive', client=None, timeout=None):
+        """Waits for a slot.
+
+        Parameters:
+            priority: one of the PRIORITIES.
+            client: identifier of the client.
+            timeout: time, in seconds, the request accepts to wait for a slot.
+        Raises:
+            Overloaded: if no slot is available before the timeout.
+        """
+        if timeout is None:
+            timeout = self.timeouts[priority]
+        deadline = time.time() + timeout
+
+        with self.condition:
+            flow = (priority, client)
+            start = max(self.virtual_time, self.finish_tags.get(flow, 0))
+            tag = start + 1. / self.weights[priority]
+
+            estimated = self._estimated_wait(tag)
+            if estimated > timeout:
+                raise Overloaded("Server overloaded: %s request would wait "
+                    "%.1f seconds." % (priority, estimated))
+
+            self.finish_tags[flow] = tag
+            ticket = (tag, next(self.sequence), priority)
+            self.waiting.append(ticket)
+
+            try:
+                while True:
+                    remaining = deadline - time.time()
+                    if self._eligible() == ticket:
+                        delay = self._next_slot()
+                        if delay == 0:
+                            break
+                    else:
+                        delay = remaining
+
+                    if remaining <= 0:
+                        raise Overloaded("Server overloaded: %s request "
+                            "waited %s seconds." % (priority, timeout))
+                    self.condition.wait(min(delay, remaining))
+            finally:
+                self.waiting.remove(ticket)
+                self._prune()
+                self.condition.notify_all()
+
+            self.virtual_time = max(self.virtual_time, start)
+            self.running[priority] += 1
+            self.limit.add_request()
+
+    def release(self, priority='interactive'):
+        """Frees the slot of a finished request.
+
+        Parameters:
+            priority: priority of the finished request.
+        """
+        with self.condition:
+            self.running[priority] -= 1
+            self.condition.notify_all()
+
+    def __enter__(self):
+        """Context management: waits for a slot, using the admission
+        parameters of the current thread."""
+        priority, client, timeout = current_admission()
+        with span('rate_limit.wait', priority=priority):
+            self.acquire(priority, client, timeout)
+        self.acquired.priority = priority
+
+    def __exit__(self, *args):
+        """Context management: frees the slot."""
+        self.release(self.acquired.priority)
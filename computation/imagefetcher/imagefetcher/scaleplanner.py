@@ -0,0 +1,161 @@
+#!/usr/bin/env python2
+
+"""Scale planner, choosing the resolution and tiling of the images.
+
+The scale of an image is chosen from the true (geodesic) size of its area, so
+that the image fits a budget of pixels and bytes, and the download limits of
+the Earth Engine. Areas too large to be downloaded at once at the requested
+scale are split into a grid of tiles, each fitting the limits.
+"""
+
+import math
+
+from collections import namedtuple
+
+from fetcher import RAW_FORMATS
+from utils import Error
+from utils import METERS_PER_DEGREE
+from utils import rectangle_bounds
+
+# Download limits of the Earth Engine: largest side of the pixel grid, and
+# size of the uncompressed image.
+MAX_GRID_DIMENSION = 10000
+MAX_DOWNLOAD_BYTES = 32 * 1024 * 1024
+
+# Budget of the automatically scaled images. About 2000x2000 pixels, which is
+# sharp enough for the clients while keeping the generation fast.
+DEFAULT_TARGET_PIXELS = 4 * 1000 * 1000
+DEFAULT_TARGET_BYTES = 16 * 1024 * 1024
+
+# Native resolution of Landsat, in meters per pixels. Finer scales only
+# interpolate pixels.
+MIN_SCALE = 30
+
+# Size, in bytes, of a raw band value. Raw bands are at most 32-bit.
+RAW_BAND_BYTES = 4
+
+ScalePlan = namedtuple('ScalePlan', ('scale', 'width', 'height', 'bytes',
+    'tiles'))
+ScalePlan.__doc__ = """Resolution and tiling of an image.
+
+    scale: resolution, in meters per pixels.
+    width, height: size of the whole image, in pixels.
+    bytes: uncompressed size of the whole image.
+    tiles: (x_min, y_min, x_max, y_max) bounds of the tiles to fetch. Only
+        contains the bounds of the area if it is fetched at once.
+"""
+
+
+def geodesic_dimensions(bounds):
+    """Computes the size of an area on the ground.
+
+    The width is measured on the parallel of the area closest to the equator,
+    where it is the widest.
+
+    Parameters:
+        bounds: (x_min, y_min, x_max, y_max) bounds of the area, in degrees.
+    Returns:
+        The (width, height) of the area, in meters.
+    """
+    x_min, y_min, x_max, y_max = bounds
+    if y_min <= 0 <= y_max:
+        widest = 0.
+    else:
+        widest = min(abs(y_min), abs(y_max))
+
+    width = (x_max - x_min) * METERS_PER_DEGREE * math.cos(
+        math.radians(widest))
+    height = (y_max - y_min) * METERS_PER_DEGREE
+    return abs(width), abs(height)
+
+
+def bytes_per_pixel(output_format, bands=3):
+    """Returns the uncompressed size of a pixel, in bytes.
+
+    Parameters:
+        output_format: one of the fetcher OUTPUT_FORMATS.
+        bands: number of bands of the raw image.
+    Returns:
+        The size of a pixel. Visualized formats are 8-bit RGB.
+    """
+    if output_format in RAW_FORMATS:
+        return RAW_BAND_BYTES * bands
+    return 3
+
+
+def _fits(width, height, pixel_bytes):
+    """Whether an image can be downloaded from the Earth Engine at once."""
+    return (max(width, height) <= MAX_GRID_DIMENSION
+        and width * height * pixel_bytes <= MAX_DOWNLOAD_BYTES)
+
+
+def plan_scale(bounds, scale=None, pixel_bytes=3,
+        target_pixels=DEFAULT_TARGET_PIXELS,
+        target_bytes=DEFAULT_TARGET_BYTES, min_scale=MIN_SCALE):
+    """Plans the resolution and tiling of an image.
+
+    Parameters:
+        bounds: (x_min, y_min, x_max, y_max) bounds of the area, in degrees.
+        scale: requested resolution, in meters per pixels. If None, the
+            finest scale fitting the targets and the download limits is
+            chosen, not finer than min_scale.
+        pixel_bytes: uncompressed size of a pixel, see
+            :func:`bytes_per_pixel`.
+        target_pixels: maximal number of pixels of automatically scaled
+            images.
+        target_bytes: maximal uncompressed size of automatically scaled
+            images.
+        min_scale: finest automatic scale.
+    Returns:
+        The ScalePlan of the image. Images not fitting the download limits at
+        the requested scale are split in tiles.
+    Raises:
+        Error: if the scale is not positive.
+    """
+    if scale is not None and scale <= 0:
+        raise Error("Scale must be positive.")
+
+    width, height = geodesic_dimensions(bounds)
+    area = max(width * height, 1.)
+
+    if scale is None:
+        pixels = min(target_pixels, float(target_bytes) / pixel_bytes,
+            float(MAX_DOWNLOAD_BYTES) / pixel_bytes)
+        scale = max(min_scale, math.sqrt(area / pixels),
+            max(width, height) / MAX_GRID_DIMENSION)
+        scale = int(math.ceil(scale))
+
+    columns = max(1, int(math.ceil(width / scale)))
+    rows = max(1, int(math.ceil(height / scale)))
+    plan = ScalePlan(scale, columns, rows, columns * rows * pixel_bytes,
+        [tuple(bounds)])
+    if _fits(columns, rows, pixel_bytes):
+        return plan
+
+    # Largest square tile fitting the limits, then as many tiles as needed
+    # along each axis.
+    side = min(MAX_GRID_DIMENSION,
+        int(math.sqrt(MAX_DOWNLOAD_BYTES / pixel_bytes)))
+    tile_columns = int(math.ceil(float(columns) / side))
+    tile_rows = int(math.ceil(float(rows) / side))
+
+    x_min, y_min, x_max, y_max = bounds
+    tile_width = float(x_max - x_min) / tile_columns
+    tile_height = float(y_max - y_min) / tile_rows
+    tiles = [(x_min + column * tile_width, y_max - (row + 1) * tile_height,
+            x_min + (column + 1) * tile_width, y_max - row * tile_height)
+        for row in range(tile_rows) for column in range(tile_columns)]
+
+    return plan._replace(tiles=tiles)
+
+
+def scale_from_geometry(rectangle, pixel_bytes=3):
+    """Computes the finest scale fitting the default budget of an image.
+
+    Parameters:
+        rectangle: Rectangle generated from the client query.
+        pixel_bytes: uncompressed size of a pixel.
+    Returns:
+        The scale, in meters per pixels. See :func:`plan_scale`.
+    """
+    return plan_scale(rectangle_bounds(rectangle), None, pixel_bytes).scale
@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+
+"""Local store of precomputed results.
+
+Results are JSON documents persisted on the local disk, one file per key, so
+that the API can serve them without reaching the Earth Engine.
+"""
+
+import gflags
+import json
+import os
+import re
+import tempfile
+
+FLAGS = gflags.FLAGS
+gflags.DEFINE_string("store_dir", "store", "Directory where precomputed "
+    "results are persisted.")
+
+
+class ResultStore:
+    """Persists JSON documents in a directory of the local disk."""
+
+    def __init__(self, directory):
+        """Constructor.
+
+        Parameters:
+            directory: directory containing the documents. Created if it does
+                not exist yet.
+        """
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        """Returns the path of the file containing a document."""
+        return os.path.join(self.directory,
+            re.sub(r'[^\w.-]', '_', key) + '.json')
+
+    def get(self, key, default=None):
+        """Loads a document.
+
+        Parameters:
+            key: name of the document.
+            default: value returned if the document does not exist.
+        Returns:
+            The document associated to the key.
+        """
+        try:
+            with open(self._path(key)) as document:
+                return json.load(document)
+        except IOError:
+            return default
+
+    def put(self, key, document):
+        """Saves a document, replacing the previous one atomically.
+
+        Parameters:
+            key: name of the document.
+            document: JSON serializable object to save.
+        """
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as temporary:
+            json.dump(document, temporary)
+        os.rename(path, self._path(key))
+
+    def keys(self):
+        """Returns the names of the stored documents."""
+        return sorted(name[:-len('.json')]
+            for name in os.listdir(self.directory) if name.endswith('.json'))
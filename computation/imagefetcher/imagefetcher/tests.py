@@ -1,21 +1,91 @@
+import ee
 import flask
 import gflags
 import json
 import mock
+import numpy
+import os
 import requests
+import shutil
+import tempfile
 import threading
 import time
 import unittest
+import zipfile
 
+from datetime import datetime
+from io import BytesIO
+from PIL import Image
+
+from dateutil.relativedelta import relativedelta
 from itertools import combinations
+from itertools import count
 
 import app
+from asyncfetcher import AsyncImageFetcher
+from circuitbreaker import CircuitBreaker
+from circuitbreaker import CircuitOpen
+from circuitbreaker import clear_stale
+from circuitbreaker import is_stale
+from circuitbreaker import mark_stale
+from changes import EventLog
+from changes import detect_changes
+from changes import label_clusters
+from costs import LAND_AREA
+from costs import OverBudget
+from costs import admit_reduction
+from costs import admit_request
+from costs import combine_estimates
+from costs import count_scenes
+from costs import estimate_cost
+from costs import estimate_reduction
+from expression import Expression
+from fetcher import EVI_DATASETS
+from fetcher import RGB_DATASETS
+from fetcher import is_upstream_failure
+from fetcher import plan_dataset
+from geocoder import GazetteerProvider
+from geocoder import Geocoder
+from geocoder import NominatimProvider
+from ratelimit import FairRateLimit
+from ratelimit import Overloaded
+from ratelimit import admission
+from ratelimit import current_admission
+from prefetch import Prefetcher
+from prefetch import neighbour_bounds
+from prefetch import neighbour_dates
+from productindex import LINK_LIFETIME
+from productindex import ProductIndex
+from profiling import Profile
+from profiling import ProfileStore
+from profiling import requested_format
+from rasterstore import RasterStore
+from scaleplanner import MAX_DOWNLOAD_BYTES
+from scaleplanner import MAX_GRID_DIMENSION
+from scaleplanner import geodesic_dimensions
+from scaleplanner import plan_scale
+from store import ResultStore
+from tiles import NATIVE_ZOOM
+from tiles import TilePyramid
+from tiles import tile_bounds
+from timelapse import MAX_FRAMES
+from timelapse import encode_gif
+from timelapse import fetch_frames
+from timelapse import frame_dates
+from timelapse import raster_frame
+from tracing import end_trace
+from tracing import span
+from tracing import start_trace
+from utils import Error
 from utils import Parser
+from watchlist import WatchlistRunner
+from watchlist import open_events
 
 FLAGS = gflags.FLAGS
 
 VALID_DATE = "2015-04-01"
 VALID_POLYGON = json.dumps([[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]])
+VALID_GEOJSON = {"type": "Polygon", "coordinates": [json.loads(VALID_POLYGON)]}
 
 @app.app.route('/shutdown')
 def shutdown():
@@ -54,10 +124,40 @@ class FlaskApplicationTest(unittest.TestCase):
         app.fetcher = cls._base_fetcher
 
     def setUp(self):
-        """Test setup. Defines a new mock in the fetcher."""
+        """Test setup. Defines a new mock in the fetcher, and an empty store."""
         self.fetcher = mock.MagicMock()
+        for method in ('VerticesToGeometry', 'CountryToGeometry',
+                'PlaceToGeometry', 'CityToGeometry', 'GeometryToRectangle'):
+            geometry = getattr(self.fetcher, method).return_value
+            geometry.toGeoJSON.return_value = VALID_GEOJSON
+        self.fetcher.BoundsToRectangle.side_effect = self.bounds_to_rectangle
+        for method in ('GetRGBImage', 'GetForestIndicesImage',
+                'GetIndexImage'):
+            getattr(self.fetcher, method).return_value = (
+                "http://something.com/foo")
         app.fetcher = self.fetcher
 
+        self.store_dir = tempfile.mkdtemp()
+        FLAGS.store_dir = self.store_dir
+        app.product_index = None
+        app.tile_pyramid = None
+        app.event_log = None
+        app.prefetcher = None
+
+    def tearDown(self):
+        """Removes the store."""
+        shutil.rmtree(self.store_dir)
+
+    @staticmethod
+    def bounds_to_rectangle(bounds):
+        """Mock of the fetcher BoundsToRectangle method."""
+        x_min, y_min, x_max, y_max = bounds
+        rectangle = mock.MagicMock()
+        rectangle.toGeoJSON.return_value = {"type": "Polygon", "coordinates": [
+            [[x_min, y_min], [x_max, y_min], [x_max, y_max], [x_min, y_max],
+                [x_min, y_min]]]}
+        return rectangle
+
     def do_request(self, route="/", params=None):
         """Sends the request to the server.
 
@@ -77,6 +177,15 @@ class FlaskApplicationTest(unittest.TestCase):
         response = self.do_request()
         self.assertEquals(response.status_code, 200)
 
+    def test_correlation_id(self):
+        """Test correlation IDs are echoed, or generated if missing."""
+        response = requests.get(self.base_url + "/",
+            headers={"X-Correlation-ID": "query-42"})
+        self.assertEqual(response.headers["X-Correlation-ID"], "query-42")
+
+        response = self.do_request()
+        self.assertTrue(response.headers["X-Correlation-ID"])
+
     def test_rgb_invalid_parameters(self):
         """Test if missing arguments are correctly handled."""
         required_args = {
@@ -160,6 +269,443 @@ class FlaskApplicationTest(unittest.TestCase):
             response.json().get("error", "[internal error]"))
         self.assertTrue(self.fetcher.GetRGBImage.called)
 
+    def test_rgb_post_query(self):
+        """Test parameters sent as a JSON body."""
+        self.fetcher.GetRGBImage.return_value = "http://something.com/foo"
+        polygon = [[i * 0.01, i % 2] for i in range(5000)] + [[0, 0]]
+        response = requests.post(self.base_url + "/rgb", json={
+            'date': VALID_DATE,
+            'polygon': polygon,
+        })
+        self.assertEqual(response.status_code, 200, "Server sent error: %s" %
+            response.json().get("error", "[internal error]"))
+        vertices = self.fetcher.VerticesToGeometry.call_args[0][0]
+        self.assertEqual(len(vertices.polygons[0][0]), 2 * len(polygon))
+
+    def test_rgb_priority(self):
+        """Test if priority classes are correctly handled."""
+        self.fetcher.GetRGBImage.return_value = "http://something.com/foo"
+        for priority in ('interactive', 'batch', 'background'):
+            response = self.do_request("/rgb", params={
+                'date': VALID_DATE,
+                'polygon': VALID_POLYGON,
+                'priority': priority,
+            })
+            self.assertEqual(response.status_code, 200, priority)
+
+        response = self.do_request("/rgb", params={
+            'date': VALID_DATE,
+            'polygon': VALID_POLYGON,
+            'priority': 'urgent',
+        })
+        self.assertEqual(response.status_code, 400)
+
+        # POST requests send the priority in their body.
+        response = requests.post(self.base_url + "/rgb", json={
+            'date': VALID_DATE,
+            'polygon': json.loads(VALID_POLYGON),
+            'priority': 'urgent',
+        })
+        self.assertEqual(response.status_code, 400)
+
+        # Requests rejected by the admission are not flagged stale by the
+        # previous request of their thread.
+        mark_stale()
+        response = app.app.test_client().get("/rgb", query_string={
+            'date': VALID_DATE, 'polygon': VALID_POLYGON,
+            'priority': 'urgent'})
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn("Warning", response.headers)
+        self.assertFalse(is_stale())
+
+    def test_rgb_reuses_images(self):
+        """Test images covering the requested area are reused."""
+        self.fetcher.GetRGBImage.return_value = "http://something.com/foo"
+        params = {'date': VALID_DATE, 'polygon': VALID_POLYGON, 'scale': 1000}
+
+        response = self.do_request("/rgb", params=params)
+        self.assertFalse(response.json()["cached"])
+        response = self.do_request("/rgb", params=params)
+        self.assertTrue(response.json()["cached"])
+        self.assertEqual(response.json()["href"], "http://something.com/foo")
+        self.assertEqual(self.fetcher.GetRGBImage.call_count, 1)
+
+        # A finer scale, or other dates, require a new image.
+        params['scale'] = 500
+        self.assertFalse(self.do_request("/rgb", params=params).json()["cached"])
+        params['date'] = "2016-01-01"
+        self.assertFalse(self.do_request("/rgb", params=params).json()["cached"])
+        self.assertEqual(self.fetcher.GetRGBImage.call_count, 3)
+
+    def test_rgb_scale_planning(self):
+        """Test scales are planned, and large images tiled."""
+        params = {'date': VALID_DATE, 'polygon': VALID_POLYGON}
+        response = self.do_request("/rgb", params=params)
+        self.assertEqual(response.json()["scale"], 557)
+        self.assertNotIn("tiles", response.json())
+
+        # 11132x11132 pixels do not fit in a single download.
+        params['scale'] = 100
+        response = self.do_request("/rgb", params=params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["href"],
+            response.json()["tiles"][0]["href"])
+        self.assertEqual(len(response.json()["tiles"]), 16)
+        self.assertEqual(self.fetcher.GetRGBImage.call_count, 17)
+        self.assertEqual(response.json()["tiles"][0]["image_geojson"],
+            self.bounds_to_rectangle((0, 7.5, 2.5, 10)).toGeoJSON())
+
+        response = self.do_request("/rgb", params=params)
+        self.assertTrue(response.json()["cached"])
+        self.assertEqual(self.fetcher.GetRGBImage.call_count, 17)
+
+    def test_forest_diff_tiles(self):
+        """Test forest change tiles are served from the pyramid."""
+        route = "/tiles/forestDiff/%s/%s/%s/%s/%s.png"
+        self.assertEqual(self.do_request(route % (2000, 1999, 3, 1, 1))
+            .status_code, 400)
+        self.assertEqual(self.do_request(route % (2000, 2010, 3, 8, 1))
+            .status_code, 404)
+
+        app.tile_pyramid = mock.MagicMock()
+        path = "%s/tile.png" % self.store_dir
+        Image.new("RGB", (256, 256), (255, 0, 0)).save(path)
+        app.tile_pyramid.get.return_value = path
+
+        response = self.do_request(route % (2000, 2010, 3, 1, 2))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "image/png")
+        app.tile_pyramid.get.assert_called_once_with(2000, 2010, 3, 1, 2)
+
+        FLAGS.tile_years = ["2000:2015"]
+        try:
+            self.assertEqual(self.do_request(route % (2000, 2010, 3, 1, 2))
+                .status_code, 404)
+        finally:
+            FLAGS.tile_years = []
+
+    def test_rgb_stale_while_unavailable(self):
+        """Test expired images are served while the Earth Engine is down."""
+        params = {'date': VALID_DATE, 'polygon': VALID_POLYGON, 'scale': 1000}
+        response = self.do_request("/rgb", params=params)
+        self.assertFalse(response.json()["stale"])
+        self.assertNotIn("Warning", response.headers)
+
+        app.get_product_index().ttl = -1
+        self.fetcher.GetRGBImage.side_effect = CircuitOpen("Earth Engine")
+        self.fetcher.breaker.available.return_value = False
+        response = self.do_request("/rgb", params=params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["stale"])
+        self.assertEqual(response.json()["href"], "http://something.com/foo")
+        self.assertEqual(response.headers["Warning"],
+            '110 - "Response is Stale"')
+
+        # Upstream errors are answered with stale images as well, but not
+        # the errors of the request.
+        self.fetcher.GetRGBImage.side_effect = ee.EEException(
+            "Computation timed out.")
+        self.assertTrue(self.do_request("/rgb", params=params).json()["stale"])
+        self.fetcher.GetRGBImage.side_effect = ee.EEException(
+            "Image.select: Pattern 'B12' did not match any bands.")
+        self.assertEqual(self.do_request("/rgb", params=params).status_code,
+            500)
+
+        # Without older image, the error is returned.
+        self.fetcher.GetRGBImage.side_effect = CircuitOpen("Earth Engine")
+        params['date'] = "2016-01-01"
+        self.assertEqual(self.do_request("/rgb", params=params).status_code,
+            503)
+
+    def test_rgb_async(self):
+        """Test asynchronous requests are polled until finished."""
+        response = self.do_request("/rgb", params={'date': VALID_DATE,
+            'polygon': VALID_POLYGON, 'async': 1})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["status"], "pending")
+        href = response.json()["href"]
+        self.assertEqual(response.headers["Location"], href)
+
+        for _ in range(50):
+            response = self.do_request(href)
+            if response.status_code != 202:
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["href"], "http://something.com/foo")
+
+        # Invalid requests are rejected before starting a job.
+        response = self.do_request("/rgb", params={'polygon': VALID_POLYGON,
+            'async': 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.do_request("/jobs/unknown").status_code, 404)
+
+    def test_watchlist_region(self):
+        """Test the links of the watched regions are generated on read."""
+        store = app.open_store()
+        store.put("congo", {"name": "congo", "start": 2000, "scale": 500,
+            "image_geojson": VALID_GEOJSON, "results": {
+                "2001": {"start": 2000, "stop": 2001, "stats": {}},
+                "2002": {"start": 2000, "stop": 2002, "stats": {}},
+            }})
+
+        with mock.patch("ee.Geometry") as geometry:
+            geometry.return_value.toGeoJSON.return_value = VALID_GEOJSON
+            response = self.do_request("/watchlist/congo")
+            self.assertEqual(response.status_code, 200)
+            results = response.json()["results"]
+            self.assertEqual(results["2002"]["href"],
+                "http://something.com/foo")
+            self.assertEqual(self.fetcher.GetForestIndicesImage.call_count, 2)
+
+            # Links are indexed until they expire.
+            self.do_request("/watchlist/congo")
+            self.assertEqual(self.fetcher.GetForestIndicesImage.call_count, 2)
+
+            self.fetcher.GetForestIndicesImage.side_effect = CircuitOpen(
+                "Earth Engine")
+            store.put("congo", dict(store.get("congo"), scale=100))
+            response = self.do_request("/watchlist/congo")
+            self.assertIsNone(response.json()["results"]["2001"]["href"])
+
+    def test_events(self):
+        """Test change events are read from a cursor."""
+        feature = {"type": "Feature", "geometry": VALID_GEOJSON,
+            "properties": {"change": "new"}}
+        open_events().append("congo", 2015, [feature, feature])
+        open_events().append("amazon", 2015, [feature])
+
+        response = self.do_request("/events", params={'limit': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["events"]), 2)
+        cursor = response.json()["cursor"]
+
+        response = self.do_request("/events", params={'since': cursor})
+        self.assertEqual([event["properties"]["region"]
+            for event in response.json()["events"]], ["amazon"])
+        response = self.do_request("/events", params={'region': 'congo',
+            'since': cursor})
+        self.assertEqual(response.json(), {"events": [], "cursor": cursor})
+
+        response = self.do_request("/events", params={'limit': 0})
+        self.assertEqual(response.status_code, 400)
+
+        # The log is opened once.
+        self.assertIs(app.get_event_log(), app.get_event_log())
+
+    def test_profiling(self):
+        """Test requests are profiled on demand, with a valid token."""
+        params = {'date': VALID_DATE, 'polygon': VALID_POLYGON,
+            'profile': 'collapsed'}
+        FLAGS.profile_token = "secret"
+        try:
+            response = self.do_request("/rgb", params=params)
+            self.assertEqual(response.status_code, 403)
+
+            response = requests.get(self.base_url + "/rgb", params=params,
+                headers={"X-Profile-Token": "secret"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["href"], "http://something.com/foo")
+            name = response.headers["X-Profile"]
+            self.assertTrue(name.endswith(".folded"))
+
+            self.assertEqual(self.do_request("/profiles/" + name).status_code,
+                403)
+            response = requests.get(self.base_url + "/profiles/" + name,
+                headers={"X-Profile-Token": "secret"})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("rgb_handler", response.text)
+            self.assertIn("get_geometry", response.text)
+        finally:
+            FLAGS.profile_token = ""
+
+        self.assertNotIn("X-Profile", self.do_request("/").headers)
+
+    def test_forest_ranking(self):
+        """Test regions are ranked in a single fetcher call."""
+        self.fetcher.GetForestChangeRanking.return_value = [
+            {"name": "Brazil", "loss_area": 2, "gain_area": 1}]
+        response = self.do_request("/forestRanking", params={
+            'countries': "brazil, atlantis", 'start': 2010, 'stop': 2015})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["regions"],
+            [{"name": "Brazil", "loss_area": 2, "gain_area": 1}])
+        self.assertEqual(response.json()["missing"], ["atlantis"])
+        self.assertEqual(self.fetcher.GetForestChangeRanking.call_args,
+            mock.call(2010, 2015, 1000, countries=["brazil", "atlantis"],
+                regions=[], sort_by="loss_area"))
+
+        self.fetcher.PlacesToGeometries.return_value = ["pau", "lyon"]
+        response = self.do_request("/forestRanking", params={
+            'countries': "all", 'places': "Pau,Lyon", 'sort': "gain_area"})
+        self.assertEqual(response.json()["missing"], [])
+        self.assertEqual(self.fetcher.GetForestChangeRanking.call_args[1],
+            {"countries": "all", "regions": [("Pau", "pau"), ("Lyon", "lyon")],
+                "sort_by": "gain_area"})
+        self.fetcher.PlacesToGeometries.assert_called_once_with(["Pau", "Lyon"])
+
+        self.assertEqual(self.do_request("/forestRanking").status_code, 400)
+        self.assertEqual(self.do_request("/forestRanking", params={
+            'countries': "brazil", 'sort': "area"}).status_code, 400)
+
+    def test_prefetching(self):
+        """Test neighbours are prefetched, and their use measured."""
+        urls = count()
+        self.fetcher.GetRGBImage.side_effect = lambda *args, **kwargs: (
+            "http://something.com/%s" % next(urls))
+        FLAGS.prefetch_level = 3
+        patcher = mock.patch("prefetch.download_image")
+        download = patcher.start()
+        try:
+            response = self.do_request("/rgb", params={'date': "2015-04-01",
+                'polygon': VALID_POLYGON, 'scale': 1000, 'delta': "0000-1-0"})
+            self.assertFalse(response.json()["cached"])
+
+            for _ in range(50):
+                stats = self.do_request("/prefetch").json()
+                if stats["generated"] + stats["failed"] == 10:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(stats["scheduled"], 10)
+            self.assertEqual(stats["generated"], 10)
+            self.assertEqual(self.fetcher.GetRGBImage.call_count, 11)
+            self.assertEqual(download.call_count, 10)
+
+            # The next window is prefetched.
+            FLAGS.prefetch_level = 0
+            response = self.do_request("/rgb", params={'date': "2015-06-01",
+                'polygon': VALID_POLYGON, 'scale': 1000, 'delta': "0000-1-0"})
+            self.assertTrue(response.json()["cached"])
+            stats = self.do_request("/prefetch").json()
+            self.assertEqual(stats["used"], 1)
+            self.assertEqual(stats["hit_rate"], 0.1)
+        finally:
+            patcher.stop()
+            FLAGS.prefetch_level = 0
+            app.get_async_fetcher().close()
+            app.async_fetcher = None
+
+    def test_timelapse(self):
+        """Test time-lapses are streamed as animated GIFs."""
+        frame = BytesIO()
+        Image.new("RGB", (8, 6), (40, 120, 60)).save(frame, "PNG")
+        self.fetcher.GetRGBFrame.return_value = "http://something.com/frame"
+        try:
+            with mock.patch("timelapse.requests") as frame_requests:
+                frame_requests.get.return_value.content = frame.getvalue()
+                response = self.do_request("/timelapse", params={
+                    'polygon': VALID_POLYGON, 'start': "2013-07-01",
+                    'stop': "2016-07-01", 'size': 8, 'duration': 200})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["Content-Type"], "image/gif")
+
+            animation = Image.open(BytesIO(response.content))
+            self.assertEqual(animation.n_frames, 4)
+            self.assertEqual(animation.info["duration"], 200)
+            windows = sorted(call[0][:2]
+                for call in self.fetcher.GetRGBFrame.call_args_list)
+            self.assertEqual(windows[0], (datetime(2013, 1, 1),
+                datetime(2014, 1, 1)))
+
+            # Errors on the first frame are reported in JSON, before the
+            # animation is streamed.
+            with mock.patch("timelapse.requests") as frame_requests:
+                frame_requests.get.return_value.content = b"<html></html>"
+                response = self.do_request("/timelapse", params={
+                    'polygon': VALID_POLYGON, 'start': "2013-07-01",
+                    'stop': "2016-07-01"})
+            self.assertEqual(response.status_code, 500)
+            self.assertEqual(response.json()["error"],
+                "Invalid frame received from the Earth Engine")
+
+            self.fetcher.GetRGBFrame.side_effect = CircuitOpen("Unavailable")
+            response = self.do_request("/timelapse", params={
+                'polygon': VALID_POLYGON, 'start': "2013-07-01",
+                'stop': "2016-07-01"})
+            self.assertEqual(response.status_code, 503)
+            self.assertIn("error", response.json())
+
+            self.assertEqual(self.do_request("/timelapse", params={
+                'polygon': VALID_POLYGON, 'start': "2013-07-01",
+                'stop': "2016-07-01", 'size': 4096}).status_code, 400)
+        finally:
+            app.get_async_fetcher().close()
+            app.async_fetcher = None
+
+    def test_dry_run(self):
+        """Test requests are estimated, and checked before the fetcher."""
+        params = {'date': "2015-04-01", 'polygon': VALID_POLYGON,
+            'scale': 10, 'dry_run': 1, 'async': 1}
+        response = self.do_request("/rgb", params=params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["dry_run"])
+        self.assertTrue(response.json()["adjusted"])
+        estimate = response.json()["estimate"]
+        self.assertEqual(response.json()["scale"], estimate["scale"])
+        self.assertTrue(estimate["scale"] > 10)
+        self.assertTrue(estimate["pixels"] <= FLAGS.max_request_pixels)
+        self.assertEqual(estimate["dataset"], "LANDSAT/LC8_L1T")
+        self.assertFalse(self.fetcher.GetRGBImage.called)
+
+        FLAGS.cost_policy = "reject"
+        try:
+            del params['dry_run'], params['async']
+            response = self.do_request("/rgb", params=params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("pixels", response.json()["error"])
+            self.assertEqual(response.json()["estimate"]["scale"], 10)
+            self.assertFalse(self.fetcher.GetRGBImage.called)
+        finally:
+            FLAGS.cost_policy = "adjust"
+
+        response = self.do_request("/forestDiff", params={
+            'polygon': VALID_POLYGON, 'start': 2010, 'stop': 2015,
+            'dry_run': 1})
+        self.assertEqual(response.json()["estimate"]["scenes"], 46)
+        self.assertFalse(self.fetcher.GetForestIndicesImage.called)
+
+        # Time-lapses sum the estimates of their frames.
+        response = self.do_request("/timelapse", params={
+            'polygon': VALID_POLYGON, 'start': "2013-07-01",
+            'stop': "2016-07-01", 'size': 100, 'dry_run': 1})
+        self.assertEqual(response.status_code, 200)
+        estimate = response.json()["estimate"]
+        self.assertEqual(estimate["pixels"], 4 * estimate["width"]
+            * estimate["height"])
+        self.assertFalse(self.fetcher.GetRGBFrame.called)
+        FLAGS.max_request_scenes = 10
+        try:
+            response = self.do_request("/timelapse", params={
+                'polygon': VALID_POLYGON, 'start': "2013-07-01",
+                'stop': "2016-07-01"})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("scenes", response.json()["error"])
+        finally:
+            FLAGS.max_request_scenes = 5000
+
+        # Rankings are estimated from the area of the regions.
+        response = self.do_request("/forestRanking", params={
+            'countries': "all", 'scale': 100, 'dry_run': 1})
+        self.assertTrue(response.json()["adjusted"])
+        self.assertTrue(response.json()["scale"] > 100)
+        self.assertTrue(response.json()["estimate"]["pixels"]
+            <= FLAGS.max_request_pixels)
+        self.assertFalse(self.fetcher.GetForestChangeRanking.called)
+
+    def test_invalid_scale(self):
+        """Test scales which are not positive are rejected."""
+        for scale in (0, -1):
+            for route, params in (
+                    ("/rgb", {'date': VALID_DATE}),
+                    ("/forestDiff", {'start': 2010, 'stop': 2015}),
+                    ("/index", {'expression': "median(landsat.B5, 2015)"})):
+                params = dict(params, polygon=VALID_POLYGON, scale=scale)
+                response = self.do_request(route, params=params)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()["error"],
+                    "Scale must be positive.")
+
     def test_rgb_date_delta_supported(self):
         """Test if date delta is fully supported."""
         date_parameters = [
@@ -180,6 +726,87 @@ class FlaskApplicationTest(unittest.TestCase):
                 response.json().get("error", "[internal error]"))
             self.assertTrue(self.fetcher.GetRGBImage.called)
 
+    def test_rgb_formats(self):
+        """Test if output formats are correctly handled."""
+        self.fetcher.GetRGBImage.return_value = "http://something.com/foo"
+        for output_format in ('png', 'jpg', 'thumb', 'geotiff', 'npy'):
+            response = self.do_request("/rgb", params={
+                'date': VALID_DATE,
+                'polygon': VALID_POLYGON,
+                'format': output_format,
+            })
+            self.assertEqual(response.status_code, 200, "Server sent error: %s"
+                % response.json().get("error", "[internal error]"))
+            self.assertEqual(response.json()["format"], output_format)
+
+        response = self.do_request("/rgb", params={
+            'date': VALID_DATE,
+            'polygon': VALID_POLYGON,
+            'format': 'bmp',
+        })
+        self.assertEqual(response.status_code, 400)
+
+    def test_rgb_composites(self):
+        """Test if composite parameters are correctly handled."""
+        self.fetcher.GetRGBImage.return_value = "http://something.com/foo"
+        response = self.do_request("/rgb", params={
+            'date': VALID_DATE,
+            'polygon': VALID_POLYGON,
+            'composite': 'best',
+            'cloud_cover': 10,
+            'scenes': 3,
+        })
+        self.assertEqual(response.status_code, 200, "Server sent error: %s" %
+            response.json().get("error", "[internal error]"))
+        kwargs = self.fetcher.GetRGBImage.call_args[1]
+        self.assertEqual(kwargs["composite"], "best")
+        self.assertEqual(kwargs["max_cloud_cover"], 10)
+        self.assertEqual(kwargs["scenes"], 3)
+
+        invalids = [
+            {'composite': 'mean'},
+            {'composite': 'cloudless', 'cloud_cover': 120},
+            {'composite': 'best', 'scenes': 0},
+        ]
+        for invalid in invalids:
+            params = {'date': VALID_DATE, 'polygon': VALID_POLYGON}
+            params.update(invalid)
+            response = self.do_request("/rgb", params=params)
+            self.assertEqual(response.status_code, 400, invalid)
+
+    def test_index_valid_query(self):
+        """Test a valid custom index query."""
+        self.fetcher.GetIndexImage.return_value = "http://foo.com/bar"
+        response = self.do_request("/index", params={
+            'expression': 'median((landsat.B5-landsat.B4)/'
+                '(landsat.B5+landsat.B4), 2015)',
+            'polygon': VALID_POLYGON,
+        })
+        self.assertEqual(response.status_code, 200, "Server sent error: %s" %
+            response.json().get("error", "[internal error]"))
+        self.assertTrue(self.fetcher.GetIndexImage.called)
+        self.assertEqual(response.json()["expression"], 'median(((landsat.B5 '
+            '- landsat.B4) / (landsat.B5 + landsat.B4)), "2015-01-01", '
+            '"2015-12-31")')
+
+    def test_index_invalid_expression(self):
+        """Test if invalid expressions are rejected."""
+        invalids = [
+            'landsat.B5',
+            '__import__("os").system("ls")',
+            'median(landsat.B5 + modis.EVI, 2015)',
+            'median(unknown.B5, 2015)',
+            'median(landsat.B5, 2015',
+        ]
+
+        for invalid in invalids:
+            response = self.do_request("/index", params={
+                'expression': invalid,
+                'polygon': VALID_POLYGON,
+            })
+            self.assertEqual(response.status_code, 400, invalid)
+            self.assertFalse(self.fetcher.GetIndexImage.called)
+
     def test_forest_diff_invalid_parameters(self):
         """Test if missing arguments are correctly handled."""
         required_args = {
@@ -268,6 +895,1391 @@ class FlaskApplicationTest(unittest.TestCase):
             response.json().get("error", "[internal error]"))
         self.assertTrue(self.fetcher.GetForestIndicesImage.called)
 
+    def test_forest_diff_formats(self):
+        """Test if output formats are correctly handled."""
+        self.fetcher.GetForestIndicesImage.return_value = "http://foo.com/bar"
+        response = self.do_request("/forestDiff", params={
+            'polygon': VALID_POLYGON,
+            'format': 'geotiff',
+        })
+        self.assertEqual(response.status_code, 200, "Server sent error: %s" %
+            response.json().get("error", "[internal error]"))
+        self.assertEqual(self.fetcher.GetForestIndicesImage.call_args[0][-1],
+            'geotiff')
+
+        response = self.do_request("/forestDiff", params={
+            'polygon': VALID_POLYGON,
+            'format': 'bmp',
+        })
+        self.assertEqual(response.status_code, 400)
+
+
+class GeocoderTest(unittest.TestCase):
+    """Test the geocoder resolves places through its providers."""
+
+    PAU = {"type": "Point", "coordinates": [-0.37, 43.3]}
+    CONGO = {"type": "Point", "coordinates": [15.8, -0.7]}
+
+    def test_gazetteer_lookup(self):
+        """Test the gazetteer matches names case insensitively."""
+        gazetteer = GazetteerProvider([
+            {"name": "Pau", "type": "city", "geojson": self.PAU},
+            {"name": "Congo", "geojson": self.CONGO},
+        ])
+        self.assertEqual(gazetteer.lookup("pau", "city"), self.PAU)
+        self.assertEqual(gazetteer.lookup(" PAU "), self.PAU)
+        self.assertEqual(gazetteer.lookup("congo"), self.CONGO)
+        self.assertIsNone(gazetteer.lookup("pau", "country"))
+        self.assertIsNone(gazetteer.lookup("paris"))
+
+    def test_nominatim_structured_query(self):
+        """Test typed places are sent as structured queries."""
+        provider = NominatimProvider()
+        provider.session = mock.MagicMock()
+        provider.session.get.return_value.json.return_value = [
+            {"geojson": self.PAU}]
+
+        self.assertEqual(provider.lookup("Pau", "city"), self.PAU)
+        params = provider.session.get.call_args[1]["params"]
+        self.assertEqual(params["city"], "Pau")
+        self.assertNotIn("q", params)
+        self.assertIsNotNone(provider.session.get.call_args[1]["timeout"])
+
+        provider.lookup("Pau")
+        params = provider.session.get.call_args[1]["params"]
+        self.assertEqual(params["q"], "Pau")
+
+    def test_nominatim_unreachable(self):
+        """Test network errors are reported as API errors."""
+        provider = NominatimProvider()
+        provider.session = mock.MagicMock()
+        provider.session.get.side_effect = requests.Timeout()
+        self.assertRaises(Error, provider.lookup, "Pau")
+
+    def test_provider_chain(self):
+        """Test providers are queried in order."""
+        online = mock.MagicMock()
+        online.lookup.return_value = self.CONGO
+        geocoder = Geocoder([
+            GazetteerProvider([{"name": "Pau", "geojson": self.PAU}]),
+            online,
+        ])
+
+        self.assertEqual(geocoder.resolve("Pau"), self.PAU)
+        self.assertFalse(online.lookup.called)
+        self.assertEqual(geocoder.resolve("Congo"), self.CONGO)
+        self.assertTrue(online.lookup.called)
+
+    def test_resolve_many(self):
+        """Test bulk lookups keep the order of the names."""
+        names = ["place %s" % i for i in range(20)]
+        provider = mock.MagicMock()
+        provider.lookup.side_effect = lambda name, place_type: {"name": name}
+        geocoder = Geocoder([provider])
+
+        try:
+            results = geocoder.resolve_many(names)
+            self.assertEqual([r["name"] for r in results], names)
+            # The workers are reused by the next lookups.
+            pool = geocoder.pool
+            geocoder.resolve_many(names[:2])
+            self.assertIs(geocoder.pool, pool)
+        finally:
+            geocoder.close()
+        self.assertIsNone(geocoder.pool)
+
+    def test_resolve_unknown(self):
+        """Test unknown places raise an error."""
+        geocoder = Geocoder([GazetteerProvider([])])
+        self.assertRaises(Error, geocoder.resolve, "Atlantis")
+
+    def test_stale_while_revalidate(self):
+        """Test expired places are served stale, and resolved again."""
+        provider = mock.MagicMock()
+        provider.lookup.return_value = self.PAU
+        geocoder = Geocoder([provider])
+
+        clear_stale()
+        self.assertEqual(geocoder.resolve("Pau"), self.PAU)
+        self.assertEqual(geocoder.resolve(" pau "), self.PAU)
+        self.assertEqual(provider.lookup.call_count, 1)
+        self.assertFalse(is_stale())
+
+        # The provider is down: the expired place is still served.
+        geocoder.ttl = -1
+        provider.lookup.side_effect = Error("Unavailable.", 503)
+        self.assertEqual(geocoder.resolve("Pau"), self.PAU)
+        self.assertTrue(is_stale())
+        clear_stale()
+
+        for _ in range(50):
+            if not geocoder.revalidating:
+                break
+            time.sleep(0.01)
+        self.assertEqual(provider.lookup.call_count, 2)
+
+        geocoder.stale_ttl = -1
+        self.assertRaises(Error, geocoder.resolve, "Pau")
+
+    def test_nominatim_circuit_breaker(self):
+        """Test failing lookups open the breaker, but unknown places do
+        not."""
+        provider = NominatimProvider(query_per_seconds=100)
+        provider.breaker._failure_threshold = 2
+        provider.breaker._reset_timeout = 60
+        provider.session = mock.MagicMock()
+        provider.session.get.return_value.json.return_value = []
+
+        for _ in range(3):
+            self.assertRaises(Error, provider.lookup, "Atlantis")
+        self.assertEqual(provider.breaker.state, "closed")
+
+        # Rejected requests are not failures of the API either.
+        provider.session.get.return_value.ok = False
+        provider.session.get.return_value.status_code = 400
+        for _ in range(3):
+            self.assertRaises(Error, provider.lookup, "Atlantis")
+        self.assertEqual(provider.breaker.state, "closed")
+
+        # Invalid responses are.
+        provider.session.get.return_value.ok = True
+        provider.session.get.return_value.json.side_effect = ValueError()
+        self.assertRaises(Error, provider.lookup, "Pau")
+        self.assertEqual(provider.breaker.consecutive_failures, 1)
+        provider.breaker.consecutive_failures = 0
+
+        provider.session.get.side_effect = requests.Timeout()
+        for _ in range(2):
+            self.assertRaises(Error, provider.lookup, "Pau")
+        self.assertRaises(CircuitOpen, provider.lookup, "Pau")
+        self.assertEqual(provider.session.get.call_count, 9)
+
+
+class ParserTest(unittest.TestCase):
+    """Test the request parameters parsers."""
+
+    SQUARE = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+    HOLE = [[2, 2], [4, 2], [4, 4], [2, 2]]
+    OTHER = [[20, 20], [30, 20], [30, -5], [20, 20]]
+
+    def test_names(self):
+        """Test lists of names are parsed from strings or JSON lists."""
+        self.assertEqual(Parser.names("brazil, peru,"), ["brazil", "peru"])
+        self.assertEqual(Parser.names(["brazil", " peru"]), ["brazil", "peru"])
+        with self.assertRaises(ValueError):
+            Parser.names(" , ")
+
+    def test_polygon(self):
+        """Test simple polygons are parsed to flat arrays."""
+        vertices = Parser.polygon(json.dumps(self.SQUARE))
+        self.assertEqual(vertices.type, 'Polygon')
+        self.assertEqual(list(vertices.polygons[0][0]),
+            [0, 0, 10, 0, 10, 10, 0, 10, 0, 0])
+        self.assertEqual(vertices.to_geojson()['coordinates'], [self.SQUARE])
+        self.assertEqual(vertices.bounds(), (0, 0, 10, 10))
+
+    def test_polygon_with_holes(self):
+        """Test polygons with holes are supported."""
+        vertices = Parser.polygon(json.dumps([self.SQUARE, self.HOLE]))
+        self.assertEqual(vertices.type, 'Polygon')
+        self.assertEqual(vertices.to_geojson()['coordinates'],
+            [self.SQUARE, self.HOLE])
+
+    def test_multipolygon(self):
+        """Test multipolygons are supported, including decoded JSON."""
+        vertices = Parser.polygon([[self.SQUARE, self.HOLE], [self.OTHER]])
+        self.assertEqual(vertices.type, 'MultiPolygon')
+        self.assertEqual(vertices.to_geojson()['coordinates'],
+            [[self.SQUARE, self.HOLE], [self.OTHER]])
+        self.assertEqual(vertices.bounds(), (0, -5, 30, 20))
+
+    def test_invalid_polygons(self):
+        """Test invalid polygons are rejected."""
+        invalids = [
+            "not json",
+            {"somekey": "somevalue"},
+            [],
+            [1, 2],
+            [[1, 2, 3], [1, 2], [1, 3]],
+            [["1", "2"], ["2", "3"]],
+            [[0, 0], [1, 1], [2, 0], [0, 1]],
+            [[0, 0], [1, 1], [0, 0]],
+            [self.SQUARE, [1, 2]],
+            [[[[[0, 0]]]]],
+            [[0, 0], [1, True], [2, 0], [0, 0]],
+            [[0, 0], [1, None], [2, 0], [0, 0]],
+        ]
+        for invalid in invalids:
+            if not isinstance(invalid, str):
+                invalid = json.dumps(invalid)
+            self.assertRaises(ValueError, Parser.polygon, invalid)
+
+
+class ExpressionTest(unittest.TestCase):
+    """Test the band-math expressions parser."""
+
+    def test_normalization(self):
+        """Test equivalent expressions share the same normalized text."""
+        self.assertEqual(
+            Expression("median(landsat.B5 - landsat.B4, 2015)").text,
+            Expression("median( (landsat.B5-landsat.B4) ,2015 )").text)
+        self.assertEqual(
+            Expression("change(modis.EVI, 2000, 2015)").text,
+            Expression("median(modis.EVI, 2015) - "
+                "median(modis.EVI, '2000-01-01', '2000-12-31')").text)
+
+    def test_request_window(self):
+        """Test reductions without window use the request dates."""
+        self.assertTrue(Expression("mean(landsat.B5)").uses_request_window())
+        self.assertFalse(
+            Expression("mean(landsat.B5, 2015)").uses_request_window())
+        self.assertRaises(Error, Expression("mean(landsat.B5)").compile)
+
+    def test_invalid_windows(self):
+        """Test invalid windows are rejected."""
+        invalids = [
+            "median(landsat.B5, 2015, 2016)",
+            "median(landsat.B5, '2015-13-01', '2016-01-01')",
+            "median(landsat.B5, '2016-01-01', '2015-01-01')",
+            "median(landsat.B5, 1 + 1)",
+            "change(landsat.B5, 2015)",
+            "median(landsat.B5, True)",
+            "median(landsat.B5, 1)",
+            "median(landsat.B5, 9999)",
+        ]
+        for invalid in invalids:
+            self.assertRaises(Error, Expression, invalid)
+
+
+class FairRateLimitTest(unittest.TestCase):
+    """Test the priority classes of the rate limit."""
+
+    def admit_all(self, limiter, requests):
+        """Runs concurrent requests, and returns their admission order.
+
+        Parameters:
+            limiter: FairRateLimit admitting the requests.
+            requests: list of (name, priority, client) tuples, queued in
+                order.
+        """
+        order = []
+        threads = []
+        for name, priority, client in requests:
+            def run(name=name, priority=priority, client=client):
+                limiter.acquire(priority, client)
+                order.append(name)
+                limiter.release(priority)
+            threads.append(threading.Thread(target=run))
+            threads[-1].start()
+            time.sleep(0.02)  # Ensures the queuing order.
+
+        for thread in threads:
+            thread.join(5)
+        return order
+
+    def test_interactive_first(self):
+        """Test interactive requests overtake queued batch requests."""
+        limiter = FairRateLimit(1, 0.2)
+        limiter.acquire('batch', 'scheduler')
+        limiter.release('batch')
+
+        order = self.admit_all(limiter, [
+            ('batch 1', 'batch', 'scheduler'),
+            ('batch 2', 'batch', 'scheduler'),
+            ('user', 'interactive', 'frontend'),
+        ])
+        self.assertEqual(order, ['user', 'batch 1', 'batch 2'])
+
+    def test_fair_clients(self):
+        """Test clients of a same class are served in turns."""
+        limiter = FairRateLimit(1, 0.1)
+        limiter.acquire('batch', 'c')
+        limiter.release('batch')
+
+        order = self.admit_all(limiter, [
+            ('a1', 'batch', 'a'),
+            ('a2', 'batch', 'a'),
+            ('a3', 'batch', 'a'),
+            ('b1', 'batch', 'b'),
+        ])
+        self.assertEqual(order, ['a1', 'b1', 'a2', 'a3'])
+
+    def test_flows_pruned(self):
+        """Test the flows of idle clients are forgotten."""
+        limiter = FairRateLimit(1000, 1)
+        for client in range(100):
+            limiter.acquire('batch', "client %s" % client)
+            limiter.release('batch')
+        self.assertEqual(limiter.finish_tags, {})
+
+    def test_idle(self):
+        """Test the limiter is idle while a request would be let through."""
+        limiter = FairRateLimit(1, 60)
+        self.assertTrue(limiter.idle())
+        limiter.acquire('interactive')
+        limiter.release('interactive')
+        self.assertFalse(limiter.idle())
+
+    def test_concurrency_cap(self):
+        """Test a class cannot run more requests than its cap."""
+        limiter = FairRateLimit(100, 1, concurrency={
+            'interactive': 8, 'batch': 1, 'background': 1})
+        limiter.acquire('batch')
+
+        blocked = threading.Thread(target=limiter.acquire, args=('batch',))
+        blocked.start()
+        limiter.acquire('interactive')
+        time.sleep(0.1)
+        self.assertTrue(blocked.is_alive())
+
+        limiter.release('batch')
+        blocked.join(1)
+        self.assertFalse(blocked.is_alive())
+        self.assertEqual(limiter.running, {
+            'interactive': 1, 'batch': 1, 'background': 0})
+
+    def test_shedding(self):
+        """Test requests are rejected early if they would wait too long."""
+        limiter = FairRateLimit(1, 10)
+        limiter.acquire('interactive')
+        limiter.release('interactive')
+
+        start = time.time()
+        self.assertRaises(Overloaded, limiter.acquire, 'interactive', None, 1)
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_timeout(self):
+        """Test requests are rejected once their timeout expires."""
+        limiter = FairRateLimit(100, 1, concurrency={
+            'interactive': 1, 'batch': 1, 'background': 1})
+        limiter.acquire('interactive')
+        self.assertRaises(Overloaded, limiter.acquire, 'interactive', None,
+            0.1)
+
+
+class ProductIndexTest(unittest.TestCase):
+    """Test the spatial index of the generated images."""
+
+    def setUp(self):
+        """Test setup. Creates an index in a temporary directory."""
+        self.directory = tempfile.mkdtemp()
+        self.path = "%s/products.sqlite" % self.directory
+        self.index = ProductIndex(self.path)
+
+    def tearDown(self):
+        """Removes the index."""
+        shutil.rmtree(self.directory)
+
+    def test_covering_images(self):
+        """Test only images covering the area at a finer scale are found."""
+        self.index.add("rgb", "2015", (0, 0, 10, 10), 100, "http://a",
+            VALID_GEOJSON)
+        self.index.add("rgb", "2015", (0, 0, 12, 12), 80, "http://b",
+            VALID_GEOJSON)
+
+        self.assertEqual(self.index.find("rgb", "2015", (1, 1, 9, 9),
+            100)["href"], "http://a")
+        self.assertEqual(self.index.find("rgb", "2015", (0, 0, 11, 11),
+            100)["href"], "http://b")
+        self.assertIsNone(self.index.find("rgb", "2015", (1, 1, 9, 9), 10))
+        self.assertIsNone(self.index.find("rgb", "2015", (-1, 1, 9, 9), 100))
+        self.assertIsNone(self.index.find("rgb", "2016", (1, 1, 9, 9), 100))
+        self.assertIsNone(self.index.find("forestDiff", "2015", (1, 1, 9, 9),
+            100))
+
+    def test_oversized_images(self):
+        """Test images much larger than the request are not reused."""
+        self.index.add("rgb", "2015", (0, 0, 10, 10), 100, "http://a",
+            VALID_GEOJSON)
+        self.assertIsNone(self.index.find("rgb", "2015", (4, 4, 5, 5), 100))
+        self.assertIsNone(self.index.find("rgb", "2015", (1, 1, 9, 9), 200))
+
+    def test_persistence(self):
+        """Test images are found by other instances."""
+        self.index.add("rgb", "2015", (0, 0, 10, 10), 100, "http://a",
+            VALID_GEOJSON)
+        found = ProductIndex(self.path).find("rgb", "2015", (1, 1, 9, 9), 100)
+        self.assertEqual(found["image_geojson"], VALID_GEOJSON)
+
+    def test_expiration(self):
+        """Test expired images are not reused."""
+        self.index.add("rgb", "2015", (0, 0, 10, 10), 100, "http://a",
+            VALID_GEOJSON)
+        self.index.ttl = -1
+        self.assertIsNone(self.index.find("rgb", "2015", (1, 1, 9, 9), 100))
+
+        # Expired images are still served as stale results for a while.
+        self.assertEqual(self.index.find("rgb", "2015", (1, 1, 9, 9), 100,
+            stale=True)["href"], "http://a")
+        self.index.stale_ttl = -1
+        self.index.expire()
+        self.assertIsNone(self.index.find("rgb", "2015", (1, 1, 9, 9), 100,
+            stale=True))
+
+        # Links are not served once expired.
+        index = ProductIndex(self.path, ttl=2 * 3600, stale_ttl=6 * 3600)
+        self.assertLess(index.ttl, LINK_LIFETIME)
+        self.assertLess(index.stale_ttl, LINK_LIFETIME)
+
+
+class RasterStoreTest(unittest.TestCase):
+    """Test the memory mapped store of rasters."""
+
+    def setUp(self):
+        """Test setup. Creates a store in a temporary directory."""
+        self.directory = tempfile.mkdtemp()
+        self.store = RasterStore(self.directory)
+
+        # 10x20 pixels of 0.5 degrees, with the pixel index as value.
+        self.array = numpy.zeros((10, 20), dtype=[("B4", "f4"), ("B5", "f4")])
+        self.array["B4"] = numpy.arange(200).reshape(10, 20)
+        self.array["B5"] = 1
+        self.bounds = (0, 0, 10, 5)
+
+    def tearDown(self):
+        """Removes the store."""
+        shutil.rmtree(self.directory)
+
+    def test_put_and_open(self):
+        """Test rasters are memory mapped with their georeference."""
+        self.assertIsNone(self.store.open("missing"))
+        self.store.put("region/2015", self.array, self.bounds)
+
+        raster = self.store.open("region/2015")
+        self.assertIsInstance(raster.array, numpy.memmap)
+        self.assertEqual(raster.bands, ("B4", "B5"))
+        self.assertEqual(raster.bounds, self.bounds)
+        self.assertEqual(raster.pixel_size, (0.5, 0.5))
+        self.assertEqual(self.store.keys(), ["region_2015"])
+
+    def test_windowed_reads(self):
+        """Test only the pixels covering the area are read."""
+        raster = self.store.put("region", self.array, self.bounds)
+
+        # Top left pixel, then a window not aligned on pixels.
+        pixels, bounds = raster.read((0, 4.5, 0.5, 5), "B4")
+        self.assertEqual(pixels.tolist(), [[0]])
+        self.assertEqual(bounds, (0, 4.5, 0.5, 5))
+
+        pixels, bounds = raster.read((1.2, 3.7, 2.1, 4.1), "B4")
+        self.assertEqual(pixels.tolist(), [[22, 23, 24], [42, 43, 44]])
+        self.assertEqual(bounds, (1, 3.5, 2.5, 4.5))
+
+        # Areas exceeding the raster are clipped.
+        pixels, bounds = raster.read((9, -5, 20, 0.5))
+        self.assertEqual(pixels.shape, (1, 2))
+        self.assertEqual(bounds, (9, 0, 10, 0.5))
+        pixels, _ = raster.read((20, 20, 30, 30))
+        self.assertEqual(pixels.size, 0)
+
+    def test_crop_and_statistics(self):
+        """Test crops and statistics only cover the area."""
+        raster = self.store.put("region", self.array, self.bounds)
+
+        crop = raster.crop((0, 4, 1, 5))
+        self.assertEqual(crop.array["B4"].tolist(), [[0, 1], [20, 21]])
+        self.assertEqual(crop.bounds, (0, 4, 1, 5))
+
+        self.assertEqual(raster.statistics((0, 4, 1, 5), "B4"),
+            {"count": 4, "min": 0, "max": 21, "mean": 10.5})
+        self.assertEqual(raster.statistics((0, 4, 1, 5), "B4",
+            nodata=0)["count"], 3)
+        self.assertEqual(raster.statistics((20, 20, 30, 30), "B5"),
+            {"count": 0, "min": None, "max": None, "mean": None})
+        self.assertRaises(ValueError, raster.statistics, self.bounds)
+
+    def test_fetch(self):
+        """Test downloaded images are streamed to the store."""
+        path = "%s/image.npy" % self.directory
+        numpy.save(path, self.array)
+        with open(path, "rb") as image:
+            content = image.read()
+
+        session = mock.MagicMock()
+        session.get.return_value.iter_content.return_value = [content[:100],
+            content[100:]]
+        raster = self.store.fetch("region", "http://ee/image", self.bounds,
+            session=session)
+        self.assertEqual(raster.array["B4"][9, 19], 199)
+
+        session.get.return_value.ok = False
+        self.assertRaises(IOError, self.store.fetch, "other",
+            "http://ee/image", self.bounds, session=session)
+        self.assertEqual(self.store.keys(), ["region"])
+
+    def test_fetch_zipped(self):
+        """Test zipped downloads are extracted, without leaving temporary
+        files."""
+        content = BytesIO()
+        numpy.save(content, self.array)
+
+        def session(name):
+            """Returns a session downloading a zip of one file."""
+            archive = BytesIO()
+            with zipfile.ZipFile(archive, "w") as output:
+                output.writestr(name, content.getvalue())
+            session = mock.MagicMock()
+            session.get.return_value.iter_content.return_value = [
+                archive.getvalue()]
+            return session
+
+        raster = self.store.fetch("region", "http://ee/image", self.bounds,
+            session=session("image.npy"))
+        self.assertEqual(raster.array["B4"][9, 19], 199)
+
+        self.assertRaises(IOError, self.store.fetch, "other",
+            "http://ee/image", self.bounds, session=session("image.tif"))
+        with mock.patch("shutil.copyfileobj", side_effect=IOError("Full")):
+            self.assertRaises(IOError, self.store.fetch, "other",
+                "http://ee/image", self.bounds, session=session("image.npy"))
+
+        self.assertEqual(self.store.keys(), ["region"])
+        self.assertEqual([name for name in os.listdir(self.directory)
+            if name.endswith(".tmp")], [])
+
+
+class ScalePlannerTest(unittest.TestCase):
+    """Test the planning of the image scales."""
+
+    def test_geodesic_dimensions(self):
+        """Test widths shrink away from the equator."""
+        width, height = geodesic_dimensions((0, -1, 1, 1))
+        self.assertAlmostEqual(width, 111320)
+        self.assertAlmostEqual(height, 2 * 111320)
+
+        width, _ = geodesic_dimensions((0, 60, 1, 70))
+        self.assertAlmostEqual(width, 111320 / 2.)
+        width, _ = geodesic_dimensions((0, -70, 1, -60))
+        self.assertAlmostEqual(width, 111320 / 2.)
+
+    def test_automatic_scale(self):
+        """Test automatic scales fit the budget and the download limits."""
+        self.assertEqual(plan_scale((0, 0, 0.01, 0.01)).scale, 30)
+
+        plan = plan_scale((0, 0, 10, 10))
+        self.assertLessEqual(plan.width * plan.height, 4 * 1000 * 1000)
+        self.assertEqual(len(plan.tiles), 1)
+
+        # Same area in degrees, but half as wide on the ground.
+        self.assertLess(plan_scale((0, 60, 10, 70)).scale, plan.scale)
+
+        # Raw images have larger pixels, so a coarser scale.
+        self.assertGreater(plan_scale((0, 0, 10, 10), pixel_bytes=12).scale,
+            plan.scale)
+
+        # Very elongated areas are limited by the grid dimension.
+        plan = plan_scale((0, 0, 100, 0.01))
+        self.assertLessEqual(plan.width, MAX_GRID_DIMENSION)
+
+        self.assertRaises(Error, plan_scale, (0, 0, 1, 1), 0)
+        self.assertRaises(Error, plan_scale, (0, 0, 1, 1), -1)
+
+    def test_tiles(self):
+        """Test images too large at the requested scale are tiled."""
+        plan = plan_scale((0, 0, 10, 10), scale=100)
+        self.assertEqual(plan.scale, 100)
+        self.assertEqual((plan.width, plan.height), (11132, 11132))
+        self.assertEqual(len(plan.tiles), 16)
+
+        # Tiles cover the area, and each fits the download limits.
+        for x_min, y_min, x_max, y_max in plan.tiles:
+            tile = plan_scale((x_min, y_min, x_max, y_max), scale=100)
+            self.assertEqual(len(tile.tiles), 1)
+            self.assertLessEqual(tile.bytes, MAX_DOWNLOAD_BYTES)
+        self.assertAlmostEqual(sum((x_max - x_min) * (y_max - y_min)
+            for x_min, y_min, x_max, y_max in plan.tiles), 100)
+
+
+class DatasetPlannerTest(unittest.TestCase):
+    """Test the choice of the dataset of the images."""
+
+    def plan(self, scale, start, end, composite='median'):
+        """Returns the collection of the RGB dataset chosen for a request."""
+        return plan_dataset(RGB_DATASETS, scale, datetime(*start),
+            datetime(*end), composite).collection
+
+    def test_coarsest_dataset(self):
+        """Test the coarsest dataset fine enough for the scale is chosen."""
+        self.assertEqual(self.plan(30, (2015, 1, 1), (2015, 3, 1)),
+            "LANDSAT/LC8_L1T")
+        self.assertEqual(self.plan(2000, (2015, 1, 1), (2015, 3, 1)),
+            "MODIS/MOD09A1")
+        self.assertEqual(self.plan(None, (2015, 1, 1), (2015, 3, 1)),
+            "LANDSAT/LC8_L1T")
+
+        self.assertEqual(plan_dataset(EVI_DATASETS, 500, datetime(2010, 1, 1),
+            datetime(2015, 12, 31)).collection, "MODIS/MOD13A1")
+        self.assertEqual(plan_dataset(EVI_DATASETS, 1500, datetime(2010, 1, 1),
+            datetime(2015, 12, 31)).collection, "MODIS/MOD13A2")
+
+    def test_time_window(self):
+        """Test the dataset must have images within the dates."""
+        # Too short for a MODIS composite.
+        self.assertEqual(self.plan(2000, (2015, 1, 1), (2015, 1, 3)),
+            "LANDSAT/LC8_L1T")
+        # Before Landsat 8.
+        self.assertEqual(self.plan(10, (2005, 1, 1), (2005, 3, 1)),
+            "MODIS/MOD09A1")
+
+    def test_composite(self):
+        """Test cloud aware composites are computed on Landsat only."""
+        self.assertEqual(self.plan(2000, (2015, 1, 1), (2015, 3, 1), "best"),
+            "LANDSAT/LC8_L1T")
+        self.assertEqual(self.plan(2000, (2015, 1, 1), (2015, 3, 1), "foo"),
+            "LANDSAT/LC8_L1T")
+
+
+class CostsTest(unittest.TestCase):
+    """Test the cost estimates of the image requests."""
+
+    def setUp(self):
+        """Test setup. Parses the flags for the budgets."""
+        gflags.FLAGS([])
+
+    def test_count_scenes(self):
+        """Test scenes are counted per acquisition and footprint."""
+        landsat, modis = RGB_DATASETS
+        start, end = datetime(2015, 1, 1), datetime(2015, 2, 2)
+        self.assertEqual(count_scenes(landsat, (0, 0, 1, 1), start, end), 2)
+        self.assertEqual(count_scenes(landsat, (0, 0, 3, 1), start, end), 4)
+        self.assertEqual(count_scenes(modis, (0, 0, 3, 1), start, end), 4)
+        # Before the first images of the collection.
+        self.assertEqual(count_scenes(landsat, (0, 0, 1, 1),
+            datetime(2010, 1, 1), datetime(2011, 1, 1)), 0)
+
+    def test_estimate(self):
+        """Test the estimates follow the planned scale and dataset."""
+        windows = [(datetime(2015, 1, 1), datetime(2015, 2, 2))]
+        fine = estimate_cost(plan_scale((0, 0, 1, 1), 30), (0, 0, 1, 1),
+            RGB_DATASETS, windows)
+        coarse = estimate_cost(plan_scale((0, 0, 1, 1), 500), (0, 0, 1, 1),
+            RGB_DATASETS, windows)
+        self.assertEqual((fine.dataset, coarse.dataset),
+            ("LANDSAT/LC8_L1T", "MODIS/MOD09A1"))
+        self.assertEqual(fine.pixels, fine.width * fine.height)
+        self.assertTrue(coarse.latency < fine.latency)
+        self.assertIsNone(estimate_cost(plan_scale((0, 0, 1, 1), 30),
+            (0, 0, 1, 1)).scenes)
+
+    def test_admission(self):
+        """Test requests over budget are coarsened or rejected."""
+        bounds = (0, 0, 10, 10)
+        plan, estimate, adjusted = admit_request(bounds, 1000, 3)
+        self.assertEqual((plan.scale, adjusted), (1000, False))
+
+        FLAGS.max_request_pixels = 1000 * 1000
+        try:
+            plan, estimate, adjusted = admit_request(bounds, 100, 3)
+            self.assertTrue(adjusted)
+            self.assertTrue(estimate.pixels <= 1000 * 1000)
+            self.assertTrue(plan.scale < 1200)
+
+            with self.assertRaises(OverBudget) as context:
+                admit_request(bounds, 100, 3, policy='reject')
+            self.assertEqual(context.exception.to_dict()["estimate"]["scale"],
+                100)
+        finally:
+            FLAGS.max_request_pixels = 400 * 1000 * 1000
+
+    def test_combined_estimates(self):
+        """Test the estimates of the images of a request are summed."""
+        plan = plan_scale((0, 0, 1, 1), 500)
+        frames = [estimate_cost(plan, (0, 0, 1, 1), RGB_DATASETS,
+            [(datetime(year, 1, 1), datetime(year, 2, 1))])
+            for year in (2014, 2015)]
+        estimate = combine_estimates(frames)
+        self.assertEqual((estimate.pixels, estimate.scenes, estimate.tiles),
+            (2 * frames[0].pixels, 2 * frames[0].scenes, 2))
+        self.assertEqual(estimate.scale, 500)
+
+    def test_reduction(self):
+        """Test reductions are estimated from the areas, and coarsened."""
+        windows = [(datetime(2015, 1, 1), datetime(2015, 12, 31))]
+        estimate = estimate_reduction([1e12, 1e12], 1000, EVI_DATASETS,
+            windows)
+        self.assertEqual((estimate.pixels, estimate.bytes), (2000000, None))
+        self.assertEqual(estimate.dataset, "MODIS/MOD13A2")
+        self.assertEqual(estimate.scenes, 23)
+
+        scale, estimate, adjusted = admit_reduction([LAND_AREA], 100)
+        self.assertTrue(adjusted)
+        self.assertTrue(scale > 100)
+        self.assertTrue(estimate.pixels <= FLAGS.max_request_pixels)
+        self.assertRaises(OverBudget, admit_reduction, [LAND_AREA], 100,
+            policy='reject')
+
+
+class TilePyramidTest(unittest.TestCase):
+    """Test the pyramid of forest change tiles."""
+
+    def setUp(self):
+        """Test setup. Creates a pyramid on a mocked Earth Engine."""
+        self.directory = tempfile.mkdtemp()
+        self.fetcher = mock.MagicMock()
+        self.session = mock.MagicMock()
+
+        # Earth Engine tiles have a red left half and a green right half.
+        image = Image.new("RGB", (256, 256), (0, 255, 0))
+        image.paste((255, 0, 0), (0, 0, 128, 256))
+        content = BytesIO()
+        image.save(content, "PNG")
+        self.session.get.return_value.content = content.getvalue()
+
+        self.pyramid = TilePyramid(self.fetcher, self.directory, self.session)
+
+    def tearDown(self):
+        """Removes the tiles."""
+        shutil.rmtree(self.directory)
+
+    def test_tile_bounds(self):
+        """Test the Web Mercator grid."""
+        x_min, y_min, x_max, y_max = tile_bounds(0, 0, 0)
+        self.assertEqual((x_min, x_max), (-180, 180))
+        self.assertAlmostEqual(y_max, 85.0511287798)
+        self.assertAlmostEqual(y_min, -85.0511287798)
+        self.assertEqual(tile_bounds(1, 1, 0)[:2], (0, 0))
+
+    def test_tiles_cached(self):
+        """Test tiles are only generated once."""
+        path = self.pyramid.get(2000, 2010, 3, 1, 2)
+        self.assertEqual(self.pyramid.get(2000, 2010, 3, 1, 2), path)
+        self.fetcher.GetForestIndicesTile.assert_called_once_with(2000, 2010,
+            tile_bounds(3, 1, 2), 256)
+        self.assertRaises(Error, self.pyramid.get, 2000, 2010, 3, 8, 0)
+
+    def test_deep_tiles_cropped(self):
+        """Test tiles beyond the native zoom are cropped from an ancestor."""
+        z = NATIVE_ZOOM + 1
+        left = Image.open(self.pyramid.get(2000, 2010, z, 0, 1))
+        right = Image.open(self.pyramid.get(2000, 2010, z, 1, 1))
+        self.assertEqual(left.convert("RGB").getcolors(), [(65536,
+            (255, 0, 0))])
+        self.assertEqual(right.convert("RGB").getcolors(), [(65536,
+            (0, 255, 0))])
+        self.fetcher.GetForestIndicesTile.assert_called_once_with(2000, 2010,
+            tile_bounds(NATIVE_ZOOM, 0, 0), 256)
+
+    def test_parent_downsampled(self):
+        """Test tiles are downsampled from their cached children."""
+        for x, y in ((2, 2), (3, 2), (2, 3), (3, 3)):
+            self.pyramid.get(2000, 2010, 2, x, y)
+        self.assertEqual(self.fetcher.GetForestIndicesTile.call_count, 4)
+
+        parent = Image.open(self.pyramid.get(2000, 2010, 1, 1, 1))
+        self.assertEqual(self.fetcher.GetForestIndicesTile.call_count, 4)
+        self.assertEqual(parent.convert("RGB").getpixel((10, 10)),
+            (255, 0, 0))
+        self.assertEqual(parent.convert("RGB").getpixel((100, 10)),
+            (0, 255, 0))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    """Test the circuit breakers of the upstreams."""
+
+    def setUp(self):
+        """Test setup. Creates a breaker opening after 2 failures."""
+        self.breaker = CircuitBreaker("Upstream", failures=(IOError,),
+            failure_threshold=2, reset_timeout=60)
+
+    def call(self, exception=None):
+        """Calls the upstream through the breaker."""
+        with self.breaker:
+            if exception is not None:
+                raise exception
+
+    def test_opens_after_failures(self):
+        """Test consecutive failures open the breaker."""
+        self.assertRaises(IOError, self.call, IOError())
+        self.call()
+        self.assertRaises(IOError, self.call, IOError())
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertRaises(IOError, self.call, IOError())
+        self.assertEqual(self.breaker.state, "open")
+
+        self.assertFalse(self.breaker.available())
+        self.assertRaises(CircuitOpen, self.call)
+
+    def test_other_errors_ignored(self):
+        """Test errors which are not failures keep the breaker closed."""
+        for _ in range(3):
+            self.assertRaises(Error, self.call, Error("Invalid request."))
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_earth_engine_failures(self):
+        """Test only the Earth Engine errors of the upstream are failures."""
+        self.breaker.failures = (ee.EEException, IOError)
+        self.breaker.is_failure = is_upstream_failure
+        for message in ("User memory limit exceeded.", "Image.select: "
+                "Pattern 'B12' did not match any bands.", "Too many pixels "
+                "in the region. Specified: 1000000000, maximum: 100000000"):
+            self.assertRaises(ee.EEException, self.call,
+                ee.EEException(message))
+        self.assertEqual(self.breaker.state, "closed")
+
+        self.assertRaises(IOError, self.call, IOError())
+        self.assertRaises(ee.EEException, self.call,
+            ee.EEException("Server returned HTTP code: 503"))
+        self.assertEqual(self.breaker.state, "open")
+        self.assertTrue(is_upstream_failure(ee.EEException("Quota exceeded")))
+        self.assertTrue(is_upstream_failure(ee.EEException(
+            "Too many concurrent aggregations.")))
+
+    def test_half_open_probe(self):
+        """Test a single probe is let through after the reset timeout."""
+        for _ in range(2):
+            self.assertRaises(IOError, self.call, IOError())
+        self.breaker.opened_at -= 60
+        self.assertTrue(self.breaker.available())
+
+        # A failing probe opens the breaker again.
+        self.assertRaises(IOError, self.call, IOError())
+        self.assertEqual(self.breaker.state, "open")
+        self.assertRaises(CircuitOpen, self.call)
+
+        # Other calls fail fast while the probe runs.
+        self.breaker.opened_at -= 60
+        with self.breaker:
+            self.assertEqual(self.breaker.state, "half-open")
+            self.assertRaises(CircuitOpen, self.breaker.__enter__)
+        self.assertEqual(self.breaker.state, "closed")
+        self.call()
+
+
+class PrefetcherTest(unittest.TestCase):
+    """Test the prefetching of the neighbours of the requests."""
+
+    def setUp(self):
+        """Test setup. Runs the prefetches synchronously, without
+        downloading them."""
+        self.async_fetcher = mock.MagicMock()
+        self.async_fetcher.submit.side_effect = lambda function: function()
+        self.rate_limiter = mock.MagicMock()
+        self.rate_limiter.idle.return_value = True
+        self.prefetcher = Prefetcher(self.async_fetcher, self.rate_limiter,
+            max_pending=1)
+        patcher = mock.patch("prefetch.download_image")
+        self.download = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_neighbours(self):
+        """Test the neighbours depend on the prefetching level."""
+        date, delta = datetime(2015, 4, 1), relativedelta(months=1)
+        self.assertEqual(neighbour_dates(date, delta, 0), [])
+        self.assertEqual(neighbour_dates(date, delta, 1),
+            [datetime(2015, 2, 1), datetime(2015, 6, 1)])
+        # The next window of the current date is in the future.
+        self.assertEqual(len(neighbour_dates(datetime.now(), delta, 1)), 1)
+
+        bounds = (0, 80, 10, 90)
+        self.assertEqual(neighbour_bounds(bounds, 1), [])
+        self.assertEqual(neighbour_bounds(bounds, 2),
+            [(-10, 80, 0, 90), (10, 80, 20, 90), (0, 70, 10, 80)])
+        self.assertEqual(len(neighbour_bounds(bounds, 3)), 5)
+
+    def test_hit_rate(self):
+        """Test the hit rate counts the prefetched images later used."""
+        self.prefetcher.prefetch("a", lambda: ("http://a", False))
+        self.prefetcher.prefetch("b", lambda: ("http://b", False))
+        self.prefetcher.prefetch("c", lambda: ("http://c", True))
+        self.prefetcher.used("http://a")
+        self.prefetcher.used("http://a")
+        self.prefetcher.used("http://c")
+
+        stats = self.prefetcher.stats()
+        self.assertEqual((stats["generated"], stats["skipped"], stats["used"]),
+            (2, 1, 1))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_downloaded(self):
+        """Test generated images are downloaded, and the time measured."""
+        self.download.side_effect = lambda href: time.sleep(0.05)
+        self.prefetcher.prefetch("a", lambda: ("http://a", False))
+        self.prefetcher.prefetch("b", lambda: ("http://b", True))
+        self.download.assert_called_once_with("http://a")
+        self.assertEqual(self.prefetcher.stats()["saved_seconds"], 0)
+        self.prefetcher.used("http://a")
+        self.assertGreaterEqual(self.prefetcher.stats()["saved_seconds"],
+            0.05)
+
+        # Failed downloads are only logged.
+        self.download.side_effect = IOError()
+        self.prefetcher.prefetch("c", lambda: ("http://c", False))
+        self.assertEqual(self.prefetcher.stats()["generated"], 2)
+
+    def test_busy(self):
+        """Test prefetches are dropped while the rate limit is busy."""
+        fetch = mock.MagicMock()
+        self.rate_limiter.idle.return_value = False
+        self.prefetcher.prefetch("a", fetch)
+        self.assertFalse(fetch.called)
+        self.assertEqual(self.prefetcher.stats()["dropped"], 1)
+
+    def test_dropped(self):
+        """Test prefetches are dropped when the budget is exhausted."""
+        def overloaded():
+            raise Overloaded("Overloaded")
+
+        self.prefetcher.prefetch("a", overloaded)
+        self.async_fetcher.submit.side_effect = None
+        self.prefetcher.prefetch("b", lambda: ("http://b", False))
+        self.prefetcher.prefetch("c", lambda: ("http://c", False))
+
+        stats = self.prefetcher.stats()
+        self.assertEqual((stats["scheduled"], stats["dropped"]), (2, 2))
+        self.assertIsNone(stats["hit_rate"])
+
+
+class ProfilingTest(unittest.TestCase):
+    """Test the request profiles."""
+
+    def setUp(self):
+        """Test setup. Parses the flags, and creates a temporary profiles
+        directory."""
+        gflags.FLAGS([])
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Removes the profiles."""
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def work():
+        """Profiled function."""
+        return sorted(range(1000), reverse=True)
+
+    def test_collapsed_stacks(self):
+        """Test stacks are written in the collapsed format."""
+        profile = Profile("collapsed")
+        profile.start()
+        self.work()
+        profile.stop()
+
+        name = profile.save(self.directory, "rgb/42")
+        self.assertEqual(name, "rgb_42.folded")
+        with open(self.directory + "/" + name) as stacks:
+            lines = stacks.read().splitlines()
+        stack, microseconds = lines[-1].rsplit(" ", 1)
+        self.assertTrue(any(line.startswith("work (tests.py:")
+            for line in lines))
+        self.assertTrue(int(microseconds) > 0)
+
+    def test_rotation(self):
+        """Test only the latest profiles are kept."""
+        store = ProfileStore(self.directory, keep=2)
+        names = []
+        for index in range(3):
+            profile = Profile("pstats")
+            profile.start()
+            self.work()
+            profile.stop()
+            names.append(store.save(profile, "rgb-%s" % index))
+            time.sleep(0.01)
+
+        self.assertIsNone(store.path(names[0]))
+        self.assertIsNotNone(store.path(names[2]))
+        self.assertIsNone(store.path("../tests.py"))
+
+    def test_requested_format(self):
+        """Test on demand profiles require the token."""
+        self.assertIsNone(requested_format(None, None))
+        with self.assertRaises(Error):
+            requested_format("1", None)
+
+        FLAGS.profile_token = "secret"
+        try:
+            self.assertEqual(requested_format("1", "secret"), "pstats")
+            with self.assertRaises(Error):
+                requested_format("1", "wrong")
+            with self.assertRaises(Error):
+                requested_format("svg", "secret")
+        finally:
+            FLAGS.profile_token = ""
+
+
+class TracingTest(unittest.TestCase):
+    """Test the request spans."""
+
+    def setUp(self):
+        """Test setup. Creates an exporter collecting the spans."""
+        self.exporter = mock.MagicMock()
+
+    def tearDown(self):
+        """Stops tracing the thread."""
+        end_trace()
+
+    def test_nested_spans(self):
+        """Test spans are nested and exported at the end of the trace."""
+        self.assertEqual(start_trace("query-42", self.exporter), "query-42")
+        with span("request"):
+            with span("stage", place="Pau"):
+                pass
+        end_trace()
+
+        spans = self.exporter.export.call_args[0][0]
+        self.assertEqual([s["name"] for s in spans], ["stage", "request"])
+        self.assertEqual(spans[0]["parentSpanId"], spans[1]["spanId"])
+        self.assertEqual(spans[0]["traceId"], spans[1]["traceId"])
+        self.assertRegexpMatches(spans[0]["traceId"], "^[0-9a-f]{32}$")
+        self.assertRegexpMatches(spans[0]["spanId"], "^[0-9a-f]{16}$")
+        attributes = dict((attribute["key"], attribute["value"]["stringValue"])
+            for attribute in spans[0]["attributes"])
+        self.assertEqual(attributes["place"], "Pau")
+        self.assertEqual(attributes["correlation.id"], "query-42")
+        self.assertEqual(spans[0]["status"], {"code": 1})
+        self.assertLessEqual(spans[0]["startTimeUnixNano"],
+            spans[0]["endTimeUnixNano"])
+
+    def test_failed_span(self):
+        """Test errors are recorded in the spans."""
+        start_trace(None, self.exporter)
+        try:
+            with span("stage"):
+                raise Error("Unknown city")
+        except Error:
+            pass
+        end_trace()
+
+        spans = self.exporter.export.call_args[0][0]
+        self.assertEqual(spans[0]["status"], {"code": 2,
+            "message": "Unknown city"})
+
+    def test_invalid_correlation_id(self):
+        """Test unsafe correlation IDs are replaced."""
+        self.assertNotEqual(start_trace("bad id\n", None), "bad id\n")
+
+    def test_disabled(self):
+        """Test nothing is recorded without exporter."""
+        start_trace("query-42", None)
+        with span("stage") as current:
+            current.set("key", "value")
+        self.assertIsNone(current.record)
+
+
+class AsyncImageFetcherTest(unittest.TestCase):
+    """Test the non-blocking fetcher."""
+
+    def setUp(self):
+        """Test setup. Creates a fetcher on a mocked one."""
+        self.fetcher = mock.MagicMock()
+        self.async_fetcher = AsyncImageFetcher(self.fetcher, workers=4)
+
+    def tearDown(self):
+        """Stops the workers."""
+        self.async_fetcher.close()
+
+    def test_call(self):
+        """Test calls run with the admission of the submitting thread."""
+        self.fetcher.GetRGBImage.side_effect = lambda *args: (
+            current_admission()[:2])
+
+        with admission("batch", "watchlist"):
+            result = self.async_fetcher.call("GetRGBImage", 2000, 2001)
+        self.assertEqual(result.get(1), ("batch", "watchlist"))
+        self.fetcher.GetRGBImage.assert_called_once_with(2000, 2001)
+
+    def test_map_keeps_order(self):
+        """Test concurrent calls are gathered in order."""
+        def slow_square(value):
+            time.sleep(0.01 * (5 - value))
+            return value * value
+
+        self.assertEqual(self.async_fetcher.map(slow_square,
+            [(i,) for i in range(5)]), [0, 1, 4, 9, 16])
+
+        def fail(value):
+            raise Error("Failed on %s." % value)
+        self.assertRaises(Error, self.async_fetcher.map, fail, [(1,), (2,)])
+
+    def test_overloaded(self):
+        """Test calls are rejected when too many are pending."""
+        self.async_fetcher.max_pending = 1
+        event = threading.Event()
+
+        result = self.async_fetcher.submit(event.wait)
+        self.assertRaises(Overloaded, self.async_fetcher.submit, time.time)
+        event.set()
+        result.get(1)
+        self.assertIsNotNone(self.async_fetcher.submit(time.time).get(1))
+
+    def test_jobs(self):
+        """Test job results are kept until polled."""
+        event = threading.Event()
+
+        def job():
+            event.wait()
+            return 200, {"href": "http://foo.com"}
+
+        job_id = self.async_fetcher.start_job(job)
+        self.assertEqual(self.async_fetcher.job(job_id), "pending")
+        event.set()
+        for _ in range(50):
+            if self.async_fetcher.job(job_id) != "pending":
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.async_fetcher.job(job_id),
+            (200, {"href": "http://foo.com"}))
+        self.assertIsNone(self.async_fetcher.job("unknown"))
+
+        def failing_job():
+            raise Error("Invalid area.", 404)
+
+        job_id = self.async_fetcher.start_job(failing_job)
+        for _ in range(50):
+            if self.async_fetcher.job(job_id) != "pending":
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.async_fetcher.job(job_id),
+            (404, {"error": "Invalid area."}))
+
+
+class ChangesTest(unittest.TestCase):
+    """Test the detection of forest changes between consecutive masks."""
+
+    def test_label_clusters(self):
+        """Test clusters are labelled by 8-connectivity."""
+        mask = numpy.array([
+            [1, 1, 0, 0, 1],
+            [0, 1, 0, 0, 1],
+            [0, 0, 1, 0, 0],
+            [1, 0, 0, 0, 1],
+            [1, 1, 0, 1, 1],
+        ], dtype=bool)
+        labels = label_clusters(mask)
+
+        self.assertTrue((labels[~mask] == mask.size).all())
+        clusters = sorted(sorted(zip(*numpy.nonzero(labels == label)))
+            for label in numpy.unique(labels[mask]))
+        self.assertEqual(clusters, [
+            [(0, 0), (0, 1), (1, 1), (2, 2)],
+            [(0, 4), (1, 4)],
+            [(3, 0), (4, 0), (4, 1)],
+            [(3, 4), (4, 3), (4, 4)],
+        ])
+
+        # Serpentine clusters are labelled as a whole.
+        snake = numpy.zeros((21, 21), dtype=bool)
+        snake[::4] = True
+        snake[1::8, -1] = snake[2::8, -1] = snake[3::8, -1] = True
+        snake[5::8, 0] = snake[6::8, 0] = snake[7::8, 0] = True
+        self.assertEqual(len(numpy.unique(label_clusters(snake)[snake])), 1)
+
+    def test_detect_changes(self):
+        """Test only new or grown clusters are reported."""
+        previous = numpy.zeros((10, 10), dtype=bool)
+        previous[0:2, 0:2] = True  # Unchanged.
+        previous[5:7, 5:7] = True  # Grown.
+        current = previous.copy()
+        current[5:7, 7] = True
+        current[8:10, 0:3] = True  # New.
+
+        features = detect_changes(previous, current, (0, 0, 1, 1))
+        self.assertEqual([feature["properties"]["change"]
+            for feature in features], ["new", "grown"])
+
+        new, grown = features
+        self.assertEqual(new["geometry"]["coordinates"][0][0], [0, 0])
+        self.assertAlmostEqual(new["geometry"]["coordinates"][0][2][0], 0.3)
+        self.assertAlmostEqual(new["properties"]["area"],
+            new["properties"]["new_area"])
+        self.assertAlmostEqual(grown["properties"]["new_area"] * 3,
+            grown["properties"]["area"], delta=1)
+
+        self.assertEqual(detect_changes(current, current, (0, 0, 1, 1)), [])
+        self.assertEqual(len(detect_changes(None, current, (0, 0, 1, 1))), 3)
+
+    def test_event_log(self):
+        """Test events are read after a cursor, per region."""
+        directory = tempfile.mkdtemp()
+        try:
+            log = EventLog(directory + "/events.sqlite")
+            feature = {"type": "Feature", "properties": {"change": "new"}}
+            log.append("congo", 2014, [feature])
+            log.append("amazon", 2015, [feature, feature])
+
+            events, cursor = log.since()
+            self.assertEqual([(event["properties"]["region"],
+                event["properties"]["year"]) for event in events],
+                [("congo", 2014), ("amazon", 2015), ("amazon", 2015)])
+            self.assertEqual(log.since(cursor), ([], cursor))
+
+            events, _ = log.since(region="congo")
+            self.assertEqual(len(events), 1)
+            first, cursor = log.since(limit=1)
+            self.assertEqual(first + log.since(cursor)[0], log.since()[0])
+        finally:
+            shutil.rmtree(directory)
+
+
+class WatchlistTest(unittest.TestCase):
+    """Test the watchlist mode only computes new years."""
+
+    RECTANGLE = {"type": "Polygon",
+        "coordinates": [[[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]]}
+
+    def setUp(self):
+        """Test setup. Creates a mocked fetcher and a temporary store."""
+        self.directory = tempfile.mkdtemp()
+        self.store = ResultStore(self.directory)
+
+        self.fetcher = mock.MagicMock()
+        geometry = self.fetcher.CountryToGeometry.return_value
+        geometry.toGeoJSON.return_value = self.RECTANGLE
+        rectangle = self.fetcher.GeometryToRectangle.return_value
+        rectangle.toGeoJSON.return_value = self.RECTANGLE
+        self.fetcher.GetForestChangeSummary.side_effect = (
+            lambda *args: {"stats": {"loss_area": 1}, "clusters": {}})
+        self.fetcher.GetForestIndicesImage.return_value = "http://foo.com/bar"
+
+        self.runner = WatchlistRunner(self.fetcher, self.store)
+
+    def tearDown(self):
+        """Removes the temporary store."""
+        shutil.rmtree(self.directory)
+
+    def test_incremental_runs(self):
+        """Test years computed by previous runs are skipped."""
+        regions = [{"name": "congo", "country": "congo", "scale": 500}]
+
+        self.assertEqual(self.runner.run(regions, current_year=2005), 0)
+        self.assertEqual(self.fetcher.GetForestChangeSummary.call_count, 4)
+        self.assertEqual(self.fetcher.CountryToGeometry.call_count, 1)
+
+        with mock.patch("ee.Geometry"):
+            self.assertEqual(self.runner.run(regions, current_year=2006), 0)
+        self.assertEqual(self.fetcher.GetForestChangeSummary.call_count, 5)
+        self.assertEqual(self.fetcher.CountryToGeometry.call_count, 1)
+
+        document = self.store.get("congo")
+        self.assertEqual(sorted(document["results"]),
+            ["2001", "2002", "2003", "2004", "2005"])
+        # Links expire, so they are generated on read instead.
+        self.assertNotIn("href", document["results"]["2005"])
+        self.assertFalse(self.fetcher.GetForestIndicesImage.called)
+
+    def test_changed_region(self):
+        """Test results are recomputed when a region changes."""
+        self.runner.run([{"name": "congo", "country": "congo", "scale": 500}],
+            current_year=2003)
+        self.runner.run([{"name": "congo", "country": "congo", "scale": 500,
+            "start": 2001}], current_year=2003)
+
+        self.assertEqual(self.fetcher.CountryToGeometry.call_count, 2)
+        self.assertEqual(sorted(self.store.get("congo")["results"]), ["2002"])
+
+    def test_failures_reported(self):
+        """Test a failing region does not stop the run."""
+        self.fetcher.CityToGeometry.side_effect = Error("Unknown city")
+        regions = [
+            {"name": "nowhere", "city": "nowhere"},
+            {"name": "congo", "country": "congo", "scale": 500},
+        ]
+
+        self.assertEqual(self.runner.run(regions, current_year=2002), 1)
+        self.assertEqual(self.store.keys(), ["congo"])
+
+    def test_change_events(self):
+        """Test clusters appearing between consecutive years are logged."""
+        rasters = RasterStore(self.directory + "/rasters")
+        events = EventLog(self.directory + "/events.sqlite")
+        runner = WatchlistRunner(self.fetcher, self.store, rasters, events)
+
+        masks = {}
+        for year in (2001, 2002):
+            masks[year] = numpy.zeros((10, 10), dtype=[("loss", "u1")])
+        masks[2001]["loss"][0:2, 0:2] = 1
+        masks[2002]["loss"][0:2, 0:2] = 1
+        masks[2002]["loss"][6:8, 6:8] = 1
+
+        self.fetcher.GetForestLossMask.side_effect = (
+            lambda start, year, rectangle, scale: year)
+        rasters.fetch = lambda key, year, bounds: rasters.put(key, masks[year],
+            bounds)
+
+        runner.run([{"name": "congo", "country": "congo", "scale": 500}],
+            current_year=2003)
+
+        # The first year is the baseline, without events.
+        results = self.store.get("congo")["results"]
+        self.assertEqual(results["2001"]["events"], 0)
+        self.assertEqual(results["2002"]["events"], 1)
+        self.assertEqual(rasters.keys(), ["congo.loss.2002"])
+
+        logged, _ = events.since()
+        self.assertEqual([event["properties"]["year"] for event in logged],
+            [2002])
+        self.assertEqual(logged[0]["geometry"]["coordinates"][0][0], [6, 2])
+
+        # The mask of a rebuilt region is deleted.
+        runner.run([{"name": "congo", "country": "congo", "scale": 1000,
+            "start": 2001}], current_year=2002)
+        self.assertEqual(rasters.keys(), [])
+        self.assertEqual(len(events.since()[0]), 1)
+
+
+class TimelapseTest(unittest.TestCase):
+    """Test the generation of the time-lapse animations."""
+
+    def test_frame_dates(self):
+        """Test the frames dates are bounded."""
+        self.assertEqual(frame_dates(datetime(2010, 1, 1),
+            datetime(2012, 6, 1), relativedelta(years=1)),
+            [datetime(2010, 1, 1), datetime(2011, 1, 1), datetime(2012, 1, 1)])
+        self.assertRaises(Error, frame_dates, datetime(2010, 1, 1),
+            datetime(2009, 1, 1), relativedelta(years=1))
+        self.assertRaises(Error, frame_dates, datetime(2010, 1, 1),
+            datetime(2012, 1, 1), relativedelta())
+        self.assertRaises(Error, frame_dates, datetime(2010, 1, 1),
+            datetime(2010, 1, 1) + relativedelta(days=MAX_FRAMES),
+            relativedelta(days=1))
+
+    def test_fetch_frames(self):
+        """Test frames are returned in order, few being loaded ahead."""
+        async_fetcher = AsyncImageFetcher(mock.MagicMock(), workers=4)
+        loaded = []
+
+        def load(index):
+            """Loads the late frames first."""
+            time.sleep(0.01 * (10 - index))
+            loaded.append(index)
+            return index
+
+        try:
+            frames = fetch_frames(async_fetcher.submit, load, range(10),
+                ahead=3)
+            self.assertEqual(next(frames), 0)
+            self.assertTrue(len(loaded) <= 4)
+            self.assertEqual(list(frames), list(range(1, 10)))
+        finally:
+            async_fetcher.close()
+
+    def test_encode_gif(self):
+        """Test frames are encoded into an animation of the first size."""
+        frames = [Image.new("RGB", (20, 10), (0, 0, 0)),
+            Image.new("RGB", (40, 20), (255, 0, 0)),
+            Image.new("RGB", (20, 10), (0, 0, 255))]
+        chunks = list(encode_gif(iter(frames), 300))
+        self.assertEqual(len(chunks), 4)
+        self.assertTrue(chunks[0].startswith(b"GIF89a"))
+
+        animation = Image.open(BytesIO(b"".join(chunks)))
+        self.assertEqual((animation.n_frames, animation.size), (3, (20, 10)))
+        self.assertEqual(animation.info["duration"], 300)
+        animation.seek(1)
+        self.assertEqual(animation.convert("RGB").getpixel((5, 5)),
+            (255, 0, 0))
+        self.assertEqual(list(encode_gif([], 300)), [])
+
+    def test_raster_frame(self):
+        """Test local rasters are rendered with the given range."""
+        raster = mock.MagicMock()
+        raster.array = numpy.zeros((2, 3), dtype=[("red", "f4"),
+            ("green", "f4"), ("blue", "f4")])
+        raster.array["red"] = 2000
+        raster.array["blue"][0, 0] = numpy.nan
+        frame = raster_frame(raster, ("red", "green", "blue"), 0, 2000)
+        self.assertEqual(frame.size, (3, 2))
+        self.assertEqual(frame.getpixel((0, 0)), (255, 0, 0))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python2
+
+"""Pyramid of forest change tiles, served to the map of the frontend.
+
+Forest change images are cut in the z/x/y tiles of the Web Mercator grid
+used by web maps, so that pans and zooms hit tiles already generated instead
+of computing a new image on the Earth Engine.
+
+Tiles are generated lazily and cached on disk, under the tiles directory of
+the store. When possible, a tile is derived locally from tiles already
+cached rather than generated on the Earth Engine:
+    - tiles zoomed beyond the resolution of the dataset are cropped from
+      their ancestor at NATIVE_ZOOM, which holds the same information;
+    - tiles whose four children are cached are downsampled from them.
+"""
+
+import gflags
+import math
+import os
+import requests
+import tempfile
+import threading
+
+from io import BytesIO
+from PIL import Image
+
+from utils import Error
+
+FLAGS = gflags.FLAGS
+gflags.DEFINE_list("tile_years", [], "Comma separated START:STOP year pairs "
+    "served by the forest change tiles, e.g. 2000:2015. Any valid pair is "
+    "served if empty.")
+
+# Sub directory of the store containing the tiles.
+TILES_STORE = 'tiles'
+
+# Side of the tiles, in pixels.
+TILE_SIZE = 256
+
+# The forest changes are computed on a 500 meters dataset, and the pixels of
+# the zoom level 8 tiles measure 611 meters at the equator. Deeper tiles are
+# only crops of these ones.
+NATIVE_ZOOM = 8
+MAX_ZOOM = 18
+
+# Number of locks serializing the generation of a same tile.
+LOCK_STRIPES = 64
+
+# Connect and read timeouts of the tiles downloads, in seconds.
+DOWNLOAD_TIMEOUT = (3.05, 60)
+
+
+def tile_bounds(z, x, y):
+    """Computes the bounds of a Web Mercator tile.
+
+    Parameters:
+        z, x, y: zoom level, column and row of the tile. Row 0 is north.
+    Returns:
+        The (x_min, y_min, x_max, y_max) bounds of the tile, in degrees.
+    """
+    tiles = 2. ** z
+
+    def latitude(row):
+        """Latitude of the northern edge of a row of tiles."""
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row /
+            tiles))))
+
+    return (x / tiles * 360 - 180, latitude(y + 1), (x + 1) / tiles * 360 - 180,
+        latitude(y))
+
+
+def check_tile(z, x, y):
+    """Checks a tile belongs to the pyramid.
+
+    Raises:
+        Error: if the tile does not exist.
+    """
+    if not 0 <= z <= MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise Error("Tile %s/%s/%s does not exist." % (z, x, y), 404)
+
+
+class TilePyramid:
+    """Lazily generated pyramid of forest change tiles."""
+
+    def __init__(self, fetcher, directory, session=requests):
+        """Constructor.
+
+        Parameters:
+            fetcher: ImageFetcher used to reach the Earth Engine.
+            directory: directory where tiles are cached. Created if it does
+                not exist yet.
+            session: requests session used to download the tiles.
+        """
+        self.fetcher = fetcher
+        self.directory = directory
+        self.session = session
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, start, stop, z, x, y):
+        """Returns the path of the file containing a tile."""
+        return os.path.join(self.directory, 'forestDiff', str(start),
+            str(stop), str(z), str(x), '%s.png' % y)
+
+    def get(self, start, stop, z, x, y):
+        """Returns a tile, generating it if it is not cached yet.
+
+        Parameters:
+            start: reference year of the forest changes.
+            stop: year compared to the reference year.
+            z, x, y: zoom level, column and row of the tile.
+        Returns:
+            The path of the PNG file of the tile.
+        """
+        check_tile(z, x, y)
+        path = self._path(start, stop, z, x, y)
+        if os.path.exists(path):
+            return path
+
+        # Generate the ancestor first, so no lock is held while waiting for
+        # another tile.
+        if z > NATIVE_ZOOM:
+            depth = z - NATIVE_ZOOM
+            self.get(start, stop, NATIVE_ZOOM, x >> depth, y >> depth)
+
+        # Concurrent requests of a tile wait for the first one to generate it.
+        with self.locks[hash(path) % LOCK_STRIPES]:
+            if os.path.exists(path):
+                return path
+
+            image = self._render(start, stop, z, x, y)
+
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Created by a concurrent request.
+                    pass
+            fd, temporary_path = tempfile.mkstemp(dir=directory,
+                suffix='.tmp')
+            with os.fdopen(fd, 'wb') as temporary:
+                image.save(temporary, 'PNG')
+            os.rename(temporary_path, path)
+
+        return path
+
+    def _open(self, start, stop, z, x, y):
+        """Loads a tile, generating it if needed."""
+        image = Image.open(self.get(start, stop, z, x, y))
+        image.load()
+        return image.convert('RGB')
+
+    def _render(self, start, stop, z, x, y):
+        """Generates the image of a tile, locally when possible."""
+        if z > NATIVE_ZOOM:
+            # Crop the area of the tile from its ancestor, without smoothing
+            # the pixels of the dataset.
+            depth = z - NATIVE_ZOOM
+            ancestor = self._open(start, stop, NATIVE_ZOOM, x >> depth,
+                y >> depth)
+            size = float(TILE_SIZE) / 2 ** depth
+            left = (x - (x >> depth << depth)) * size
+            top = (y - (y >> depth << depth)) * size
+            return ancestor.resize((TILE_SIZE, TILE_SIZE), Image.NEAREST,
+                box=(left, top, left + size, top + size))
+
+        children = [(z + 1, 2 * x + dx, 2 * y + dy)
+            for dy in (0, 1) for dx in (0, 1)]
+        if z < NATIVE_ZOOM and all(os.path.exists(
+                self._path(start, stop, *child)) for child in children):
+            mosaic = Image.new('RGB', (2 * TILE_SIZE, 2 * TILE_SIZE))
+            for child_z, child_x, child_y in children:
+                mosaic.paste(self._open(start, stop, child_z, child_x,
+                    child_y), ((child_x - 2 * x) * TILE_SIZE,
+                    (child_y - 2 * y) * TILE_SIZE))
+            return mosaic.resize((TILE_SIZE, TILE_SIZE), Image.BOX)
+
+        url = self.fetcher.GetForestIndicesTile(start, stop,
+            tile_bounds(z, x, y), TILE_SIZE)
+        try:
+            response = self.session.get(url, timeout=DOWNLOAD_TIMEOUT)
+        except requests.RequestException as e:
+            raise Error('Unable to download the tile: %s' % e, 500)
+        if not response.ok:
+            raise Error('Unable to download the tile. Earth Engine status '
+                'code: %s' % response.status_code, 500)
+
+        image = Image.open(BytesIO(response.content))
+        return image.convert('RGB')
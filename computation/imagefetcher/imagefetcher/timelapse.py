@@ -0,0 +1,177 @@
+#!/usr/bin/env python2
+
+"""Time-lapse animations, showing how an area changes over the years.
+
+A time-lapse is a sequence of frames, each the RGB image of a date window.
+Frames are generated concurrently on the asynchronous fetcher workers, under
+the rate limit, and encoded in order into an animated GIF as soon as they
+are available. The animation is streamed to the client while the next frames
+are generated: only the frames fetched ahead (FRAMES_AHEAD) and the one being
+encoded are held in memory, whatever the length of the time-lapse.
+
+Frames are downloaded from the Earth Engine (see
+:meth:`ImageFetcher.GetRGBFrame`), or built from local rasters with
+:func:`raster_frame`.
+"""
+
+import numpy
+import requests
+
+from collections import deque
+from io import BytesIO
+from PIL import GifImagePlugin
+from PIL import Image
+
+from utils import Error
+
+# Number of frames generated concurrently, ahead of the one being encoded.
+FRAMES_AHEAD = 4
+
+# Maximal number of frames of a time-lapse.
+MAX_FRAMES = 100
+
+# Largest side of the frames, in pixels.
+DEFAULT_FRAME_SIZE = 512
+MAX_FRAME_SIZE = 1024
+
+# Display time of each frame, in milliseconds. GIF durations are counted in
+# hundredths of seconds.
+DEFAULT_FRAME_DURATION = 500
+MIN_FRAME_DURATION = 20
+
+# Connect and read timeouts of the frames downloads, in seconds.
+DOWNLOAD_TIMEOUT = (3.05, 60)
+
+# Number of colors of the frames, GIF being limited to 256.
+GIF_COLORS = 256
+
+
+def frame_dates(start, stop, step):
+    """Computes the middle dates of the frames of a time-lapse.
+
+    Parameters:
+        start: date of the first frame.
+        stop: date after which there is no frame.
+        step: relativedelta between two frames.
+    Returns:
+        The list of the middle dates.
+    Raises:
+        Error: if there is no frame, or too many.
+    """
+    if start + step <= start:
+        raise Error("The step between frames must be positive.")
+
+    dates = []
+    while start + step * len(dates) <= stop:
+        if len(dates) == MAX_FRAMES:
+            raise Error("A time-lapse has at most %s frames." % MAX_FRAMES)
+        dates.append(start + step * len(dates))
+
+    if not dates:
+        raise Error("A time-lapse has at least one frame.")
+    return dates
+
+
+def download_frame(url, session=None):
+    """Downloads and decodes a frame.
+
+    Parameters:
+        url: link of the image of the frame.
+        session: requests session used to download the frame.
+    Returns:
+        The RGB Image of the frame.
+    Raises:
+        Error: if the frame cannot be downloaded or decoded.
+    """
+    session = session if session is not None else requests
+    try:
+        response = session.get(url, timeout=DOWNLOAD_TIMEOUT)
+    except requests.RequestException as e:
+        raise Error('Unable to download the frame: %s' % e, 500)
+    if not response.ok:
+        raise Error('Unable to download the frame. Earth Engine status code: '
+            '%s' % response.status_code, 500)
+
+    try:
+        return Image.open(BytesIO(response.content)).convert('RGB')
+    except IOError:
+        raise Error('Invalid frame received from the Earth Engine', 500)
+
+
+def raster_frame(raster, bands, minimum, maximum):
+    """Builds a frame from a local raster.
+
+    Parameters:
+        raster: Raster of the window of the frame, see :mod:`rasterstore`.
+        bands: names of its red, green and blue bands.
+        minimum: band value rendered black.
+        maximum: band value rendered white.
+    Returns:
+        The RGB Image of the frame.
+    """
+    array = numpy.dstack([numpy.asarray(raster.array[band], dtype=float)
+        for band in bands])
+    array = (array - minimum) * 255. / (maximum - minimum)
+    pixels = numpy.nan_to_num(array).clip(0, 255).astype(numpy.uint8)
+    return Image.fromarray(pixels, 'RGB')
+
+
+def fetch_frames(submit, load, windows, ahead=FRAMES_AHEAD):
+    """Loads frames concurrently, in order.
+
+    Parameters:
+        submit: function running a call on workers, and returning its
+            AsyncResult. Typically :meth:`AsyncImageFetcher.submit`.
+        load: function loading the frame of a window.
+        windows: windows of the frames.
+        ahead: number of frames loaded ahead of the one returned.
+    Returns:
+        A generator of the frames, in the windows order.
+    """
+    windows = iter(windows)
+    pending = deque()
+    for window in windows:
+        pending.append(submit(load, window))
+        if len(pending) == ahead:
+            break
+
+    while pending:
+        frame = pending.popleft().get()
+        for window in windows:
+            pending.append(submit(load, window))
+            break
+        yield frame
+
+
+def encode_gif(frames, duration):
+    """Encodes frames into an animated GIF, frame by frame.
+
+    Each frame has its own palette. Frames are resized to the size of the
+    first one.
+
+    Parameters:
+        frames: iterable of the frames, as Images.
+        duration: display time of each frame, in milliseconds.
+    Returns:
+        A generator of the chunks of the GIF file: the header, then one
+        chunk per frame, then the trailer.
+    """
+    size = None
+    for frame in frames:
+        header = size is None
+        if header:
+            size = frame.size
+        elif frame.size != size:
+            frame = frame.resize(size, Image.BILINEAR)
+        frame = frame.convert('RGB').quantize(GIF_COLORS)
+
+        chunks = []
+        if header:
+            # Global header of the animation, looping forever.
+            chunks, _ = GifImagePlugin.getheader(frame, None, {'loop': 0})
+        chunks += GifImagePlugin.getdata(frame, duration=duration,
+            include_color_table=True)
+        yield b''.join(chunks)
+
+    if size is not None:
+        yield b';'
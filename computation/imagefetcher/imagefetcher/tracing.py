@@ -0,0 +1,229 @@
+#!/usr/bin/env python2
+
+"""Request tracing, measuring the time spent in each stage of a request.
+
+Every request gets a correlation ID, taken from the X-Correlation-ID header
+or generated, and echoed in the response so callers can log it. Stages of the
+request are measured as spans, nested in the request span.
+
+Spans are exported as JSON lines in the --trace_file file, each line being
+a span of the OpenTelemetry (OTLP) JSON encoding: the trace ID is 16 random
+bytes, the correlation ID being a correlation.id attribute of every span.
+Lines are wrapped in the resourceSpans and scopeSpans of an export request
+before being sent to an OTLP collector. Tracing costs nothing but the
+correlation ID when no trace file is given.
+"""
+
+import functools
+import gflags
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+FLAGS = gflags.FLAGS
+gflags.DEFINE_string("trace_file", "", "File where request spans are "
+    "appended as JSON lines. Tracing is disabled if empty.")
+
+CORRELATION_HEADER = 'X-Correlation-ID'
+
+# Correlation IDs received from callers must match this pattern, otherwise a
+# new one is generated.
+CORRELATION_ID_PATTERN = re.compile(r'^[\w.:-]{1,128}$')
+
+# Status codes of the OTLP spans.
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# Trace of the request handled by the current thread.
+_context = threading.local()
+
+
+class FileExporter:
+    """Appends spans to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        """Constructor.
+
+        Parameters:
+            path: path of the file. Created if it does not exist yet.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        """Appends spans to the file.
+
+        Parameters:
+            spans: list of span dictionaries.
+        """
+        lines = ''.join(json.dumps(span) + '\n' for span in spans)
+        with self.lock:
+            with open(self.path, 'a') as output:
+                output.write(lines)
+
+
+_exporters = {}
+_exporters_lock = threading.Lock()
+
+
+def get_exporter():
+    """Returns the exporter of the --trace_file file, or None if disabled."""
+    path = FLAGS.trace_file
+    if not path:
+        return None
+
+    with _exporters_lock:
+        if path not in _exporters:
+            _exporters[path] = FileExporter(path)
+        return _exporters[path]
+
+
+def new_id():
+    """Generates a random trace ID, of 16 bytes in hexadecimal."""
+    return uuid.uuid4().hex
+
+
+def start_trace(correlation_id=None, exporter=None, trace_id=None):
+    """Starts tracing the request handled by the current thread.
+
+    Parameters:
+        correlation_id: ID received from the caller, if any.
+        exporter: exporter receiving the spans when the trace ends. Spans are
+            not recorded if None.
+        trace_id: ID of the trace continued by the thread, e.g. by the
+            workers of a request. A new trace is started if None.
+    Returns:
+        The correlation ID of the request.
+    """
+    if correlation_id is None or not CORRELATION_ID_PATTERN.match(
+            correlation_id):
+        correlation_id = new_id()
+
+    _context.correlation_id = correlation_id
+    _context.trace_id = trace_id or new_id()
+    _context.exporter = exporter
+    _context.stack = []
+    _context.spans = []
+    return correlation_id
+
+
+def end_trace():
+    """Stops tracing the current thread, and exports its spans."""
+    exporter = getattr(_context, 'exporter', None)
+    spans = getattr(_context, 'spans', [])
+    _context.correlation_id = None
+    _context.trace_id = None
+    _context.exporter = None
+    _context.stack = []
+    _context.spans = []
+
+    if exporter is not None and spans:
+        exporter.export(spans)
+
+
+def correlation_id():
+    """Returns the correlation ID of the current request, or None."""
+    return getattr(_context, 'correlation_id', None)
+
+
+def trace_id():
+    """Returns the trace ID of the current request, or None."""
+    return getattr(_context, 'trace_id', None)
+
+
+def span(name, **attributes):
+    """Measures a stage of the current request.
+
+    Does nothing if the current thread is not traced.
+
+    Parameters:
+        name: name of the stage.
+        attributes: additional information attached to the span.
+    Returns:
+        The Span context manager.
+    """
+    return Span(name, **attributes)
+
+
+class Span:
+    """Context manager measuring a stage of the current request."""
+
+    def __init__(self, name, **attributes):
+        """Constructor.
+
+        Parameters:
+            name: name of the stage.
+            attributes: additional information attached to the span.
+        """
+        self.name = name
+        self.attributes = attributes
+        self.record = None
+
+    def __enter__(self):
+        if getattr(_context, 'exporter', None) is None:
+            return self
+
+        stack = _context.stack
+        self.record = {
+            'traceId': _context.trace_id,
+            'spanId': new_id()[:16],
+            'parentSpanId': stack[-1]['spanId'] if stack else '',
+            'name': self.name,
+            'startTimeUnixNano': int(time.time() * 1e9),
+            'attributes': dict((key, str(value))
+                for key, value in self.attributes.items()),
+        }
+        self.record['attributes'].update({
+            'correlation.id': _context.correlation_id,
+            'process.pid': str(os.getpid()),
+        })
+        stack.append(self.record)
+        return self
+
+    def set(self, key, value):
+        """Attaches an attribute to the span."""
+        if self.record is not None:
+            self.record['attributes'][key] = str(value)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.record is None:
+            return
+
+        self.record['endTimeUnixNano'] = int(time.time() * 1e9)
+        self.record['status'] = {'code': STATUS_OK}
+        if exc_type is not None:
+            self.record['status'] = {'code': STATUS_ERROR, 'message': str(
+                getattr(exc_value, 'message', exc_value))}
+
+        _context.stack.pop()
+        # Attributes are kept in a mapping while the span is open, and
+        # exported as the key and value list of OTLP.
+        record = dict(self.record, attributes=[{'key': key,
+                'value': {'stringValue': value}}
+            for key, value in sorted(self.record['attributes'].items())])
+        _context.spans.append(record)
+
+
+def traced(name):
+    """Decorator measuring each call of a function as a span.
+
+    Parameters:
+        name: name of the span.
+    Returns:
+        The decorator.
+    """
+
+    def decorator(func):
+        """Parametrized decorator."""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            """Wrapper on the function, measuring the call."""
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+    return decorator
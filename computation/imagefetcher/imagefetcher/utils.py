@@ -7,11 +7,28 @@ Defines a set of parsers and utilities for easier request handling.
 
 import functools
 import json
+import math
 
+from array import array
+from collections import namedtuple
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from flask import request
 
+# Approximate length of one degree of latitude, in meters.
+METERS_PER_DEGREE = 111320.
+
+try:
+    STRING_TYPES = basestring
+except NameError:
+    STRING_TYPES = str
+
+# Types of the JSON numbers. Booleans are not numbers there.
+try:
+    NUMBER_TYPES = (int, long, float)
+except NameError:
+    NUMBER_TYPES = (int, float)
+
 
 class Error(Exception):
     """Exception raised when an error occurs in the API."""
@@ -27,44 +44,84 @@ class Error(Exception):
         return {"error": self.message}
 
 
-def get_param(param_name, parser=str, required=False, default=None):
-    """Decorator used on route handler to pass a get parameter to the function.
+Param = namedtuple('Param', ['name', 'parser', 'required', 'default'])
+
+
+def param(name, parser=str, required=False, default=None):
+    """Describes a request parameter, for the :func:`get_params` decorator.
 
     Parameters:
-        param_name: name of the parameter, used in the request.
+        name: name of the parameter, used in the request.
         parser: eventual function parsing the parameter value.
         required: boolean indicating if the request should be drop if the
             parameter is missing.
         default: default value if the parameter is unspecified.
     Returns:
-        The wrapped function.
+        The Param description.
     """
     if required and default is not None:
         raise ValueError("A required parameter cannot have a default value.")
+    return Param(name, parser, required, default)
+
+
+def request_values():
+    """Returns the parameters sent with the current request.
+
+    GET requests send their parameters in the query string. POST requests may
+    also send them as form fields or as a JSON object, which is useful for
+    geometries too large to fit in a query string.
+
+    Returns:
+        A mapping of the parameter names to their values.
+    """
+    if request.method != 'POST':
+        return request.args
+
+    values = dict(request.args.items())
+    values.update(request.form.items())
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        values.update(body)
+    return values
+
+
+def get_params(*params):
+    """Decorator used on route handler to pass the parameters to the function.
+
+    All parameters of the route are parsed in a single pass, with a single
+    wrapper, instead of stacking a decorator per parameter.
+
+    Parameters:
+        params: Param descriptions, as returned by :func:`param`.
+    Returns:
+        The wrapped function.
+    """
+    params = tuple(params)
 
     def decorator(func):
         """Parametrized decorator."""
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            """Wrapper on the function, parsing GET parameter."""
-            param_value = request.args.get(param_name)
+            """Wrapper on the function, parsing the parameters."""
+            values = request_values()
 
-            if required and param_value is None:
-                raise Error("Expected GET parameter '%s' missing." %
-                    param_name)
+            for name, parser, required, default in params:
+                value = values.get(name)
+
+                if value is None:
+                    if required:
+                        raise Error("Expected parameter '%s' missing." % name)
+                    kwargs[name] = default
+                    continue
 
-            if param_value is not None:
                 try:
-                    param_value = parser(param_value)
+                    kwargs[name] = parser(value)
                 except Error:
                     raise
                 except Exception as e:
-                    raise Error(str(e))
-            else:
-                param_value = default
+                    raise Error("Invalid parameter '%s': %s" % (name, e))
 
-            kwargs.update({param_name: param_value})
             return func(*args, **kwargs)
 
         return wrapper
@@ -96,23 +153,89 @@ def get_geometry(get_parameters):
     return parser(value)
 
 
-def scale_from_geometry(rectangle):
-    """Attempts to compute a best scale based on the Image geometry.
+def rectangle_bounds(rectangle):
+    """Returns the (x_min, y_min, x_max, y_max) bounds of a rectangle.
+
+    Parameters:
+        rectangle: Rectangle generated from the client query.
+    Returns:
+        The bounds of the rectangle.
+    """
+    return polygon_bounds(rectangle.toGeoJSON())
+
+
+def polygon_bounds(geojson):
+    """Returns the (x_min, y_min, x_max, y_max) bounds of a GeoJSON polygon.
+
+    Parameters:
+        geojson: GeoJSON Polygon geometry.
+    Returns:
+        The bounds of its exterior ring.
+    """
+    ring = geojson['coordinates'][0]
+    xs = [x for x, _ in ring]
+    ys = [y for _, y in ring]
+    return min(xs), min(ys), max(xs), max(ys)
+
 
-    Best scale is estimated rectangle area. The scale is (almost) proportionnal
-    with the area. This is done to avoid generating a too huge image using a
-    default scale.
+def dimensions_from_scale(rectangle, scale):
+    """Computes the size in pixels of a rectangle rendered at a given scale.
 
     Parameters:
         rectangle: Rectangle generated from the client query.
+        scale: image resolution, in meters per pixels.
     Returns:
-        A 'best scale' based on the rectangle values.
+        The image dimensions, formatted as WIDTHxHEIGHT.
     """
-    # Get the highest and lowest rectangle bounds
     x_0, y_0 = rectangle.toGeoJSON()['coordinates'][0][0]
     x_1, y_1 = rectangle.toGeoJSON()['coordinates'][0][2]
 
-    return int((abs(x_0 - x_1) * abs(y_0 - y_1) + 1) * 20)
+    # Meridians get closer to each other when going away from the equator.
+    latitude = math.radians((y_0 + y_1) / 2.)
+    width = abs(x_0 - x_1) * METERS_PER_DEGREE * math.cos(latitude) / scale
+    height = abs(y_0 - y_1) * METERS_PER_DEGREE / scale
+
+    return "%dx%d" % (max(1, int(round(width))), max(1, int(round(height))))
+
+
+class Vertices:
+    """Polygon or multipolygon parsed from a request.
+
+    The coordinates of each ring are stored as a flat array of doubles
+    (x0, y0, x1, y1...), which is far lighter than nested lists.
+    """
+
+    __slots__ = ('type', 'polygons')
+
+    def __init__(self, geometry_type, polygons):
+        """Constructor.
+
+        Parameters:
+            geometry_type: either Polygon or MultiPolygon.
+            polygons: list of polygons, each being a list of rings. The first
+                ring is the exterior, the next ones are holes.
+        """
+        self.type = geometry_type
+        self.polygons = polygons
+
+    def to_geojson(self):
+        """Converts the vertices to a GeoJSON geometry."""
+        polygons = [[[[ring[i], ring[i + 1]] for i in range(0, len(ring), 2)]
+            for ring in polygon] for polygon in self.polygons]
+
+        return {
+            'type': self.type,
+            'coordinates': polygons[0] if self.type == 'Polygon' else polygons,
+        }
+
+    def bounds(self):
+        """Returns the (x_min, y_min, x_max, y_max) bounds of the vertices."""
+        exteriors = [polygon[0] for polygon in self.polygons]
+        xs = [min(ring[0::2]) for ring in exteriors] + \
+            [max(ring[0::2]) for ring in exteriors]
+        ys = [min(ring[1::2]) for ring in exteriors] + \
+            [max(ring[1::2]) for ring in exteriors]
+        return min(xs), min(ys), max(xs), max(ys)
 
 
 class Parser:
@@ -131,39 +254,123 @@ class Parser:
         """
         return datetime.strptime(entry, "%Y-%m-%d")
 
+    @staticmethod
+    def _ring(ring):
+        """Parse a closed list of points as a flat array of coordinates."""
+        if type(ring) != list:
+            raise ValueError("Not a list of list.")
+
+        coordinates = array('d')
+        for point in ring:
+            if type(point) != list:
+                raise ValueError("Not a list of list.")
+            if len(point) != 2:
+                raise ValueError("Some points do not have 2 coords.")
+            if (type(point[0]) not in NUMBER_TYPES
+                    or type(point[1]) not in NUMBER_TYPES):
+                raise ValueError("Some points have invalid types.")
+            coordinates.extend(point)
+
+        if len(coordinates) < 8:
+            raise ValueError("A polygon needs at least 3 points.")
+        if (coordinates[0] != coordinates[-2]
+                or coordinates[1] != coordinates[-1]):
+            raise ValueError("Last point must equal first point.")
+
+        return coordinates
+
     @staticmethod
     def polygon(entry):
-        """Parse an entry as a polygon.
+        """Parse an entry as a polygon or a multipolygon.
 
         A polygon is a list of coordinates (list of two numbers) representing
         points of the polygon. The start element and end element must match.
+        Polygons with holes are lists of such rings, and multipolygons are
+        lists of polygons with holes, as in GeoJSON.
 
         Examples of valid polygons:
             [[1, 2], [2, 3], [4, 9], [1, 2]]
-            [[10.9, -23.3, [8, -20], [10, -10], [10.9, -23.3]]]
+            [[10.9, -23.3], [8, -20], [10, -10], [10.9, -23.3]]
+            [[[[1, 2], [2, 3], [4, 9], [1, 2]]], [[[5, 5], [6, 5], ...]]]
 
         Parameters:
-            entry: a string supposed to contain a polygon
+            entry: a string supposed to contain a polygon, or the already
+                decoded JSON of a POST body.
         Returns:
-            A list corresponding to valid polygon
+            The Vertices corresponding to valid polygon.
         Raises:
-            ValueError: if the json is unreadable.
-            AssertionError: if the polygon is invalid.
+            ValueError: if the json is unreadable or the polygon is invalid.
         """
-        try:
-            polygon = json.loads(entry)
-        except ValueError:
-            raise ValueError("Unreadable JSON sent.")
-
-        assert type(polygon) == list, "Not a list"
-        assert all(type(p) == list for p in polygon), "Not a list of list."
-        assert all(len(p) == 2 for p in polygon), ("Some points do not have 2 "
-                "coords.")
-        assert all(all(type(c) in (int, float) for c in p)
-                for p in polygon), "Some points have invalid types."
-        assert polygon[0] == polygon[-1], "Last point must equal first point."
-
-        return polygon
+        if isinstance(entry, STRING_TYPES):
+            try:
+                entry = json.loads(entry)
+            except ValueError:
+                raise ValueError("Unreadable JSON sent.")
+
+        if type(entry) != list or len(entry) == 0:
+            raise ValueError("Not a list")
+
+        # The nesting depth tells whether this is a single ring, a polygon
+        # with holes or a multipolygon.
+        depth, node = 0, entry
+        while type(node) == list and len(node) > 0:
+            node, depth = node[0], depth + 1
+
+        if depth <= 2:
+            return Vertices('Polygon', [[Parser._ring(entry)]])
+        if depth == 3:
+            return Vertices('Polygon', [[Parser._ring(r) for r in entry]])
+        if depth == 4:
+            return Vertices('MultiPolygon', [
+                [Parser._ring(r) for r in Parser._list(polygon)]
+                for polygon in entry])
+
+        raise ValueError("Too many nested lists.")
+
+    @staticmethod
+    def _list(entry):
+        """Ensures an entry is a list."""
+        if type(entry) != list:
+            raise ValueError("Not a list of list.")
+        return entry
+
+    @staticmethod
+    def names(entry):
+        """Parse an entry as a list of names.
+
+        Parameters:
+            entry: comma separated names, or a list of names decoded from a
+                JSON request.
+        Returns:
+            The list of names, without surrounding spaces.
+        Raises:
+            ValueError: if the list is empty.
+        """
+        if not isinstance(entry, list):
+            entry = entry.split(",")
+        names = [name.strip() for name in entry if name.strip()]
+        if not names:
+            raise ValueError("Expected at least one name.")
+        return names
+
+    @staticmethod
+    def one_of(choices):
+        """Generates a parser accepting only a set of values.
+
+        Parameters:
+            choices: list of accepted values.
+        Returns:
+            A parser returning the entry if it is one of the choices.
+        """
+
+        def parser(entry):
+            """Parse an entry as one of the choices."""
+            if entry not in choices:
+                raise ValueError("Expected one of %s, got '%s'." %
+                    (", ".join(choices), entry))
+            return entry
+
+        return parser
 
     @staticmethod
     def date_delta(entry):
@@ -0,0 +1,240 @@
+#!/usr/bin/env python2
+
+"""Watchlist mode, precomputing forest changes over a list of regions.
+
+This file contains is the entry point to the following command:
+    python2 -m imagefetcher.watchlist --watchlist=watchlist.json
+
+Each run only computes the years elapsed since the previous run, and stores
+the results (statistics and deforestation clusters) in the local store, where
+the API serves them through the /watchlist routes. Earth Engine links expire,
+so the links of the images are generated when the results are read.
+
+The deforestation mask of the last computed year of each region is also kept
+in the raster store. Clusters of deforested pixels which appeared or grew
+since the previous year are appended as events to the event log, served by
+the /events route (see the :mod:`changes` module). The first computed year
+of a region is its baseline: its clusters are not events.
+
+The watchlist is a JSON list of regions such as:
+    [
+        {"name": "rondonia", "polygon": [[-68, -7], [-65, -7], ...]},
+        {"name": "congo", "country": "congo", "start": 2005, "scale": 1000}
+    ]
+A region must specify exactly one of polygon/place/country/city. The start
+year defaults to 2000, and the scale is computed from the region if missing.
+"""
+
+import ee
+import gflags
+import json
+import logging
+import os
+import sys
+
+from datetime import date
+
+from changes import EventLog
+from changes import detect_changes
+from fetcher import ImageFetcher
+from ratelimit import admission
+from rasterstore import RasterStore
+from scaleplanner import scale_from_geometry
+from store import ResultStore
+from utils import Error
+from utils import get_geometry
+from utils import polygon_bounds
+
+FLAGS = gflags.FLAGS
+gflags.DEFINE_string("watchlist", "watchlist.json", "JSON file listing the "
+    "regions to watch.")
+
+# Sub directory of the store containing the watched regions results.
+WATCHLIST_STORE = 'watchlist'
+
+# Sub directory of the store containing the deforestation masks, and file of
+# the change events.
+RASTERS_STORE = 'rasters'
+EVENTS_FILE = 'events.sqlite'
+
+# Keys of a watchlist region defining its position.
+POSITION_KEYS = ('polygon', 'place', 'country', 'city')
+
+DEFAULT_START_YEAR = 2000
+
+
+def open_store():
+    """Opens the store containing the watched regions results."""
+    return ResultStore(os.path.join(FLAGS.store_dir, WATCHLIST_STORE))
+
+
+def open_rasters():
+    """Opens the store containing the deforestation masks."""
+    return RasterStore(os.path.join(FLAGS.store_dir, RASTERS_STORE))
+
+
+def open_events():
+    """Opens the log of the change events."""
+    if not os.path.isdir(FLAGS.store_dir):
+        os.makedirs(FLAGS.store_dir)
+    return EventLog(os.path.join(FLAGS.store_dir, EVENTS_FILE))
+
+
+class WatchlistRunner:
+    """Incrementally computes forest changes over watched regions."""
+
+    def __init__(self, fetcher, store, rasters=None, events=None):
+        """Constructor.
+
+        Parameters:
+            fetcher: ImageFetcher used to reach the Earth Engine.
+            store: ResultStore where results are persisted.
+            rasters: RasterStore where deforestation masks are kept.
+            events: EventLog where change events are appended. Changes are
+                not detected without rasters and events.
+        """
+        self.fetcher = fetcher
+        self.store = store
+        self.rasters = rasters
+        self.events = events
+
+    def _get_geometry(self, region):
+        """Converts the position of a region to a geometry."""
+        return get_geometry({
+            'country': (region.get('country'), self.fetcher.CountryToGeometry),
+            'place': (region.get('place'), self.fetcher.PlaceToGeometry),
+            'polygon': (region.get('polygon'),
+                self.fetcher.VerticesToGeometry),
+            'city': (region.get('city'), self.fetcher.CityToGeometry),
+        })
+
+    def _detect_changes(self, document, rectangle, year):
+        """Emits the clusters deforested since the previous computed year.
+
+        Without previous year, the mask is only stored as the baseline of the
+        next years.
+
+        Parameters:
+            document: document of the region.
+            rectangle: area of the region.
+            year: computed year.
+        Returns:
+            The number of emitted events.
+        """
+        url = self.fetcher.GetForestLossMask(document['start'], year,
+            rectangle, document['scale'])
+        key = '%s.loss.%s' % (document['name'], year)
+        current = self.rasters.fetch(key, url,
+            polygon_bounds(document['image_geojson']))
+
+        previous_key = document.get('loss_mask')
+        previous = self.rasters.open(previous_key) if previous_key else None
+        features = []
+        if previous is not None:
+            features = detect_changes(previous.array['loss'],
+                current.array['loss'], current.bounds)
+            self.events.append(document['name'], year, features)
+
+        if previous_key is not None and previous_key != key:
+            self.rasters.delete(previous_key)
+        document['loss_mask'] = key
+        return len(features)
+
+    def update_region(self, region, current_year):
+        """Computes the years of a region not computed by previous runs.
+
+        Parameters:
+            region: watchlist entry of the region.
+            current_year: current year. Being incomplete, it is not computed.
+        Returns:
+            The updated document of the region.
+        """
+        position = dict((key, region[key]) for key in POSITION_KEYS
+            if key in region)
+        start = region.get('start', DEFAULT_START_YEAR)
+        document = self.store.get(region['name'])
+
+        # Results are only reused if the region did not change since then.
+        if (document is None or document['position'] != position
+                or document['start'] != start
+                or document['requested_scale'] != region.get('scale')):
+            geometry = self._get_geometry(region)
+            rectangle = self.fetcher.GeometryToRectangle(geometry)
+            # The mask of the previous area is no baseline for the new one.
+            if (document is not None and document.get('loss_mask')
+                    and self.rasters is not None):
+                self.rasters.delete(document['loss_mask'])
+            document = {
+                'name': region['name'],
+                'position': position,
+                'start': start,
+                'requested_scale': region.get('scale'),
+                'scale': region.get('scale') or scale_from_geometry(rectangle),
+                'geojson': geometry.toGeoJSON(),
+                'image_geojson': rectangle.toGeoJSON(),
+                'results': {},
+            }
+        else:
+            # Skip geocoding on known regions.
+            rectangle = ee.Geometry(document['image_geojson'])
+
+        for year in range(start + 1, current_year):
+            if str(year) in document['results']:
+                continue
+
+            logging.info("Computing %s from %s to %s.", region['name'], start,
+                year)
+            summary = self.fetcher.GetForestChangeSummary(start, year,
+                rectangle, document['scale'])
+            summary['start'], summary['stop'] = start, year
+            if self.rasters is not None and self.events is not None:
+                summary['events'] = self._detect_changes(document, rectangle,
+                    year)
+            document['results'][str(year)] = summary
+
+            # Save after each year, so an interrupted run is not lost.
+            self.store.put(region['name'], document)
+
+        return document
+
+    def run(self, regions, current_year=None):
+        """Updates all the regions of the watchlist.
+
+        Parameters:
+            regions: watchlist entries.
+            current_year: current year. Defaults to today's year.
+        Returns:
+            The number of regions that failed to update.
+        """
+        if current_year is None:
+            current_year = date.today().year
+
+        failures = 0
+        for region in regions:
+            try:
+                self.update_region(region, current_year)
+            except (Error, ee.EEException, IOError) as e:
+                logging.error("Unable to update %s: %s", region.get('name'),
+                    getattr(e, 'message', e))
+                failures += 1
+
+        return failures
+
+
+def main(argv):
+    """Updates the regions of the watchlist file."""
+    FLAGS(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    with open(FLAGS.watchlist) as watchlist:
+        regions = json.load(watchlist)
+
+    ee.Initialize()
+    runner = WatchlistRunner(ImageFetcher(), open_store(), open_rasters(),
+        open_events())
+    with admission('batch', 'watchlist'):
+        return 1 if runner.run(regions) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))